@@ -0,0 +1,405 @@
+#! /usr/bin/env python
+
+"""
+Benchmarks of simulating, pruning and writing trees, and of the
+`sim-SDSD-trees` pipeline.
+
+Each scenario is timed over several repeats, and then run once more under
+`tracemalloc` to measure its peak memory. The results are written as JSON, so
+that runs on different commits can be compared. The script is run from the
+root of the repository, and it uses the `sdsdsim` package installed there (in
+editable mode). To run the same scenarios on another commit, run a copy of the
+script kept outside the tree:
+
+    cp benchmarks/run_benchmarks.py /tmp/run_benchmarks.py
+    python /tmp/run_benchmarks.py -o before.json
+    git checkout <other-commit>
+    python /tmp/run_benchmarks.py -o after.json --compare before.json
+
+The other commit needs the `SDSDTreeSimulator` and `sim_SDSD_trees` of
+`sdsdsim.model` and the `-j`, `-f` and `-o` options of `sim-SDSD-trees`, which
+all commits since the one adding this script have.
+
+Scenarios are selected with `-k` (a substring of their names), and `--quick`
+shrinks them for a fast smoke test.
+"""
+
+import os
+import sys
+import io
+import copy
+import json
+import time
+import random
+import argparse
+import platform
+import datetime
+import tempfile
+import statistics
+import subprocess
+import tracemalloc
+
+import sdsdsim
+from sdsdsim import model
+from sdsdsim.cli import sim_SDSD_trees
+
+PROJECT_DIR = os.getcwd()
+SDSD_CONFIG_PATH = os.path.join(PROJECT_DIR, "phytools-resources",
+        "sdsd-config.yml")
+
+
+def get_base_model(**kwargs):
+    params = dict(
+        q = [
+            [-0.3, 0.3],
+            [0.3, -0.3],
+        ],
+        birth_rates = [1.0, 1.0],
+        death_rates = [0.5, 0.5],
+        burst_rate = 0.5,
+        burst_probs = [0.1, 0.6],
+        burst_furcation_poisson_means = [1.0, 2.0],
+        burst_furcation_poisson_shifts = [2, 2],
+        only_bifurcate = False,
+    )
+    params.update(kwargs)
+    return model.SDSDModel(**params)
+
+def get_many_state_model(n_states):
+    rng = random.Random(1)
+    q = []
+    for i in range(n_states):
+        row = [rng.uniform(0.1, 1.0) for j in range(n_states)]
+        row[i] = 0.0
+        row[i] = -sum(row)
+        q.append(row)
+    return model.SDSDModel(
+        q = q,
+        birth_rates = [rng.uniform(0.8, 1.2) for i in range(n_states)],
+        death_rates = [rng.uniform(0.2, 0.5) for i in range(n_states)],
+        burst_rate = 0.5,
+        burst_probs = [rng.uniform(0.0, 0.5) for i in range(n_states)],
+        burst_furcation_poisson_means = [
+            rng.uniform(0.5, 2.0) for i in range(n_states)],
+        burst_furcation_poisson_shifts = [2] * n_states,
+        only_bifurcate = False,
+    )
+
+def sim_trees(sdsd_model, n, keep_extinct_trees = True, **kwargs):
+    return list(model.sim_SDSD_trees(
+            n = n,
+            sdsd_model = sdsd_model,
+            rng_seed = 1,
+            keep_extinct_trees = keep_extinct_trees,
+            **kwargs
+        ))
+
+
+# Each scenario function takes a size factor, does any setup, and returns the
+# parameters of the scenario, a callable that runs it (once), and a callable
+# (or None) that is called, untimed, before each run. The run callable returns
+# the number of items processed (e.g., trees), which is used to report the time
+# per item.
+
+def sim_scenario(sdsd_model, n_trees, **kwargs):
+    def setup(scale):
+        n = max(1, int(n_trees * scale))
+        params = dict(kwargs, n_trees = n)
+        simulator = model.SDSDTreeSimulator(sdsd_model)
+        def run():
+            for i in range(n):
+                simulator.simulate(rng_seed = i, **kwargs)
+            return n
+        return params, run, None
+    return setup
+
+def ctmc_scenario(n_states, n_draws):
+    def setup(scale):
+        n = max(1, int(n_draws * scale))
+        m = get_many_state_model(n_states).ctmc
+        def run():
+            rng = random.Random(1)
+            draw_transition = m.draw_transition
+            state = 0
+            for i in range(n):
+                state = draw_transition(state, rng)
+            return n
+        return {"n_states": n_states, "n_draws": n}, run, None
+    return setup
+
+def prune_scenario(n_trees, max_extant_leaves):
+    def setup(scale):
+        n = max(1, int(n_trees * scale))
+        # Death rates close to birth rates leave many extinct leaves to prune
+        results = sim_trees(
+            get_base_model(death_rates = [0.9, 0.9]),
+            n = n,
+            keep_extinct_trees = False,
+            max_extant_leaves = max_extant_leaves,
+        )
+        n_extinct = sum(r.number_of_extinct_leaves for r in results)
+        originals = [r.tree for r in results]
+        trees = []
+        # Pruning caches the number of extant leaves below each node, so each
+        # run prunes fresh copies of the (uncached) simulated trees
+        def reset():
+            trees[:] = [copy.deepcopy(t) for t in originals]
+        def run():
+            for tree in trees:
+                tree.prune_extinct_leaves()
+            return n
+        return {
+            "n_trees": n,
+            "max_extant_leaves": max_extant_leaves,
+            "mean_extinct_leaves": n_extinct / n,
+        }, run, reset
+    return setup
+
+def newick_scenario(n_trees, max_extant_leaves):
+    def setup(scale):
+        n = max(1, int(n_trees * scale))
+        trees = [r.tree for r in sim_trees(get_base_model(), n = n,
+                max_extant_leaves = max_extant_leaves)]
+        def run():
+            for tree in trees:
+                tree.as_newick_string()
+            return n
+        return {"n_trees": n, "max_extant_leaves": max_extant_leaves}, run, None
+    return setup
+
+def sdsd_config_scenario(n_trees):
+    def setup(scale):
+        n = max(1, int(n_trees * scale))
+        cfg = sim_SDSD_trees.parse_config(SDSD_CONFIG_PATH)
+        sdsd_model = model.SDSDModel(**cfg["model"])
+        settings = cfg["settings"]
+        def run():
+            for tree in model.sim_SDSD_trees(
+                    n = n,
+                    sdsd_model = sdsd_model,
+                    rng_seed = 1,
+                    root_state = settings["fix_root_state_to"],
+                    keep_extinct_trees = settings["keep_extinct_trees"],
+                    max_leaves_strict = settings["max_leaves_strict"],
+                    **settings["stopping_conditions"]):
+                pass
+            return n
+        return {"config": "phytools-resources/sdsd-config.yml",
+                "n_trees": n}, run, None
+    return setup
+
+def cli_scenario(n_trees, output_format = "yaml", jobs = 1):
+    def setup(scale):
+        n = max(1, int(n_trees * scale))
+        def run():
+            argv = sys.argv
+            stderr = sys.stderr
+            with tempfile.TemporaryDirectory(
+                    prefix = "sdsdsim-benchmark-") as out_dir:
+                sys.argv = ["sim-SDSD-trees", "-n", str(n), "-s", "1",
+                        "-j", str(jobs), "-f", output_format,
+                        "-o", os.path.join(out_dir, "trees.out"),
+                        SDSD_CONFIG_PATH]
+                # Silence the messages about discarded trees
+                sys.stderr = io.StringIO()
+                try:
+                    sim_SDSD_trees.main()
+                finally:
+                    sys.argv = argv
+                    sys.stderr = stderr
+            return n
+        return {"config": "phytools-resources/sdsd-config.yml",
+                "n_trees": n, "output_format": output_format,
+                "jobs": jobs}, run, None
+    return setup
+
+SCENARIOS = {
+    "sim_small_trees": sim_scenario(get_base_model(), 2000,
+        max_extant_leaves = 20),
+    "sim_large_trees": sim_scenario(get_base_model(), 20,
+        max_extant_leaves = 2000),
+    "sim_burst_heavy": sim_scenario(
+        get_base_model(burst_rate = 3.0, burst_probs = [0.5, 0.9]), 100,
+        max_extant_leaves = 500),
+    "sim_transition_heavy": sim_scenario(
+        get_base_model(q = [[-20.0, 20.0], [20.0, -20.0]]), 100,
+        max_extant_leaves = 500),
+    "sim_many_states": sim_scenario(get_many_state_model(20), 100,
+        max_extant_leaves = 500),
+    "sim_near_critical": sim_scenario(
+        get_base_model(death_rates = [0.95, 0.95]), 1000,
+        max_extant_leaves = 100),
+    "ctmc_draw_transition_2_states": ctmc_scenario(2, 200000),
+    "ctmc_draw_transition_50_states": ctmc_scenario(50, 200000),
+    "prune_extinction_heavy": prune_scenario(50, 200),
+    "newick_large_trees": newick_scenario(20, 2000),
+    "sdsd_config": sdsd_config_scenario(20),
+    "cli_sdsd_config_yaml": cli_scenario(20),
+    "cli_sdsd_config_archive": cli_scenario(20, output_format = "archive"),
+}
+
+def run_scenario(name, setup, scale = 1.0, repeats = 3):
+    params, run, reset = setup(scale)
+    times = []
+    for i in range(repeats):
+        if reset:
+            reset()
+        start_time = time.perf_counter()
+        n_items = run()
+        times.append(time.perf_counter() - start_time)
+    if reset:
+        reset()
+    tracemalloc.start()
+    try:
+        run()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    best = min(times)
+    return {
+        "name": name,
+        "params": params,
+        "repeats": repeats,
+        "times": times,
+        "min_seconds": best,
+        "median_seconds": statistics.median(times),
+        "min_seconds_per_item": best / n_items,
+        "peak_memory_bytes": peak,
+    }
+
+def get_git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd = PROJECT_DIR,
+            capture_output = True,
+            text = True,
+            check = True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def get_metadata(scale, repeats):
+    return {
+        "SDSDsim_version": sdsdsim.__version__,
+        "git_commit": get_git_commit(),
+        "python_version": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "scale": scale,
+        "repeats": repeats,
+    }
+
+def compare_results(results, baseline):
+    """
+    Get lines comparing the timings and peak memory of `results` to those of
+    `baseline` (both as written by `main`).
+    """
+    baseline = {b["name"]: b for b in baseline["benchmarks"]}
+    lines = [f"{'scenario':<32} {'time':>10} {'ratio':>7} "
+             f"{'peak MB':>9} {'ratio':>7}"]
+    for r in results["benchmarks"]:
+        b = baseline.get(r["name"])
+        peak_mb = r["peak_memory_bytes"] / 1e6
+        if (b is None) or (b["params"] != r["params"]):
+            lines.append(f"{r['name']:<32} {r['min_seconds']:>9.3f}s "
+                         f"{'-':>7} {peak_mb:>9.2f} {'-':>7}")
+            continue
+        time_ratio = r["min_seconds"] / b["min_seconds"]
+        peak_ratio = r["peak_memory_bytes"] / max(b["peak_memory_bytes"], 1)
+        lines.append(f"{r['name']:<32} {r['min_seconds']:>9.3f}s "
+                     f"{time_ratio:>7.2f} {peak_mb:>9.2f} {peak_ratio:>7.2f}")
+    return lines
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(
+        description = "Run the SDSDsim benchmarks.",
+    )
+    parser.add_argument(
+        '-o', '--output',
+        action = 'store',
+        type = str,
+        help = ('Path to which to write the results as JSON. By default, '
+                'they are written to standard output.'),
+    )
+    parser.add_argument(
+        '-k', '--keyword',
+        action = 'append',
+        default = [],
+        help = ('Only run the scenarios with names containing this string. '
+                'Can be given more than once.'),
+    )
+    parser.add_argument(
+        '-r', '--repeats',
+        action = 'store',
+        default = 3,
+        type = sdsdsim.argparse_utils.arg_is_positive_int,
+        help = ('Number of timed runs of each scenario.'),
+    )
+    parser.add_argument(
+        '--quick',
+        action = 'store_true',
+        help = ('Shrink each scenario to a tenth of its size.'),
+    )
+    parser.add_argument(
+        '--compare',
+        action = 'store',
+        type = sdsdsim.argparse_utils.arg_is_file,
+        metavar = 'BASELINE-JSON',
+        help = ('Results of a previous run to compare to. The ratios of the '
+                'times and peak memory to those of the baseline are written '
+                'to standard error.'),
+    )
+    parser.add_argument(
+        '--list',
+        action = 'store_true',
+        help = ('List the scenarios and exit.'),
+    )
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name in SCENARIOS:
+            sys.stdout.write(f"{name}\n")
+        return
+
+    names = [
+        name for name in SCENARIOS
+        if (not args.keyword) or any(k in name for k in args.keyword)
+    ]
+    if not names:
+        sys.stderr.write("ERROR: No scenarios match the keywords\n")
+        sys.exit(1)
+
+    scale = 0.1 if args.quick else 1.0
+    results = {
+        "metadata": get_metadata(scale, args.repeats),
+        "benchmarks": [],
+    }
+    for name in names:
+        sys.stderr.write(f"Running {name}...\n")
+        result = run_scenario(name, SCENARIOS[name],
+                scale = scale,
+                repeats = args.repeats)
+        sys.stderr.write(
+            f"\t{result['min_seconds']:.3f}s (best of {args.repeats}), "
+            f"peak memory {result['peak_memory_bytes'] / 1e6:.2f} MB\n"
+        )
+        results["benchmarks"].append(result)
+
+    if args.output:
+        with open(args.output, "w") as stream:
+            json.dump(results, stream, indent = 2, sort_keys = True)
+            stream.write("\n")
+    else:
+        json.dump(results, sys.stdout, indent = 2, sort_keys = True)
+        sys.stdout.write("\n")
+
+    if args.compare:
+        with open(args.compare) as stream:
+            baseline = json.load(stream)
+        for line in compare_results(results, baseline):
+            sys.stderr.write(f"{line}\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,8 +10,13 @@ logging.getLogger(__name__).addHandler(logging.NullHandler())
 GLOBAL_RNG = random.Random()
 
 import sdsdsim.argparse_utils
+import sdsdsim.archive
+import sdsdsim.array_tree
 import sdsdsim.rng_utils
 import sdsdsim.ctmc
+import sdsdsim.lineage_pool
 import sdsdsim.math_utils
+import sdsdsim.metrics
+import sdsdsim.newick
 import sdsdsim.model
 import sdsdsim.node
@@ -0,0 +1,377 @@
+#! /usr/bin/env python
+
+"""
+A compact binary archive of trees, with random access to each tree (and each
+column of a tree) via memory-mapped I/O.
+
+An archive is laid out as follows (all integers are little endian, and every
+part starts at a multiple of 8 bytes):
+
+- A file header: the magic bytes `SDSDTREE`, the format version (uint32), 4
+  padding bytes, the number of bytes of metadata (uint64), and then the
+  metadata as UTF-8 JSON (padded to 8 bytes).
+- One record per tree: a record header (`RECORD_HEADER`) with the magic bytes
+  `TREE`, the size of the record, the number of nodes, state changes and
+  burst times, the number of bytes of labels, and the seed time (NaN if
+  None), followed by the columns of the tree (see `COLUMNS`), each padded to
+  8 bytes. The columns mirror the arrays of `ArrayTree`, plus the burst times
+  of the tree and its labels (UTF-8, separated by newlines, with None as an
+  empty string).
+- An index, written when the archive is finished: the magic bytes
+  `SDSDINDX`, the number of trees (uint64) and the offset of each record
+  (uint64), followed by the offset of the index (uint64) and the magic bytes
+  `SDSDEND\\0`.
+
+If an archive was not finished (e.g., the run writing it was interrupted),
+the offsets of the complete records are found by scanning the records from
+the start.
+"""
+
+import json
+import struct
+import numpy as np
+
+from sdsdsim.node import Node
+from sdsdsim.array_tree import ArrayTree
+
+VERSION = 1
+
+FILE_MAGIC = b"SDSDTREE"
+RECORD_MAGIC = b"TREE"
+INDEX_MAGIC = b"SDSDINDX"
+END_MAGIC = b"SDSDEND\x00"
+
+FILE_HEADER = struct.Struct("<8sI4xQ")
+# Magic, record size, and the number of nodes, state changes, burst times and
+# bytes of labels, and the seed time
+RECORD_HEADER = struct.Struct("<4s4xQQQQQd")
+INDEX_HEADER = struct.Struct("<8sQ")
+INDEX_FOOTER = struct.Struct("<Q8s")
+
+# The name, type and length (as a function of the number of nodes, state
+# changes, burst times and bytes of labels) of each column of a record, in
+# order
+COLUMNS = (
+    ("time", np.dtype("<f8"), lambda n, m, b, l: n),
+    ("state_change_times", np.dtype("<f8"), lambda n, m, b, l: m),
+    ("burst_times", np.dtype("<f8"), lambda n, m, b, l: b),
+    ("parent", np.dtype("<i4"), lambda n, m, b, l: n),
+    ("state_change_offsets", np.dtype("<i4"), lambda n, m, b, l: n + 1),
+    ("rootward_state", np.dtype("<i2"), lambda n, m, b, l: n),
+    ("state_change_states", np.dtype("<i2"), lambda n, m, b, l: m),
+    ("flags", np.dtype("u1"), lambda n, m, b, l: n),
+    ("labels", np.dtype("u1"), lambda n, m, b, l: l),
+)
+COLUMN_NAMES = tuple(name for name, dtype, get_length in COLUMNS)
+
+
+def _get_padding(nbytes):
+    return -nbytes % 8
+
+def _get_column_layout(n_nodes, n_changes, n_bursts, n_label_bytes):
+    """
+    Get a dict mapping each column name to its (offset from the start of the
+    record, dtype, length), along with the size of the record.
+    """
+    layout = {}
+    offset = RECORD_HEADER.size
+    for name, dtype, get_length in COLUMNS:
+        length = get_length(n_nodes, n_changes, n_bursts, n_label_bytes)
+        layout[name] = (offset, dtype, length)
+        nbytes = length * dtype.itemsize
+        offset += nbytes + _get_padding(nbytes)
+    return layout, offset
+
+def encode_tree(tree, burst_times = ()):
+    """
+    Get the bytes of the archive record of a tree.
+
+    Parameters
+    ----------
+    tree : `Node` or `ArrayTree` object
+        The tree (or its root `Node`).
+    burst_times : iterable of float
+        The times of the burst events of the tree.
+
+    Returns
+    -------
+    bytes
+    """
+    if isinstance(tree, Node):
+        tree = ArrayTree.from_node(tree)
+    labels = "\n".join("" if l is None else l for l in tree.labels).encode(
+            "utf-8")
+    columns = {
+        "time": tree.time,
+        "state_change_times": tree.state_change_times,
+        "burst_times": np.asarray(burst_times, dtype = np.float64),
+        "parent": tree.parent,
+        "state_change_offsets": tree.state_change_offsets,
+        "rootward_state": tree.rootward_state,
+        "state_change_states": tree.state_change_states,
+        "flags": tree.flags,
+        "labels": np.frombuffer(labels, dtype = np.uint8),
+    }
+    n_nodes = len(tree)
+    n_changes = len(tree.state_change_states)
+    n_bursts = len(columns["burst_times"])
+    layout, record_nbytes = _get_column_layout(n_nodes, n_changes, n_bursts,
+            len(labels))
+    seed_time = np.nan if tree.seed_time is None else tree.seed_time
+    pieces = [RECORD_HEADER.pack(RECORD_MAGIC, record_nbytes, n_nodes,
+            n_changes, n_bursts, len(labels), seed_time)]
+    for name, dtype, get_length in COLUMNS:
+        column = np.asarray(columns[name])
+        if (dtype.kind == "i") and (len(column) > 0) and (
+                (column.min() < np.iinfo(dtype).min) or
+                (column.max() > np.iinfo(dtype).max)):
+            raise ValueError(f"Values of {name} are too large for the archive")
+        data = column.astype(dtype).tobytes()
+        pieces.append(data)
+        pieces.append(b"\x00" * _get_padding(len(data)))
+    return b"".join(pieces)
+
+
+class TreeArchiveWriter(object):
+    """
+    Writes trees to a binary archive stream as they are added.
+
+    Parameters
+    ----------
+    stream : binary file object
+        The stream to write to (it does not need to be seekable).
+    metadata : dict
+        Metadata to store in the file header (as JSON).
+
+    The index of the archive is written by `finish` (or on leaving a `with`
+    block), after which no more trees can be added.
+    """
+
+    def __init__(self, stream, metadata = None):
+        self.stream = stream
+        self.offsets = []
+        self.finished = False
+        if metadata is None:
+            metadata = {}
+        data = json.dumps(metadata, sort_keys = True).encode("utf-8")
+        self.stream.write(FILE_HEADER.pack(FILE_MAGIC, VERSION, len(data)))
+        self.stream.write(data)
+        self.stream.write(b"\x00" * _get_padding(len(data)))
+        self.position = FILE_HEADER.size + len(data) + _get_padding(len(data))
+
+    @classmethod
+    def resume(cls, stream):
+        """
+        Get a writer that appends to the unfinished archive in `stream` (a
+        readable and writable binary stream).
+
+        The offsets of the records in the stream are found by scanning them,
+        and anything after the last complete record is discarded.
+        """
+        stream.seek(0)
+        metadata, data_offset = _read_file_header(stream.read)
+        stream.seek(0, 2)
+        offsets = _scan_records(stream, data_offset, stream.tell())
+        end = data_offset
+        if offsets:
+            stream.seek(offsets[-1])
+            header = RECORD_HEADER.unpack(stream.read(RECORD_HEADER.size))
+            end = offsets[-1] + header[1]
+        stream.seek(end)
+        stream.truncate()
+        writer = cls.__new__(cls)
+        writer.stream = stream
+        writer.offsets = offsets
+        writer.finished = False
+        writer.position = end
+        return writer
+
+    def write_record(self, record):
+        """
+        Add the bytes of a tree record (from `encode_tree`) to the archive.
+        """
+        if self.finished:
+            raise ValueError("Cannot add trees to a finished archive")
+        self.offsets.append(self.position)
+        self.stream.write(record)
+        self.position += len(record)
+
+    def write_tree(self, tree, burst_times = ()):
+        """
+        Add a tree (a `Node` or `ArrayTree` object) and the times of its burst
+        events to the archive.
+        """
+        self.write_record(encode_tree(tree, burst_times))
+
+    def finish(self):
+        """
+        Write the index of the archive.
+        """
+        if self.finished:
+            return
+        index_offset = self.position
+        self.stream.write(INDEX_HEADER.pack(INDEX_MAGIC, len(self.offsets)))
+        self.stream.write(np.asarray(self.offsets, dtype = "<u8").tobytes())
+        self.stream.write(INDEX_FOOTER.pack(index_offset, END_MAGIC))
+        self.stream.flush()
+        self.finished = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.finish()
+
+
+def _read_file_header(read):
+    header = read(FILE_HEADER.size)
+    if len(header) < FILE_HEADER.size:
+        raise ValueError("Tree archive is too short")
+    magic, version, n_metadata_bytes = FILE_HEADER.unpack(header)
+    if magic != FILE_MAGIC:
+        raise ValueError("Not a tree archive")
+    if version != VERSION:
+        raise ValueError(f"Unsupported tree archive version: {version}")
+    metadata = json.loads(read(n_metadata_bytes).decode("utf-8"))
+    data_offset = (FILE_HEADER.size + n_metadata_bytes +
+            _get_padding(n_metadata_bytes))
+    return metadata, data_offset
+
+def _scan_records(stream, start, end):
+    # Get the offsets of the complete records from `start`, stopping at the
+    # index, a partial record or `end`
+    offsets = []
+    offset = start
+    while offset + RECORD_HEADER.size <= end:
+        stream.seek(offset)
+        header = RECORD_HEADER.unpack(stream.read(RECORD_HEADER.size))
+        if (header[0] != RECORD_MAGIC) or (offset + header[1] > end):
+            break
+        offsets.append(offset)
+        offset += header[1]
+    return offsets
+
+
+class TreeArchiveReader(object):
+    """
+    Reads trees from a binary archive file.
+
+    The file is memory mapped, so only the parts of the file that are used are
+    read. `get_column` returns a (read-only) view of a single column of a
+    tree, without reading the rest of the tree.
+
+    Parameters
+    ----------
+    path : str
+        The path to the archive.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as stream:
+            self.metadata, data_offset = _read_file_header(stream.read)
+            stream.seek(0, 2)
+            size = stream.tell()
+            offsets = None
+            if size >= data_offset + INDEX_HEADER.size + INDEX_FOOTER.size:
+                stream.seek(size - INDEX_FOOTER.size)
+                index_offset, magic = INDEX_FOOTER.unpack(
+                        stream.read(INDEX_FOOTER.size))
+                if magic == END_MAGIC:
+                    stream.seek(index_offset)
+                    magic, n = INDEX_HEADER.unpack(
+                            stream.read(INDEX_HEADER.size))
+                    if magic != INDEX_MAGIC:
+                        raise ValueError("Tree archive has a corrupt index")
+                    offsets = np.frombuffer(stream.read(8 * n),
+                            dtype = "<u8").astype(np.int64)
+            if offsets is None:
+                # The archive was not finished
+                offsets = np.array(_scan_records(stream, data_offset, size),
+                        dtype = np.int64)
+        self.offsets = offsets
+        self._data = np.memmap(path, dtype = np.uint8, mode = "r")
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _get_record_header(self, index):
+        offset = int(self.offsets[index])
+        header = RECORD_HEADER.unpack_from(self._data, offset)
+        if header[0] != RECORD_MAGIC:
+            raise ValueError(f"Corrupt record for tree {index}")
+        return offset, header
+
+    def _get_columns(self, index, names):
+        offset, (magic, record_nbytes, n_nodes, n_changes, n_bursts,
+                n_label_bytes, seed_time) = self._get_record_header(index)
+        layout, nbytes = _get_column_layout(n_nodes, n_changes, n_bursts,
+                n_label_bytes)
+        columns = {}
+        for name in names:
+            column_offset, dtype, length = layout[name]
+            start = offset + column_offset
+            end = start + (length * dtype.itemsize)
+            columns[name] = self._data[start:end].view(dtype)
+        return columns, seed_time
+
+    def get_column(self, index, name):
+        """
+        Get a (memory-mapped) array of one column of tree `index`.
+
+        `name` is one of `COLUMN_NAMES`.
+        """
+        if name not in COLUMN_NAMES:
+            raise ValueError(f"Unknown tree archive column: {name!r}")
+        return self._get_columns(index, (name,))[0][name]
+
+    def get_burst_times(self, index):
+        """
+        Get an array of the times of the burst events of tree `index`.
+        """
+        return self.get_column(index, "burst_times")
+
+    def get_tree(self, index):
+        """
+        Get tree `index` as an `ArrayTree` object.
+        """
+        columns, seed_time = self._get_columns(index, COLUMN_NAMES)
+        parent = columns["parent"]
+        n = len(parent)
+        # Nodes are in pre-order, so the children of each node are in order
+        # of their index
+        children = np.argsort(parent[1:], kind = "stable") + 1
+        child_offsets = np.zeros(n + 1, dtype = np.int64)
+        np.cumsum(np.bincount(parent[1:], minlength = n),
+                out = child_offsets[1:])
+        labels = [l if l else None for l in
+                columns["labels"].tobytes().decode("utf-8").split("\n")]
+        return ArrayTree(
+            parent = parent,
+            child_offsets = child_offsets,
+            children = children,
+            time = columns["time"],
+            rootward_state = columns["rootward_state"],
+            flags = columns["flags"],
+            state_change_offsets = columns["state_change_offsets"],
+            state_change_states = columns["state_change_states"],
+            state_change_times = columns["state_change_times"],
+            labels = labels,
+            seed_time = None if np.isnan(seed_time) else seed_time,
+        )
+
+    def __getitem__(self, index):
+        return self.get_tree(index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.get_tree(i)
+
+    def close(self):
+        self._data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -20,3 +20,12 @@ def arg_is_positive_int(i):
         msg = '{0!r} is not a positive integer'.format(i)
         raise argparse.ArgumentTypeError(msg)
     return int(i)
+
+def arg_is_positive_float(x):
+    try:
+        if float(x) <= 0.0:
+            raise
+    except:
+        msg = '{0!r} is not a positive number'.format(x)
+        raise argparse.ArgumentTypeError(msg)
+    return float(x)
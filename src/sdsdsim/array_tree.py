@@ -0,0 +1,366 @@
+#! /usr/bin/env python
+
+from array import array
+
+import numpy as np
+
+from sdsdsim.node import Node
+
+
+class ArrayTree(object):
+    """
+    A tree stored as a struct of NumPy arrays, rather than as linked `Node`
+    objects.
+
+    Nodes are indexed in pre-order, so the root is node 0 and every node comes
+    before its descendants. For node `i`:
+
+    - `parent[i]` is the index of its parent (-1 for the root)
+    - `children[child_offsets[i]:child_offsets[i + 1]]` are the indices of its
+      children, in order
+    - `time[i]` is its time (NaN if not set)
+    - `rootward_state[i]` is its rootward state (-1 if not set)
+    - `flags[i]` holds the `EXTINCT` and `BURST` bits
+    - `state_change_states[state_change_offsets[i]:state_change_offsets[i + 1]]`
+      are the states it transitioned to along its branch, at the
+      corresponding `state_change_times`. The state each transition is from is
+      the state before it, starting from `rootward_state[i]`.
+    - `labels[i]` is its label (a list of str or None, rather than an array)
+
+    `seed_time` is the time at which the root branch starts (None if not
+    set).
+    """
+    EXTINCT = 1
+    BURST = 2
+
+    def __init__(
+        self,
+        parent,
+        child_offsets,
+        children,
+        time,
+        rootward_state,
+        flags,
+        state_change_offsets,
+        state_change_states,
+        state_change_times,
+        labels = None,
+        seed_time = None,
+    ):
+        self.parent = np.asarray(parent, dtype = np.int64)
+        self.child_offsets = np.asarray(child_offsets, dtype = np.int64)
+        self.children = np.asarray(children, dtype = np.int64)
+        self.time = np.asarray(time, dtype = np.float64)
+        self.rootward_state = np.asarray(rootward_state, dtype = np.int64)
+        self.flags = np.asarray(flags, dtype = np.uint8)
+        self.state_change_offsets = np.asarray(state_change_offsets,
+                dtype = np.int64)
+        self.state_change_states = np.asarray(state_change_states,
+                dtype = np.int64)
+        self.state_change_times = np.asarray(state_change_times,
+                dtype = np.float64)
+        n = len(self.parent)
+        if labels is None:
+            labels = [None] * n
+        self.labels = list(labels)
+        self.seed_time = seed_time
+        for name in ("time", "rootward_state", "flags", "labels"):
+            if len(getattr(self, name)) != n:
+                raise ValueError(f"Expecting {n} {name}; found "
+                        f"{len(getattr(self, name))}")
+        for name in ("child_offsets", "state_change_offsets"):
+            if len(getattr(self, name)) != n + 1:
+                raise ValueError(f"Expecting {n + 1} {name}; found "
+                        f"{len(getattr(self, name))}")
+        if len(self.state_change_states) != len(self.state_change_times):
+            raise ValueError("Number of state-change states and times differ")
+
+    @classmethod
+    def from_node(cls, root):
+        """
+        Get an `ArrayTree` of the tree descending from (and including) the
+        `Node` object `root`.
+        """
+        nodes = list(root.leafward_iter())
+        index = {node: i for i, node in enumerate(nodes)}
+        n = len(nodes)
+        parent = np.full(n, -1, dtype = np.int64)
+        child_offsets = np.zeros(n + 1, dtype = np.int64)
+        children = []
+        time = np.empty(n, dtype = np.float64)
+        rootward_state = np.empty(n, dtype = np.int64)
+        flags = np.zeros(n, dtype = np.uint8)
+        state_change_offsets = np.zeros(n + 1, dtype = np.int64)
+        state_change_states = []
+        state_change_times = []
+        labels = []
+        for i, node in enumerate(nodes):
+            for child in node.children:
+                c = index[child]
+                parent[c] = i
+                children.append(c)
+            child_offsets[i + 1] = len(children)
+            time[i] = np.nan if node.time is None else node.time
+            rootward_state[i] = (-1 if node.rootward_state is None
+                    else node.rootward_state)
+            if node.is_extinct:
+                flags[i] |= cls.EXTINCT
+            if node.is_burst_node:
+                flags[i] |= cls.BURST
+            state_change_states.extend(to for fr, to in node.state_changes)
+            state_change_times.extend(node.state_change_times)
+            state_change_offsets[i + 1] = len(state_change_states)
+            labels.append(node.label)
+        if root.is_root:
+            seed_time = root.seed_time
+        else:
+            seed_time = root.parent.time
+        return cls(
+            parent = parent,
+            child_offsets = child_offsets,
+            children = children,
+            time = time,
+            rootward_state = rootward_state,
+            flags = flags,
+            state_change_offsets = state_change_offsets,
+            state_change_states = state_change_states,
+            state_change_times = state_change_times,
+            labels = labels,
+            seed_time = seed_time,
+        )
+
+    def to_node(self):
+        """
+        Get the `Node` object at the root of a linked copy of this tree.
+        """
+        nodes = []
+        for i in range(len(self)):
+            t = float(self.time[i])
+            s = int(self.rootward_state[i])
+            node = Node(
+                label = self.labels[i],
+                time = None if np.isnan(t) else t,
+                rootward_state = None if s < 0 else s,
+            )
+            node.is_extinct = bool(self.flags[i] & self.EXTINCT)
+            node.is_burst_node = bool(self.flags[i] & self.BURST)
+            start = self.state_change_offsets[i]
+            end = self.state_change_offsets[i + 1]
+            for j in range(start, end):
+                node.transition_state(
+                    int(self.state_change_states[j]),
+                    float(self.state_change_times[j]),
+                )
+            nodes.append(node)
+        for i, node in enumerate(nodes):
+            start = self.child_offsets[i]
+            end = self.child_offsets[i + 1]
+            for c in self.children[start:end]:
+                node.add_child(nodes[c])
+        root = nodes[0]
+        root.seed_time = self.seed_time
+        return root
+
+    def __len__(self):
+        return len(self.parent)
+
+    def _get_n_nodes(self):
+        return len(self.parent)
+
+    number_of_nodes = property(_get_n_nodes)
+
+    def _get_is_leaf(self):
+        return self.child_offsets[1:] == self.child_offsets[:-1]
+
+    is_leaf = property(_get_is_leaf)
+
+    def _get_is_extinct(self):
+        return (self.flags & self.EXTINCT).astype(bool)
+
+    is_extinct = property(_get_is_extinct)
+
+    def _get_is_burst_node(self):
+        return (self.flags & self.BURST).astype(bool)
+
+    is_burst_node = property(_get_is_burst_node)
+
+    def _get_n_leaves(self):
+        return int(np.count_nonzero(self.is_leaf))
+
+    number_of_leaves = property(_get_n_leaves)
+
+    def _get_n_extant_leaves(self):
+        return int(np.count_nonzero(self.is_leaf & (~self.is_extinct)))
+
+    number_of_extant_leaves = property(_get_n_extant_leaves)
+
+    def _get_n_extinct_leaves(self):
+        return int(np.count_nonzero(self.is_leaf & self.is_extinct))
+
+    number_of_extinct_leaves = property(_get_n_extinct_leaves)
+
+    def _get_branch_lengths(self):
+        lengths = np.empty(len(self), dtype = np.float64)
+        lengths[1:] = self.time[1:] - self.time[self.parent[1:]]
+        if self.seed_time is None:
+            lengths[0] = 0.0
+        else:
+            lengths[0] = self.time[0] - self.seed_time
+        return lengths
+
+    branch_lengths = property(_get_branch_lengths)
+
+    def _get_tree_length(self):
+        return float(self.branch_lengths[1:].sum())
+
+    tree_length = property(_get_tree_length)
+
+    def _get_max_time(self):
+        return float(self.time[self.is_leaf].max())
+
+    max_time = property(_get_max_time)
+
+    def _get_height(self):
+        return self.max_time - float(self.time[0])
+
+    height = property(_get_height)
+
+    def _get_nbytes(self):
+        """
+        The number of bytes used by the arrays (not including the labels).
+        """
+        return sum(getattr(self, name).nbytes for name in (
+            "parent",
+            "child_offsets",
+            "children",
+            "time",
+            "rootward_state",
+            "flags",
+            "state_change_offsets",
+            "state_change_states",
+            "state_change_times",
+        ))
+
+    nbytes = property(_get_nbytes)
+
+
+class ArrayTreeBuilder(object):
+    """
+    Grows the columns of an `ArrayTree` one node at a time, as a tree is
+    simulated, without creating a `Node` object for each node.
+
+    Nodes are referred to by their index (in the order they are added, so a
+    parent always comes before its children), which is a lightweight handle
+    for the lineages of a simulation. The columns are kept in compact
+    `array.array` objects, and state changes in a single table in the order
+    they happen. `finish` reorders the nodes (and their state changes) to
+    pre-order and labels the leaves, giving the same tree as
+    `ArrayTree.from_node` of the equivalent simulated `Node` tree.
+
+    >>> builder = ArrayTreeBuilder()
+    >>> root = builder.add_node(-1, 0)
+    >>> builder.time[root] = 1.0
+    >>> children = [builder.add_node(root, 0) for i in range(2)]
+    >>> builder.add_state_change(children[0], 1, 1.5)
+    >>> tree = builder.finish(end_time = 2.0)
+    >>> tree.labels, tree.state_change_states.tolist()
+    (['root', 'L1', 'L2'], [1])
+    """
+    def __init__(self, seed_time = 0.0):
+        self.seed_time = seed_time
+        self.parent = array("q")
+        self.time = array("d")
+        self.rootward_state = array("q")
+        self.flags = bytearray()
+        self.state_change_nodes = array("q")
+        self.state_change_states = array("q")
+        self.state_change_times = array("d")
+
+    def __len__(self):
+        return len(self.parent)
+
+    def add_node(self, parent, rootward_state):
+        """
+        Add a node (with no time yet) as the last child of the node with
+        index `parent` (-1 for the root), and return its index.
+        """
+        self.parent.append(parent)
+        self.time.append(np.nan)
+        self.rootward_state.append(rootward_state)
+        self.flags.append(0)
+        return len(self.parent) - 1
+
+    def add_state_change(self, node, state, time):
+        self.state_change_nodes.append(node)
+        self.state_change_states.append(state)
+        self.state_change_times.append(time)
+
+    def finish(self, end_time):
+        """
+        Get the `ArrayTree`, with `end_time` as the time of the nodes whose
+        time is not set (the extant leaves).
+        """
+        n = len(self.parent)
+        parent = np.frombuffer(self.parent, dtype = np.int64)
+        time = np.frombuffer(self.time, dtype = np.float64).copy()
+        time[np.isnan(time)] = end_time
+        # Children are grouped by parent, keeping the order they were added
+        child_order = np.argsort(parent[1:], kind = "stable") + 1
+        n_children = np.bincount(parent[1:], minlength = n)
+        child_offsets = np.zeros(n + 1, dtype = np.int64)
+        np.cumsum(n_children, out = child_offsets[1:])
+        # Pre-order, by a depth-first pass with an explicit stack
+        children = child_order.tolist()
+        offsets = child_offsets.tolist()
+        order = []
+        stack = [0]
+        while stack:
+            i = stack.pop()
+            order.append(i)
+            stack.extend(reversed(children[offsets[i]:offsets[i + 1]]))
+        order = np.array(order, dtype = np.int64)
+        new_index = np.empty(n, dtype = np.int64)
+        new_index[order] = np.arange(n)
+
+        new_parent = np.full(n, -1, dtype = np.int64)
+        new_parent[1:] = new_index[parent[order[1:]]]
+        new_n_children = n_children[order]
+        new_child_offsets = np.zeros(n + 1, dtype = np.int64)
+        np.cumsum(new_n_children, out = new_child_offsets[1:])
+        new_children = np.argsort(new_parent[1:], kind = "stable") + 1
+        flags = np.frombuffer(self.flags, dtype = np.uint8)[order]
+
+        change_nodes = new_index[np.frombuffer(self.state_change_nodes,
+                dtype = np.int64)]
+        change_order = np.argsort(change_nodes, kind = "stable")
+        state_change_offsets = np.zeros(n + 1, dtype = np.int64)
+        np.cumsum(np.bincount(change_nodes, minlength = n),
+                out = state_change_offsets[1:])
+
+        labels = [None] * n
+        labels[0] = "root"
+        n_extant = 0
+        n_extinct = 0
+        for i in np.flatnonzero(new_n_children == 0).tolist():
+            if flags[i] & ArrayTree.EXTINCT:
+                n_extinct += 1
+                labels[i] = f"XL{n_extinct}"
+            else:
+                n_extant += 1
+                labels[i] = f"L{n_extant}"
+        return ArrayTree(
+            parent = new_parent,
+            child_offsets = new_child_offsets,
+            children = new_children,
+            time = time[order],
+            rootward_state = np.frombuffer(self.rootward_state,
+                dtype = np.int64)[order],
+            flags = flags,
+            state_change_offsets = state_change_offsets,
+            state_change_states = np.frombuffer(self.state_change_states,
+                dtype = np.int64)[change_order],
+            state_change_times = np.frombuffer(self.state_change_times,
+                dtype = np.float64)[change_order],
+            labels = labels,
+            seed_time = self.seed_time,
+        )
@@ -2,8 +2,14 @@
 
 import os
 import sys
+import time
 import random
+import json
+import hashlib
 import argparse
+import itertools
+import collections
+import multiprocessing
 import yaml
 
 import sdsdsim
@@ -67,6 +73,15 @@ def parse_settings(settings_config):
     settings['stopping_conditions'] = parse_stopping_conditions(
         stopping_conditions)
     settings['fix_root_state_to'] = settings_config.get('fix_root_state_to', None)
+    settings['rng_backend'] = settings_config.get('rng_backend', 'python')
+    settings['condition_on_survival'] = settings_config.get(
+        'condition_on_survival', False)
+    if settings['rng_backend'] not in sdsdsim.rng_utils.RNG_BACKENDS:
+        sys.stderr.write(
+            f"ERROR: Unrecognized rng_backend '{settings['rng_backend']}'; "
+            f"expecting one of {sdsdsim.rng_utils.RNG_BACKENDS}\n"
+        )
+        sys.exit(1)
     for k in settings_config.keys():
         if k not in settings:
             sys.stderr.write(f"ERROR: Unrecognized settings field '{k}'\n")
@@ -80,6 +95,233 @@ def parse_config(path):
     cfg['settings'] = settings
     return cfg
 
+# State of the simulation in each (worker) process; see `init_worker`
+_WORKER = {}
+
+def init_worker(cfg, seed, get_sample):
+    _WORKER['cfg'] = cfg
+    _WORKER['seed'] = seed
+    _WORKER['get_sample'] = get_sample
+    _WORKER['simulator'] = sdsdsim.model.SDSDTreeSimulator(
+        sdsdsim.model.SDSDModel(**cfg['model']),
+        rng_backend = cfg['settings']['rng_backend'],
+    )
+
+def get_sample(tree, burst_times):
+    burst_times_with_nodes = set()
+    for node in tree.internal_leafward_iter():
+        if node.is_burst_node:
+            burst_times_with_nodes.add(node.time)
+    burst_times_with_nodes = sorted(burst_times_with_nodes)
+    return {
+        'tree': tree.as_newick_string(),
+        'burst_times': [float(t) for t in burst_times],
+        'burst_times_with_nodes': [float(t) for t in burst_times_with_nodes],
+    }
+
+def get_archive_sample(tree, burst_times):
+    return sdsdsim.archive.encode_tree(tree, burst_times)
+
+def sim_sample(replicate_index):
+    """
+    Simulate a replicate in this (worker) process.
+
+    Returns
+    -------
+    tuple
+        The reason the replicate was rejected (or None), the number of leaves
+        relevant to a strict-leaf rejection (or None), the sample (or None
+        if rejected), the number of events simulated, and the seconds spent
+        in each stage (see `sdsdsim.metrics.SimulationMetrics`).
+    """
+    settings = _WORKER['cfg']['settings']
+    stopping_conditions = settings['stopping_conditions']
+    start_time = time.perf_counter()
+    result = sdsdsim.model.sim_SDSD_replicate(
+        simulator = _WORKER['simulator'],
+        seed = _WORKER['seed'],
+        replicate_index = replicate_index,
+        root_state = settings['fix_root_state_to'],
+        keep_extinct_trees = settings['keep_extinct_trees'],
+        max_leaves_strict = settings['max_leaves_strict'],
+        condition_on_survival = settings['condition_on_survival'],
+        **stopping_conditions
+    )
+    end_time = time.perf_counter()
+    stage_times = {'simulation': end_time - start_time}
+    if result.rejection is not None:
+        n_leaves = None
+        if result.rejection == sdsdsim.model.REJECTED_MAX_TOTAL_LEAVES:
+            n_leaves = result.number_of_leaves
+        elif result.rejection == sdsdsim.model.REJECTED_MAX_EXTANT_LEAVES:
+            n_leaves = result.number_of_extant_leaves
+        elif result.rejection == sdsdsim.model.REJECTED_MAX_EXTINCT_LEAVES:
+            n_leaves = result.number_of_extinct_leaves
+        return (result.rejection, n_leaves, None, result.number_of_events,
+                stage_times)
+    tree = result.tree
+    if settings['prune_extinct_leaves']:
+        start_time = end_time
+        tree = tree.prune_extinct_leaves()
+        end_time = time.perf_counter()
+        stage_times['pruning'] = end_time - start_time
+    start_time = end_time
+    sample = _WORKER['get_sample'](tree, result.burst_times)
+    if settings['condition_on_survival']:
+        sample['log_weight'] = result.log_weight
+    stage_times['serialization'] = time.perf_counter() - start_time
+    return None, None, sample, result.number_of_events, stage_times
+
+def iter_replicates(cfg, seed, jobs = 1, start_index = 0,
+        get_sample = get_sample):
+    """
+    Simulate replicates (via `sim_sample`) in order of their index, starting
+    from `start_index`, across `jobs` processes.
+
+    Each replicate is seeded from `seed` and its index, so the results do not
+    depend on the number of processes. Accepted trees are converted to samples
+    by `get_sample` in the worker processes.
+    """
+    if jobs < 2:
+        init_worker(cfg, seed, get_sample)
+        for i in itertools.count(start_index):
+            yield sim_sample(i)
+        return
+    with multiprocessing.Pool(
+            processes = jobs,
+            initializer = init_worker,
+            initargs = (cfg, seed, get_sample)) as pool:
+        # Keep a bounded queue of pending replicates, so all the workers stay
+        # busy while results are consumed in order
+        pending = collections.deque()
+        replicate_indices = itertools.count(start_index)
+        while True:
+            while len(pending) < (jobs * 4):
+                pending.append(
+                    pool.apply_async(sim_sample, (next(replicate_indices),))
+                )
+            yield pending.popleft().get()
+
+class SampleWriter(object):
+    """
+    Base class of the writers of samples.
+
+    `get_sample` converts a tree and its burst times to a sample (in a worker
+    process), and `binary` is whether the output stream is binary.
+    """
+    binary = False
+    get_sample = staticmethod(get_sample)
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    @classmethod
+    def resume(cls, stream):
+        """
+        Get a writer that appends samples to the output of an interrupted run
+        in `stream`, which has been truncated to the last checkpoint.
+        """
+        return cls(stream)
+
+    def finish(self):
+        pass
+
+
+class YamlSampleWriter(SampleWriter):
+    """
+    Writes the header and then each sample to a stream as soon as it is
+    simulated, as one YAML document with the samples listed under 'trees'.
+
+    The output is identical to dumping the header with the list of samples
+    under 'trees' in a single call to `yaml.dump`.
+    """
+    def write_header(self, header):
+        assert 'trees' not in header
+        # 'trees' sorts after all the header keys, so it can go last
+        assert all(k < 'trees' for k in header)
+        yaml.dump(header, stream = self.stream, default_flow_style = False)
+        self.stream.write("trees:\n")
+        self.stream.flush()
+
+    def write_sample(self, sample):
+        yaml.dump([sample], stream = self.stream, default_flow_style = False)
+        self.stream.flush()
+
+
+class JsonLinesSampleWriter(SampleWriter):
+    """
+    Writes the header and then each sample to a stream as soon as it is
+    simulated, as one JSON object per line.
+    """
+    def write_header(self, header):
+        self.write_sample(header)
+
+    def write_sample(self, sample):
+        self.stream.write(json.dumps(sample, sort_keys = True))
+        self.stream.write("\n")
+        self.stream.flush()
+
+
+class ArchiveSampleWriter(SampleWriter):
+    """
+    Writes the header and then each tree to a binary tree archive (see
+    `sdsdsim.archive`) as soon as it is simulated. The index of the archive is
+    written when the run finishes.
+    """
+    binary = True
+    get_sample = staticmethod(get_archive_sample)
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.archive_writer = None
+
+    @classmethod
+    def resume(cls, stream):
+        writer = cls(stream)
+        writer.archive_writer = sdsdsim.archive.TreeArchiveWriter.resume(
+                stream)
+        return writer
+
+    def write_header(self, header):
+        self.archive_writer = sdsdsim.archive.TreeArchiveWriter(self.stream,
+                metadata = header)
+        self.stream.flush()
+
+    def write_sample(self, sample):
+        self.archive_writer.write_record(sample)
+        self.stream.flush()
+
+    def finish(self):
+        self.archive_writer.finish()
+
+
+SAMPLE_WRITERS = {
+    'yaml': YamlSampleWriter,
+    'jsonl': JsonLinesSampleWriter,
+    'archive': ArchiveSampleWriter,
+}
+
+def get_header_digest(header):
+    return hashlib.sha256(
+        json.dumps(header, sort_keys = True).encode("utf-8")
+    ).hexdigest()
+
+def read_checkpoint(path):
+    try:
+        with open(path, "r") as stream:
+            return json.load(stream)
+    except (OSError, ValueError) as e:
+        sys.stderr.write(f"ERROR: Could not read checkpoint '{path}': {e}\n")
+        sys.exit(1)
+
+def write_checkpoint(path, checkpoint):
+    # Write to a temporary file first, so an interruption never leaves a
+    # partially written checkpoint behind
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as stream:
+        json.dump(checkpoint, stream, sort_keys = True)
+    os.replace(tmp_path, path)
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -101,12 +343,102 @@ def main():
         type = sdsdsim.argparse_utils.arg_is_positive_int,
         help = ('Seed for random number generator.'),
     )
+    parser.add_argument(
+        '-j', '--jobs',
+        action = 'store',
+        default = 1,
+        type = sdsdsim.argparse_utils.arg_is_positive_int,
+        help = ('Number of processes to simulate trees across. The output '
+                'does not depend on the number of processes.'),
+    )
+    parser.add_argument(
+        '-o', '--output',
+        action = 'store',
+        type = str,
+        help = ('Path to output file. By default, output is written to '
+                'standard output.'),
+    )
+    parser.add_argument(
+        '-f', '--output-format',
+        action = 'store',
+        default = 'yaml',
+        choices = sorted(SAMPLE_WRITERS),
+        help = ('Format of output. With \'yaml\' (the default), the output '
+                'is a single YAML document with the trees listed under '
+                '\'trees\'. With \'jsonl\', the header (seed, model and '
+                'settings) is the first line and each tree is on its own line '
+                'as a JSON object. With \'archive\', the output is a binary '
+                'tree archive (see sdsdsim.archive) holding the node times, '
+                'topology, states, flags and burst times of each tree, that '
+                'can be read by sdsdsim.archive.TreeArchiveReader. Either '
+                'way, each tree is written as soon as it is simulated.'),
+    )
+    parser.add_argument(
+        '--checkpoint-interval',
+        action = 'store',
+        default = 100,
+        type = sdsdsim.argparse_utils.arg_is_positive_int,
+        help = ('When writing to a file (--output), save a checkpoint to '
+                '\'<OUTPUT>.checkpoint\' after every this many trees.'),
+    )
+    parser.add_argument(
+        '--resume',
+        action = 'store_true',
+        help = ('Resume an interrupted run from the checkpoint of its '
+                '--output file, appending only the missing trees. The output '
+                'is identical to that of an uninterrupted run. The config, '
+                'seed and output format must match those of the interrupted '
+                'run.'),
+    )
+    parser.add_argument(
+        '--progress-interval',
+        action = 'store',
+        type = sdsdsim.argparse_utils.arg_is_positive_float,
+        metavar = 'SECONDS',
+        help = ('Write a progress line (replicates attempted, accepted and '
+                'rejected for each reason, events simulated and throughput) '
+                'to standard error every this many seconds, and once more at '
+                'the end. By default, no progress is reported.'),
+    )
+    parser.add_argument(
+        '--metrics-output',
+        action = 'store',
+        type = str,
+        metavar = 'PATH',
+        help = ('Path to which to write a JSON summary of the run: the counts '
+                'of attempted, accepted and rejected replicates, the number '
+                'of events simulated, throughput, and the time spent '
+                'simulating, pruning and serializing trees (summed across '
+                'processes). When resuming, only the resumed part of the run '
+                'is counted.'),
+    )
     args = parser.parse_args()
 
-    rng = random.Random()
+    checkpoint = None
+    checkpoint_path = None
+    if args.output:
+        checkpoint_path = args.output + ".checkpoint"
+    if args.resume:
+        if not args.output:
+            sys.stderr.write("ERROR: --resume requires --output\n")
+            sys.exit(1)
+        checkpoint = read_checkpoint(checkpoint_path)
+        if args.seed and (args.seed != checkpoint['seed']):
+            sys.stderr.write(
+                f"ERROR: Seed {args.seed} does not match the seed of the "
+                f"checkpoint ({checkpoint['seed']})\n"
+            )
+            sys.exit(1)
+        args.seed = checkpoint['seed']
+        if args.output_format != checkpoint['output_format']:
+            sys.stderr.write(
+                f"ERROR: Output format '{args.output_format}' does not match "
+                f"that of the checkpoint ('{checkpoint['output_format']}')\n"
+            )
+            sys.exit(1)
+
     if not args.seed:
-        args.seed = sdsdsim.rng_utils.get_safe_seed(rng)
-    rng.seed(args.seed)
+        args.seed = sdsdsim.rng_utils.get_safe_seed(random.Random())
 
     data = {
         'SDSDsim_version' : sdsdsim.__version__,
@@ -115,70 +447,109 @@ def main():
 
     cfg = parse_config(args.config_path)
 
-    prune_extinct_leaves = cfg['settings']['prune_extinct_leaves']
-    keep_extinct_trees = cfg['settings']['keep_extinct_trees']
-    max_leaves_strict = cfg['settings']['max_leaves_strict']
-
     data['model'] = cfg['model']
     data['settings'] = cfg['settings']
 
-    model = sdsdsim.model.SDSDModel(**cfg['model'])
+    # Vet the model before any worker processes are started
+    sdsdsim.model.SDSDModel(**cfg['model'])
 
-    samples = []
-    
-    while len(samples) < args.number_of_samples:
-        survived, tree, burst_times = sdsdsim.model.sim_SDSD_tree(
-            rng_seed = rng.random(),
-            sdsd_model = model,
-            root_state = cfg['settings']['fix_root_state_to'],
-            **cfg['settings']['stopping_conditions']
+    if cfg['settings']['condition_on_survival'] and (
+            SAMPLE_WRITERS[args.output_format].binary):
+        sys.stderr.write(
+            "ERROR: The weights of trees simulated with "
+            "condition_on_survival cannot be written in the "
+            f"'{args.output_format}' format\n"
         )
-        if (not survived) and (not keep_extinct_trees):
-            continue
-        if max_leaves_strict:
-            mx = cfg['settings']['stopping_conditions']['max_total_leaves']
-            if (mx and (tree.number_of_leaves > mx)):
-                sys.stderr.write(
-                    f"max_total_leaves is {mx} and final shared event resulted "
-                    f"in {tree.number_of_leaves} leaves...\n"
-                    f"\tDiscarding this simulation!\n"
-                )
-                continue
-            mx = cfg['settings']['stopping_conditions']['max_extant_leaves']
-            if (mx and (tree.number_of_extant_leaves > mx)):
-                sys.stderr.write(
-                    f"max_extant_leaves is {mx} and final shared event resulted "
-                    f"in {tree.number_of_extant_leaves} leaves...\n"
-                    f"\tDiscarding this simulation!\n"
-                )
+        sys.exit(1)
+
+    stopping_conditions = cfg['settings']['stopping_conditions']
+
+    n_samples = 0
+    replicate_index = 0
+    rejection_counts = {}
+    header_digest = get_header_digest(data)
+    writer_class = SAMPLE_WRITERS[args.output_format]
+    out = sys.stdout
+    if checkpoint is not None:
+        if checkpoint['header_digest'] != header_digest:
+            sys.stderr.write(
+                "ERROR: The config or SDSDsim version does not match that of "
+                "the checkpoint\n"
+            )
+            sys.exit(1)
+        n_samples = checkpoint['number_of_samples']
+        replicate_index = checkpoint['next_replicate_index']
+        rejection_counts = checkpoint['rejection_counts']
+        # Discard anything written after the checkpoint
+        out = open(args.output, "r+b" if writer_class.binary else "r+")
+        out.seek(checkpoint['output_offset'])
+        out.truncate()
+        writer = writer_class.resume(out)
+    else:
+        if args.output:
+            out = open(args.output, "wb" if writer_class.binary else "w")
+        elif writer_class.binary:
+            out = sys.stdout.buffer
+        writer = writer_class(out)
+        writer.write_header(data)
+
+    def save_checkpoint():
+        if checkpoint_path is None:
+            return
+        write_checkpoint(checkpoint_path, {
+            'seed': args.seed,
+            'output_format': args.output_format,
+            'header_digest': header_digest,
+            'number_of_samples': n_samples,
+            'next_replicate_index': replicate_index,
+            'rejection_counts': rejection_counts,
+            'output_offset': out.tell(),
+        })
+
+    metrics = sdsdsim.metrics.SimulationMetrics()
+    last_progress_time = metrics.start_time
+
+    save_checkpoint()
+    if n_samples < args.number_of_samples:
+        replicates = iter_replicates(cfg, args.seed, jobs = args.jobs,
+                start_index = replicate_index,
+                get_sample = writer_class.get_sample)
+        for rejection, n_leaves, sample, n_events, stage_times in replicates:
+            replicate_index += 1
+            metrics.record_replicate(rejection,
+                    number_of_events = n_events,
+                    stage_times = stage_times)
+            if args.progress_interval is not None:
+                now = time.perf_counter()
+                if (now - last_progress_time) >= args.progress_interval:
+                    last_progress_time = now
+                    sys.stderr.write(
+                        f"Progress: {metrics.get_progress_line()}\n")
+            if rejection is None:
+                start_time = time.perf_counter()
+                writer.write_sample(sample)
+                metrics.add_time('serialization',
+                        time.perf_counter() - start_time)
+                n_samples += 1
+                if n_samples >= args.number_of_samples:
+                    break
+                if (n_samples % args.checkpoint_interval) == 0:
+                    save_checkpoint()
                 continue
-            mx = cfg['settings']['stopping_conditions']['max_extinct_leaves']
-            if (mx and (tree.number_of_extinct_leaves > mx)):
-                # This should never happen, but putting logic in place in case
-                # we ever decide to allow shared extinction events
+            rejection_counts[rejection] = rejection_counts.get(rejection, 0) + 1
+            if n_leaves is not None:
                 sys.stderr.write(
-                    f"max_extinct_leaves is {mx} and final shared event resulted "
-                    f"in {tree.number_of_extinct_leaves} leaves...\n"
+                    f"{rejection} is {stopping_conditions[rejection]} "
+                    f"and final shared event resulted in {n_leaves} leaves...\n"
                     f"\tDiscarding this simulation!\n"
                 )
-                continue
-
-        if prune_extinct_leaves:
-            tree = tree.prune_extinct_leaves()
-
-        burst_times_with_nodes = set()
-        for node in tree.internal_leafward_iter():
-            if node.is_burst_node:
-                burst_times_with_nodes.add(node.time)
-        burst_times_with_nodes = sorted(burst_times_with_nodes)
-
-        samples.append(
-            {
-                'tree': tree.as_newick_string(),
-                'burst_times': [float(t) for t in burst_times],
-                'burst_times_with_nodes': [float(t) for t in burst_times_with_nodes],
-            }
-        )
-
-    data['trees'] = samples
-    yaml.dump(data, stream = sys.stdout, default_flow_style = False)
+        replicates.close()
+    save_checkpoint()
+    writer.finish()
+    if out not in (sys.stdout, getattr(sys.stdout, "buffer", None)):
+        out.close()
+    if args.progress_interval is not None:
+        sys.stderr.write(f"Progress: {metrics.get_progress_line()}\n")
+    if args.metrics_output:
+        with open(args.metrics_output, "w") as stream:
+            metrics.write_json(stream)
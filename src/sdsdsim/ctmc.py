@@ -12,16 +12,49 @@ class CTMC(object):
     The methods for getting the steady-state probabilities borrow heavily from
     this very nice blog post by Vince Knight:
         https://vknight.org/blog/posts/continuous-time-markov-chains
+
+    The quantities derived from `q` that are needed to simulate the chain (the
+    rate of leaving each state, alias samplers of the states each state can
+    jump to, and the steady-state probabilities) are cached when `q` is set,
+    so they are not recomputed on every call. Setting `q` to
+    a new matrix updates the cache; the stored matrix is read-only, so it
+    cannot be changed in place without the cache going stale.
     """
     def __init__(
         self,
         q = np.array([[-1.0,   1.0],
                       [ 1.0,  -1.0]]),
     ):
-        q = np.array(q)
-        self.vet_q_matrix(q)
         self.q = q
 
+    def _get_q(self):
+        return self._q
+
+    def _set_q(self, q):
+        q = np.array(q, dtype = float)
+        self.vet_q_matrix(q)
+        q.flags.writeable = False
+        self._q = q
+        self._exit_rates = []
+        self._jump_states = []
+        self._jump_rates = []
+        self._jump_samplers = []
+        for row in q:
+            potential_states = [int(j) for j in np.where(row > 0.0)[0]]
+            rates = [float(row[j]) for j in potential_states]
+            exit_rate = 0.0
+            for r in rates:
+                exit_rate += r
+            self._exit_rates.append(exit_rate)
+            self._jump_states.append(potential_states)
+            self._jump_rates.append(rates)
+            self._jump_samplers.append(rng_utils.AliasSampler(rates))
+        # The steady-state probabilities are computed when first needed
+        self._steady_state_probs = None
+        self._steady_state_sampler = None
+
+    q = property(_get_q, _set_q)
+
     @classmethod
     def vet_q_matrix(cls, q):
         n_states = len(q)
@@ -51,38 +84,35 @@ class CTMC(object):
     n_states = property(_get_n_states)
 
     def get_rate_from(self, state):
-        row = self.q[state]
-        rate = 0.0
-        for r in row:
-            if r > 0.0:
-                rate += r
-        return rate
+        return self._exit_rates[state]
 
     def draw_transition(self, state, rng = None):
         if not rng:
             rng = GLOBAL_RNG
-        row = self.q[state]
-        potential_states = np.where(row > 0.0)[0]
-        rates = row[potential_states]
-        state_index = rng_utils.get_weighted_index(rates, rng)
-        new_state = potential_states[state_index]
-        return new_state
+        state_index = self._jump_samplers[state].draw(rng)
+        return self._jump_states[state][state_index]
 
     def are_steady_state_probs(self, state_probs):
         return np.allclose((state_probs @ self.q), 0.0)
 
     def get_steady_state_probs(self):
-        m = np.vstack((self.q.transpose()[:-1], np.ones(self.n_states)))
-        b = np.vstack((np.zeros((self.n_states - 1, 1)), [1]))
-        state_probs = np.linalg.solve(m, b).transpose()[0]
-        return state_probs
-    
+        if self._steady_state_probs is None:
+            m = np.vstack((self.q.transpose()[:-1], np.ones(self.n_states)))
+            b = np.vstack((np.zeros((self.n_states - 1, 1)), [1]))
+            state_probs = np.linalg.solve(m, b).transpose()[0]
+            state_probs.flags.writeable = False
+            self._steady_state_probs = state_probs
+            # Solving can leave probabilities of zero slightly negative
+            self._steady_state_sampler = rng_utils.AliasSampler(
+                    [max(p, 0.0) for p in state_probs])
+        return self._steady_state_probs
+
     def draw_random_state(self, rng = None):
         if not rng:
             rng = GLOBAL_RNG
-        steady_state_probs = self.get_steady_state_probs()
-        state = rng_utils.get_prob_index(steady_state_probs, rng)
-        return state
+        if self._steady_state_sampler is None:
+            self.get_steady_state_probs()
+        return self._steady_state_sampler.draw(rng)
 
     def sim_steady_state_probs(
         self,
@@ -99,10 +129,9 @@ class CTMC(object):
         time_in_state = {x : 0.0 for x in range(self.n_states) }
 
         while clock < max_time:
-            row = self.q[state]
-            potential_states = np.where(row > 0.0)[0]
-            rates = row[potential_states]
-            samples = [rng.expovariate(r) for r in rates]
+            potential_states = self._jump_states[state]
+            rates = self._jump_rates[state]
+            samples = rng_utils.exponential_rvs(rates, rng)
             time = np.min(samples)
             clock += time
             if clock > warmup_time:
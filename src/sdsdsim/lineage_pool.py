@@ -0,0 +1,65 @@
+#! /usr/bin/env python
+
+
+class LineagePool(object):
+    """
+    An unordered collection of lineages (nodes) that supports constant-time
+    addition, removal and indexing (e.g., to pick a lineage at random by
+    drawing an index below `len(pool)`).
+
+    Items are stored in an array alongside a map from each item to its
+    position in the array. Removing an item moves the last item of the array
+    into the vacated position, so the order of the items is not preserved.
+    Items are compared by identity.
+
+    >>> pool = LineagePool(["a", "b", "c"])
+    >>> len(pool)
+    3
+    >>> pool.remove("a")
+    >>> sorted(pool)
+    ['b', 'c']
+    >>> "a" in pool
+    False
+    """
+
+    def __init__(self, items = None):
+        self._items = []
+        self._positions = {}
+        if items is not None:
+            self.extend(items)
+
+    def add(self, item):
+        if item in self._positions:
+            raise ValueError("Item is already in the pool")
+        self._positions[item] = len(self._items)
+        self._items.append(item)
+
+    def extend(self, items):
+        for item in items:
+            self.add(item)
+
+    def remove(self, item):
+        try:
+            i = self._positions.pop(item)
+        except KeyError:
+            raise ValueError("Item to remove is not in the pool")
+        last = self._items.pop()
+        if i < len(self._items):
+            self._items[i] = last
+            self._positions[last] = i
+
+    def clear(self):
+        self._items.clear()
+        self._positions.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        return self._items[index]
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __contains__(self, item):
+        return item in self._positions
@@ -0,0 +1,217 @@
+#! /usr/bin/env python
+
+"""
+Counters and timers for monitoring batches of simulated trees.
+
+`SimulationMetrics` collects the number of replicates attempted, accepted and
+rejected (by reason), the number of events simulated, and the time spent in
+each stage of producing trees. It can be passed to
+`sdsdsim.model.sim_SDSD_trees`, and is used by the `sim-SDSD-trees` command to
+print progress and write a summary. `EventLoopProfile` breaks down the time
+spent within the simulation of trees.
+"""
+
+import json
+import time
+
+
+class SimulationMetrics(object):
+    """
+    Counts and timings of a batch of simulated trees.
+
+    Times are cumulative seconds spent in each of `STAGES`. When replicates
+    are simulated across several processes, the times are summed across the
+    processes, so they can exceed the elapsed (wall-clock) time.
+
+    Parameters
+    ----------
+    clock : callable
+        Returns the current time in seconds; used for the elapsed time.
+
+    >>> metrics = SimulationMetrics()
+    >>> metrics.record_replicate(None, number_of_events = 30,
+    ...         stage_times = {"simulation": 0.5})
+    >>> metrics.record_replicate("extinct", number_of_events = 10,
+    ...         stage_times = {"simulation": 0.5})
+    >>> metrics.attempts, metrics.accepted, metrics.rejections
+    (2, 1, {'extinct': 1})
+    >>> metrics.events_per_second
+    40.0
+    """
+
+    STAGES = ("simulation", "pruning", "serialization")
+
+    def __init__(self, clock = time.perf_counter):
+        self._clock = clock
+        self.start_time = clock()
+        self.attempts = 0
+        self.accepted = 0
+        self.rejections = {}
+        self.events = 0
+        self.stage_times = {stage: 0.0 for stage in self.STAGES}
+
+    def add_time(self, stage, seconds):
+        if stage not in self.stage_times:
+            raise ValueError(
+                f"Unknown stage '{stage}'; expecting one of {self.STAGES}"
+            )
+        self.stage_times[stage] += seconds
+
+    def record_replicate(self, rejection, number_of_events = 0,
+            stage_times = None):
+        """
+        Record a simulated replicate.
+
+        Parameters
+        ----------
+        rejection : str or None
+            The reason the replicate was rejected, or None if it was accepted.
+        number_of_events : int
+            The number of events simulated for the replicate.
+        stage_times : dict or None
+            The seconds spent on the replicate in each stage.
+        """
+        self.attempts += 1
+        if rejection is None:
+            self.accepted += 1
+        else:
+            self.rejections[rejection] = self.rejections.get(rejection, 0) + 1
+        self.events += number_of_events
+        if stage_times:
+            for stage, seconds in stage_times.items():
+                self.add_time(stage, seconds)
+
+    def _get_elapsed_time(self):
+        return self._clock() - self.start_time
+
+    elapsed_time = property(_get_elapsed_time)
+
+    def _get_acceptance_rate(self):
+        if self.attempts < 1:
+            return None
+        return self.accepted / self.attempts
+
+    acceptance_rate = property(_get_acceptance_rate)
+
+    def _get_events_per_second(self):
+        if self.stage_times["simulation"] <= 0.0:
+            return None
+        return self.events / self.stage_times["simulation"]
+
+    events_per_second = property(_get_events_per_second)
+
+    def _get_trees_per_second(self):
+        elapsed_time = self.elapsed_time
+        if elapsed_time <= 0.0:
+            return None
+        return self.accepted / elapsed_time
+
+    trees_per_second = property(_get_trees_per_second)
+
+    def as_dict(self):
+        return {
+            "attempts": self.attempts,
+            "accepted": self.accepted,
+            "rejections": dict(sorted(self.rejections.items())),
+            "acceptance_rate": self.acceptance_rate,
+            "events": self.events,
+            "events_per_second": self.events_per_second,
+            "elapsed_seconds": self.elapsed_time,
+            "trees_per_second": self.trees_per_second,
+            "stage_seconds": dict(self.stage_times),
+        }
+
+    def get_progress_line(self):
+        """
+        Get a one-line summary of the metrics.
+
+        >>> metrics = SimulationMetrics()
+        >>> metrics.record_replicate("max_extant_leaves")
+        >>> metrics.get_progress_line().split(";")[0]
+        '0 of 1 replicates accepted (0.0%)'
+        """
+        acceptance_rate = self.acceptance_rate or 0.0
+        line = (f"{self.accepted} of {self.attempts} replicates accepted "
+                f"({acceptance_rate * 100.0:.1f}%)")
+        if self.rejections:
+            rejections = ", ".join(
+                f"{reason} {count}"
+                for reason, count in sorted(self.rejections.items())
+            )
+            line += f"; rejected: {rejections}"
+        line += f"; {self.events} events"
+        if self.events_per_second is not None:
+            line += f" ({self.events_per_second:.0f}/s)"
+        if self.trees_per_second is not None:
+            line += f"; {self.trees_per_second:.2f} trees/s"
+        line += f"; {self.elapsed_time:.1f}s elapsed"
+        return line
+
+    def write_json(self, stream):
+        json.dump(self.as_dict(), stream, indent = 2, sort_keys = True)
+        stream.write("\n")
+
+
+class EventLoopProfile(object):
+    """
+    Counts and cumulative times of the parts of the event loop of
+    `sdsdsim.model.SDSDTreeSimulator.simulate`.
+
+    The parts (`PARTS`) are drawing the waiting time to (and the lineage of)
+    each event, resolving each birth, death, state transition and burst event,
+    and the final pass that labels the leaves. A profile accumulates across
+    all the trees it is passed to. To act on each part as it is recorded
+    (e.g., to log it), override `add`.
+
+    >>> from sdsdsim import model
+    >>> profile = EventLoopProfile()
+    >>> survived, root, burst_times = model.sim_SDSD_tree(
+    ...         rng_seed = 1,
+    ...         sdsd_model = model.SDSDModel(),
+    ...         profile = profile)
+    >>> profile.counts["labeling"]
+    1
+    >>> profile.counts["birth"] > 0
+    True
+    """
+
+    PARTS = ("wait_time", "birth", "death", "transition", "burst", "labeling")
+
+    def __init__(self):
+        self.counts = {part: 0 for part in self.PARTS}
+        self.times = {part: 0.0 for part in self.PARTS}
+
+    def add(self, part, seconds):
+        self.counts[part] += 1
+        self.times[part] += seconds
+
+    def _get_total_time(self):
+        return sum(self.times.values())
+
+    total_time = property(_get_total_time)
+
+    def as_dict(self):
+        return {
+            part: {
+                "count": self.counts[part],
+                "seconds": self.times[part],
+            } for part in self.PARTS
+        }
+
+    def get_summary_lines(self):
+        """
+        Get a line for each part, with its count, cumulative time, mean time
+        and share of the total time.
+        """
+        total_time = self.total_time
+        lines = []
+        for part in self.PARTS:
+            count = self.counts[part]
+            seconds = self.times[part]
+            mean = (seconds / count) if count else 0.0
+            share = (seconds / total_time) if total_time > 0.0 else 0.0
+            lines.append(
+                f"{part:<11} {count:>10d} {seconds:>10.4f}s "
+                f"{mean * 1e6:>9.2f}us {share * 100.0:>6.1f}%"
+            )
+        return lines
@@ -1,10 +1,14 @@
 #! /usr/bin/env python
 
+import time
 import random
+import weakref
 import numpy as np
 
-from sdsdsim import GLOBAL_RNG, rng_utils
+from sdsdsim import rng_utils
+from sdsdsim.array_tree import ArrayTree, ArrayTreeBuilder
 from sdsdsim.ctmc import CTMC
+from sdsdsim.lineage_pool import LineagePool
 from sdsdsim.node import Node
 
 
@@ -57,6 +61,631 @@ class SDSDModel(object):
         self.only_bifurcate = only_bifurcate
 
 
+# Algorithms for drawing the waiting time to, and the index of, the next event.
+# The "direct" engine (Gillespie's direct method) draws a single exponential
+# waiting time from the summed rate of all events and then picks an event in
+# proportion to its rate. The "race" engine draws a waiting time for every
+# event and takes the minimum. Both yield the same distribution of trees; the
+# "race" engine is retained so the two can be checked against each other.
+ENGINES = ("direct", "race")
+
+
+def draw_direct_event(rates, rng):
+    """
+    Draw the next event using Gillespie's direct method.
+
+    Parameters
+    ----------
+    rates : sequence of float
+        The (non-negative) rate of each event.
+    rng : `random.Random` or `rng_utils.NumpyRNG` object
+        The random number generator to use.
+
+    Returns
+    -------
+    tuple
+        The waiting time until the next event and the index of the event.
+    """
+    total_rate = sum(rates)
+    if total_rate <= 0.0:
+        return float("inf"), None
+    wait_time = rng.expovariate(total_rate)
+    return wait_time, rng_utils.get_weighted_index(rates, rng)
+
+def draw_race_event(rates, rng):
+    """
+    Draw the next event by racing an exponential waiting time for each event.
+
+    Parameters
+    ----------
+    rates : sequence of float
+        The (non-negative) rate of each event.
+    rng : `random.Random` or `rng_utils.NumpyRNG` object
+        The random number generator to use.
+
+    Returns
+    -------
+    tuple
+        The waiting time until the next event and the index of the event.
+    """
+    rates = np.asarray(rates)
+    positive_rate_indices = np.where(rates > 0.0)[0]
+    if len(positive_rate_indices) < 1:
+        return float("inf"), None
+    positive_rates = rates[positive_rate_indices]
+    wait_times = rng_utils.exponential_rvs(positive_rates, rng)
+    i = np.argmin(wait_times)
+    return wait_times[i], positive_rate_indices[i]
+
+def draw_lineage_event(engine, extant_by_state, state_total_rates,
+        burst_rate, rng):
+    """
+    Draw the next event among the extant lineages and the burst process.
+
+    Parameters
+    ----------
+    engine : str
+        One of `ENGINES`.
+    extant_by_state : sequence
+        For each state, the extant lineages currently in that state.
+    state_total_rates : sequence of float
+        For each state, the summed rate of birth, death and transition for a
+        single lineage in that state.
+    burst_rate : float
+        The rate of burst events.
+    rng : `random.Random` or `rng_utils.NumpyRNG` object
+        The random number generator to use.
+
+    Returns
+    -------
+    tuple
+        The waiting time until the next event, the state of the lineage
+        involved, and the index of the lineage within `extant_by_state[state]`.
+        For burst events the state and index are both -1. If no event can occur
+        the waiting time is infinite and the state and index are None.
+    """
+    n_states = len(state_total_rates)
+    if engine == "direct":
+        # Pick a state in proportion to its summed rate across lineages, and
+        # then a lineage uniformly within that state, so the cost of each
+        # event grows with the number of states rather than lineages.
+        rates = [
+            len(extant_by_state[i]) * state_total_rates[i]
+            for i in range(n_states)
+        ]
+        rates.append(burst_rate)
+        wait_time, index = draw_direct_event(rates, rng)
+        if index is None:
+            return wait_time, None, None
+        if index == n_states:
+            return wait_time, -1, -1
+        return wait_time, index, rng.randrange(len(extant_by_state[index]))
+    if engine == "race":
+        rates = []
+        for i in range(n_states):
+            rates.extend([state_total_rates[i]] * len(extant_by_state[i]))
+        rates.append(burst_rate)
+        wait_time, index = draw_race_event(rates, rng)
+        if index is None:
+            return wait_time, None, None
+        if index == len(rates) - 1:
+            return wait_time, -1, -1
+        for i in range(n_states):
+            if index < len(extant_by_state[i]):
+                return wait_time, i, index
+            index -= len(extant_by_state[i])
+        raise ValueError(f"Unexpected lineage index: {index}")
+    raise ValueError(f"Unknown engine '{engine}'; expecting one of {ENGINES}")
+
+def draw_burst_divergences(sdsd_model, extant_by_state, rng):
+    """
+    Draw which extant lineages diverge at a burst event and into how many
+    descendants.
+
+    The lineages are resolved a state at a time. The lineages that take part
+    in the burst are drawn together for each state (see
+    `rng_utils.bernoulli_indices`), so no random numbers are drawn for the
+    lineages that do not.
+
+    Parameters
+    ----------
+    sdsd_model : `SDSDModel` object
+        The model to simulate under.
+    extant_by_state : sequence
+        For each state, the extant lineages currently in that state.
+    rng : `random.Random` or `rng_utils.NumpyRNG` object
+        The random number generator to use.
+
+    Returns
+    -------
+    list
+        A tuple for each state that has diverging lineages, containing the
+        state, a list of the lineages that diverge, and a list of the number
+        of descendants of each of these lineages. Lineages that are assigned a
+        single descendant do not diverge and are not included.
+    """
+    divergences = []
+    for state, extant_nodes in enumerate(extant_by_state):
+        indices = rng_utils.bernoulli_indices(
+                n = len(extant_nodes),
+                p = sdsd_model.burst_probs[state],
+                rng = rng)
+        if not indices:
+            continue
+        if sdsd_model.only_bifurcate:
+            furcations = [2] * len(indices)
+        else:
+            burst_mean = sdsd_model.burst_furcation_poisson_means[state]
+            burst_shift = sdsd_model.burst_furcation_poisson_shifts[state]
+            furcations = [
+                k + burst_shift for k in rng_utils.poisson_rvs(
+                    mean = burst_mean, n = len(indices), rng = rng)
+            ]
+        assert min(furcations) > 0
+        # Collect the nodes before any are removed from the pool, because
+        # removing reorders it
+        nodes = [extant_nodes[i] for i, k in zip(indices, furcations) if k > 1]
+        if nodes:
+            divergences.append(
+                (state, nodes, [k for k in furcations if k > 1])
+            )
+    return divergences
+
+# Reasons for rejecting a simulated tree
+REJECTED_EXTINCT = "extinct"
+REJECTED_MAX_TOTAL_LEAVES = "max_total_leaves"
+REJECTED_MAX_EXTANT_LEAVES = "max_extant_leaves"
+REJECTED_MAX_EXTINCT_LEAVES = "max_extinct_leaves"
+
+
+class SimulatedTree(object):
+    """
+    The outcome of simulating a tree.
+
+    Attributes
+    ----------
+    survived : bool
+        Whether any lineages were extant at the end of the simulation.
+    tree : `Node` or `ArrayTree` object
+        The root of the simulated tree, or the tree as an `ArrayTree`. This is
+        None if the simulator rejected the tree before finishing it.
+    burst_times : list of float
+        The times of the burst events.
+    rejection : str or None
+        The reason the tree was rejected (one of the `REJECTED_*` values), or
+        None if it was accepted.
+    number_of_extant_leaves : int or None
+        The number of extant leaves of the tree.
+    number_of_extinct_leaves : int or None
+        The number of extinct leaves of the tree.
+    log_weight : float
+        The log of the importance weight of the tree; see the
+        `condition_on_survival` option of `SDSDTreeSimulator.simulate`. This
+        is zero for trees simulated without conditioning.
+    number_of_events : int or None
+        The number of events (births, deaths, transitions and bursts) drawn
+        during the simulation, including the one that ended it.
+    """
+    def __init__(self, survived, tree, burst_times, rejection = None,
+            number_of_extant_leaves = None,
+            number_of_extinct_leaves = None,
+            log_weight = 0.0,
+            number_of_events = None):
+        self.survived = survived
+        self.tree = tree
+        self.burst_times = burst_times
+        self.rejection = rejection
+        self.number_of_extant_leaves = number_of_extant_leaves
+        self.number_of_extinct_leaves = number_of_extinct_leaves
+        self.log_weight = log_weight
+        self.number_of_events = number_of_events
+
+    def _get_number_of_leaves(self):
+        if (self.number_of_extant_leaves is None) or (
+                self.number_of_extinct_leaves is None):
+            return None
+        return self.number_of_extant_leaves + self.number_of_extinct_leaves
+
+    number_of_leaves = property(_get_number_of_leaves)
+
+
+class SDSDTreeSimulator(object):
+    """
+    Simulates trees under an `SDSDModel`.
+
+    The per-state rate tables are taken from `get_state_tables` when the
+    simulator is created, so they are only built once per model, and are not
+    updated if the model is changed after the simulator is created. The
+    lineages of each tree are kept in pools local to `simulate`, so a
+    simulator can be used by several threads at once.
+
+    Each tree is simulated with a random number generator from
+    `rng_utils.get_rng`, seeded with the `rng_seed` of `simulate` and of type
+    `rng_backend` (one of `rng_utils.RNG_BACKENDS`). A given seed gives the
+    same tree under the same backend, but not across backends. Every random
+    draw of a simulation is taken from this generator (never from
+    `GLOBAL_RNG`), so a tree only depends on its seed, and not on the process
+    it is simulated in or on what was simulated before it.
+    """
+    def __init__(self, sdsd_model, engine = "direct", rng_backend = "python"):
+        if engine not in ENGINES:
+            raise ValueError(
+                f"Unknown engine '{engine}'; expecting one of {ENGINES}"
+            )
+        if rng_backend not in rng_utils.RNG_BACKENDS:
+            raise ValueError(
+                f"Unknown RNG backend '{rng_backend}'; expecting one of "
+                f"{rng_utils.RNG_BACKENDS}"
+            )
+        self.sdsd_model = sdsd_model
+        self.engine = engine
+        self.rng_backend = rng_backend
+        self.n_states = sdsd_model.ctmc.n_states
+        tables = get_state_tables(sdsd_model)
+        self.state_rates = tables.state_rates
+        self.state_total_rates = tables.state_total_rates
+        self.state_event_samplers = tables.state_event_samplers
+        self.state_survival_total_rates = tables.state_survival_total_rates
+        self.state_survival_samplers = tables.state_survival_samplers
+
+    def simulate(
+        self,
+        rng_seed,
+        root_state = None,
+        max_extant_leaves = 50,
+        max_extinct_leaves = None,
+        max_total_leaves = None,
+        max_time = None,
+        as_array_tree = False,
+        keep_extinct_trees = True,
+        max_leaves_strict = False,
+        condition_on_survival = False,
+        profile = None,
+    ):
+        """
+        Simulate a tree.
+
+        If `as_array_tree` is True, the tree is returned as an `ArrayTree`
+        rather than as the root `Node`. The arrays are then grown in the event
+        loop by an `ArrayTreeBuilder`, and the extant lineages are only integer
+        indices into them, so no `Node` objects are created. For the same seed,
+        the result is the same as `ArrayTree.from_node` of the `Node` tree.
+
+        The simulation stops as soon as the tree is certain to be rejected
+        (see `get_rejection_reason`), in which case the tree is not finished
+        and the `tree` of the result is None. If `keep_extinct_trees` is
+        False, this happens when the last lineage goes extinct. If
+        `max_leaves_strict` is True, this happens when a burst event
+        overshoots the maximum number of extant or total leaves; the simulation
+        would otherwise carry on to the next event, but the number of leaves
+        could no longer change.
+
+        If `condition_on_survival` is True, the tree is conditioned on
+        survival by importance sampling rather than by rejection. The death of
+        the last extant lineage is suppressed, so every replicate survives,
+        and the `log_weight` of the result is decremented by the death rate of
+        that lineage times the time it spent as the only extant lineage. The
+        weight is exactly the probability that the unconditioned process would
+        not have gone extinct along the tree, so weighting trees by
+        `exp(log_weight)` gives exact (self-normalized importance sampling)
+        estimates under the conditioned process, the mean weight estimates the
+        probability of survival, and keeping each tree with probability
+        `exp(log_weight)` gives unweighted draws. The cost per tree does not
+        grow as death rates approach birth rates, but the weights become more
+        variable. The final extension past a stopping condition is simulated
+        under the unconditioned rates, as a death then ends the simulation
+        without extinction.
+
+        If a `profile` (a `metrics.EventLoopProfile` object) is provided, the
+        number and duration of each part of the event loop is recorded in it.
+        Otherwise, the only cost of the hooks is a check of a local flag at
+        each of them.
+
+        Returns
+        -------
+        `SimulatedTree` object
+        """
+        sdsd_model = self.sdsd_model
+        n_states = self.n_states
+        state_event_samplers = self.state_event_samplers
+        clock = 0.0
+        rng = rng_utils.get_rng(rng_seed, self.rng_backend)
+        if (root_state is None) or (root_state < 0):
+            root_state = sdsd_model.ctmc.draw_random_state(rng)
+        if (root_state >= n_states) or (root_state < 0):
+            raise ValueError(f"Invalid root state: {root_state}")
+        if as_array_tree:
+            builder = ArrayTreeBuilder(seed_time = clock)
+            root = builder.add_node(-1, root_state)
+            node_time = builder.time
+            node_flags = builder.flags
+        else:
+            builder = None
+            root = Node(
+                label = "root",
+                rootward_state = root_state,
+            )
+            root.seed_time = clock
+        # Extant lineages are kept in per-state pools, which support
+        # constant-time removal
+        extant_by_state = [LineagePool() for i in range(n_states)]
+        extant_by_state[root_state].add(root)
+        n_extant = 1
+        n_extinct = 0
+        burst_times = []
+        survived = True
+        rejection = None
+        log_weight = 0.0
+        n_events = 0
+        profiling = profile is not None
+        timer = time.perf_counter
+
+        while True:
+            final_extension = False
+            if ((max_extant_leaves is not None)
+                    and (n_extant >= max_extant_leaves)):
+                final_extension = True
+            elif ((max_extinct_leaves is not None)
+                    and (n_extinct >= max_extinct_leaves)):
+                final_extension = True
+            elif ((max_total_leaves is not None)
+                    and (n_extant + n_extinct >= max_total_leaves)):
+                final_extension = True
+            conditioning = (condition_on_survival and (n_extant == 1)
+                    and (not final_extension))
+            if profiling:
+                start_time = timer()
+            wait_time, state, lineage_index = draw_lineage_event(
+                engine = self.engine,
+                extant_by_state = extant_by_state,
+                state_total_rates = (self.state_survival_total_rates
+                    if conditioning else self.state_total_rates),
+                burst_rate = sdsd_model.burst_rate,
+                rng = rng,
+            )
+            if profiling:
+                event_start_time = timer()
+                profile.add("wait_time", event_start_time - start_time)
+            if conditioning:
+                for last_state, pool in enumerate(extant_by_state):
+                    if pool:
+                        break
+                if (max_time is not None) and (clock + wait_time > max_time):
+                    alone_time = max_time - clock
+                else:
+                    alone_time = wait_time
+                log_weight -= self.state_rates[last_state][1] * alone_time
+            if (max_time is not None) and (clock + wait_time > max_time):
+                clock = max_time
+                break
+            if state is None:
+                raise ValueError(
+                    "All event rates are zero and there is no max_time"
+                )
+            clock += wait_time
+            n_events += 1
+            if state < 0:
+                # This is a burst event
+                if final_extension:
+                    # We have the desired number of leaves and have extended
+                    # the tree to the next diversification event
+                    break
+                burst_times.append(clock)
+                divergences = draw_burst_divergences(
+                    sdsd_model = sdsd_model,
+                    extant_by_state = extant_by_state,
+                    rng = rng,
+                )
+                for current_state, nodes, furcations in divergences:
+                    extant_nodes = extant_by_state[current_state]
+                    for node, n_children in zip(nodes, furcations):
+                        extant_nodes.remove(node)
+                        if builder is not None:
+                            node_time[node] = clock
+                            node_flags[node] |= ArrayTree.BURST
+                            for i in range(n_children):
+                                extant_nodes.add(
+                                    builder.add_node(node, current_state))
+                        else:
+                            node.time = clock
+                            node.is_burst_node = True
+                            for i in range(n_children):
+                                child = Node(
+                                    rootward_state = current_state,
+                                )
+                                node.add_child(child)
+                                extant_nodes.add(child)
+                        n_extant += n_children - 1
+                if profiling:
+                    profile.add("burst", timer() - event_start_time)
+                if max_leaves_strict:
+                    rejection = get_leaf_rejection_reason(
+                        number_of_extant_leaves = n_extant,
+                        number_of_extinct_leaves = n_extinct,
+                        max_extant_leaves = max_extant_leaves,
+                        max_extinct_leaves = max_extinct_leaves,
+                        max_total_leaves = max_total_leaves,
+                    )
+                    if rejection is not None:
+                        break
+            else:
+                # This is a lineage-specific event
+                if conditioning:
+                    event_index = self.state_survival_samplers[state].draw(
+                        rng)
+                else:
+                    event_index = state_event_samplers[state].draw(rng)
+
+                if (event_index < 2) and final_extension:
+                    # We have the desired number of leaves and have extended
+                    # the tree to the next birth/death event
+                    break
+
+                extant_nodes = extant_by_state[state]
+                node = extant_nodes[lineage_index]
+
+                if event_index == 0:
+                    # lineage-specific birth event
+                    extant_nodes.remove(node)
+                    if builder is not None:
+                        node_time[node] = clock
+                        for i in range(2):
+                            extant_nodes.add(builder.add_node(node, state))
+                    else:
+                        node.time = clock
+                        for i in range(2):
+                            child = Node(
+                                rootward_state = state,
+                            )
+                            node.add_child(child)
+                            extant_nodes.add(child)
+                    n_extant += 1
+                    if profiling:
+                        profile.add("birth", timer() - event_start_time)
+
+                elif event_index == 1:
+                    # lineage-specific death event
+                    if builder is not None:
+                        node_time[node] = clock
+                        node_flags[node] |= ArrayTree.EXTINCT
+                    else:
+                        node.time = clock
+                        node.is_extinct = True
+                    extant_nodes.remove(node)
+                    n_extant -= 1
+                    n_extinct += 1
+                    if profiling:
+                        profile.add("death", timer() - event_start_time)
+                    if n_extant == 0:
+                        survived = False
+                        if not keep_extinct_trees:
+                            rejection = REJECTED_EXTINCT
+                        break
+
+                elif event_index == 2:
+                    # lineage-specific state transition
+                    new_state = sdsd_model.ctmc.draw_transition(state, rng)
+                    if builder is not None:
+                        builder.add_state_change(node, new_state, clock)
+                    else:
+                        node.transition_state(new_state, clock)
+                    extant_nodes.remove(node)
+                    extant_by_state[new_state].add(node)
+                    if profiling:
+                        profile.add("transition", timer() - event_start_time)
+
+                else:
+                    raise ValueError(f"Unexpected event index: {event_index}")
+        if rejection is not None:
+            return SimulatedTree(survived, None, burst_times,
+                    rejection = rejection,
+                    number_of_extant_leaves = n_extant,
+                    number_of_extinct_leaves = n_extinct,
+                    log_weight = log_weight,
+                    number_of_events = n_events)
+        # Populate leaf times and labels
+        if profiling:
+            start_time = timer()
+        if builder is not None:
+            root = builder.finish(end_time = clock)
+            if profiling:
+                profile.add("labeling", timer() - start_time)
+            return SimulatedTree(survived, root, burst_times,
+                    number_of_extant_leaves = n_extant,
+                    number_of_extinct_leaves = n_extinct,
+                    log_weight = log_weight,
+                    number_of_events = n_events)
+        extant_leaf_count = 0
+        extinct_leaf_count = 0
+        for node in root:
+            if node.time is None:
+                assert node.is_leaf
+                assert not node.is_extinct
+                node.time = clock
+            if node.is_leaf:
+                if node.is_extinct:
+                    extinct_leaf_count += 1
+                    node.label = f"XL{extinct_leaf_count}"
+                else:
+                    extant_leaf_count += 1
+                    node.label = f"L{extant_leaf_count}"
+        if profiling:
+            profile.add("labeling", timer() - start_time)
+        return SimulatedTree(survived, root, burst_times,
+                number_of_extant_leaves = n_extant,
+                number_of_extinct_leaves = n_extinct,
+                log_weight = log_weight,
+                number_of_events = n_events)
+
+
+def get_state_rates(sdsd_model):
+    """
+    Get the birth, death and transition rate of each state of `sdsd_model`,
+    as a list of (birth, death, transition) tuples.
+    """
+    return [
+        (
+            sdsd_model.birth_rates[i],
+            sdsd_model.death_rates[i],
+            sdsd_model.ctmc.get_rate_from(i),
+        ) for i in range(sdsd_model.ctmc.n_states)
+    ]
+
+class StateTables(object):
+    """
+    The per-state rates and event samplers of an `SDSDModel`, used by
+    `SDSDTreeSimulator`.
+
+    The tables only hold numbers and samplers (no reference to the model), so
+    they can be cached by model; see `get_state_tables`.
+    """
+    def __init__(self, sdsd_model):
+        # Rates only depend on state, so we look them up once per state rather
+        # than once per lineage
+        self.state_rates = get_state_rates(sdsd_model)
+        self.state_total_rates = [sum(r) for r in self.state_rates]
+        # Which event a lineage in a given state undergoes is drawn from
+        # fixed weights, so a sampler is built for each state up front
+        self.state_event_samplers = [
+            rng_utils.AliasSampler(r) for r in self.state_rates
+        ]
+        # The same, without death, for the last extant lineage when
+        # conditioning on survival (see `SDSDTreeSimulator.simulate`).
+        # Lineages can always leave their state, so the weights cannot all be
+        # zero.
+        self.state_survival_total_rates = [
+            b + t for b, d, t in self.state_rates
+        ]
+        self.state_survival_samplers = [
+            rng_utils.AliasSampler((b, 0.0, t)) for b, d, t in self.state_rates
+        ]
+
+# The tables of each model; see `get_state_tables`
+_STATE_TABLES = weakref.WeakKeyDictionary()
+
+def get_state_tables(sdsd_model):
+    """
+    Get the `StateTables` of `sdsd_model`, reusing those from the last call
+    with the same model (object).
+
+    New tables are built if the rates of the model have changed since the
+    last ones were built. The tables do not refer to the model, so they are
+    dropped along with it.
+
+    >>> sdsd_model = SDSDModel()
+    >>> get_state_tables(sdsd_model) is get_state_tables(sdsd_model)
+    True
+    >>> sdsd_model.ctmc.q = [[-2.0, 2.0], [2.0, -2.0]]
+    >>> get_state_tables(sdsd_model).state_rates[0]
+    (1.0, 0.5, 2.0)
+    """
+    tables = _STATE_TABLES.get(sdsd_model)
+    if (tables is None) or (
+            tables.state_rates != get_state_rates(sdsd_model)):
+        tables = StateTables(sdsd_model)
+        _STATE_TABLES[sdsd_model] = tables
+    return tables
+
 def sim_SDSD_tree(
     rng_seed,
     sdsd_model,
@@ -65,161 +694,260 @@ def sim_SDSD_tree(
     max_extinct_leaves = None,
     max_total_leaves = None,
     max_time = None,
+    engine = "direct",
+    as_array_tree = False,
+    rng_backend = "python",
+    profile = None,
 ):
-    clock = 0.0
-    rng = random.Random(rng_seed)
-    if (root_state is None) or (root_state < 0):
-        root_state = sdsd_model.ctmc.draw_random_state(rng)
-    if (root_state >= sdsd_model.ctmc.n_states) or (root_state < 0):
-        raise ValueError(f"Invalid root state: {root_state}")
-    root = Node(
-        label = "root",
-        rootward_state = root_state,
+    simulator = SDSDTreeSimulator(sdsd_model, engine = engine,
+            rng_backend = rng_backend)
+    result = simulator.simulate(
+        rng_seed = rng_seed,
+        root_state = root_state,
+        max_extant_leaves = max_extant_leaves,
+        max_extinct_leaves = max_extinct_leaves,
+        max_total_leaves = max_total_leaves,
+        max_time = max_time,
+        as_array_tree = as_array_tree,
+        profile = profile,
     )
-    root.seed_time = clock
-    extant_nodes = [root]
-    extinct_nodes = []
-    burst_times = []
-    survived = True
-
-    while True:
-        final_extension = False
-        if ((max_extant_leaves is not None)
-                and (len(extant_nodes) >= max_extant_leaves)):
-            final_extension = True
-        elif ((max_extinct_leaves is not None)
-                and (len(extinct_nodes) >= max_extinct_leaves)):
-            final_extension = True
-        elif ((max_total_leaves is not None)
-                and (len(extant_nodes) + len(extinct_nodes) >= max_total_leaves)):
-            final_extension = True
-        lineage_total_rates = []
-        lineage_rates = []
-        for node in extant_nodes:
-            total_rate = 0.0
-            current_state = node.leafward_state
-            birth_rate = sdsd_model.birth_rates[current_state]
-            death_rate = sdsd_model.death_rates[current_state]
-            transition_rate = sdsd_model.ctmc.get_rate_from(current_state)
-            lineage_total_rates.append(
-                birth_rate + death_rate + transition_rate
-            )
-            lineage_rates.append(
-                (birth_rate, death_rate, transition_rate)
-            )
-        lineage_total_rates.append(sdsd_model.burst_rate)
-        lineage_total_rates = np.array(lineage_total_rates)
-        positive_rate_indices = np.where(lineage_total_rates > 0.0)[0]
-        positive_rates = lineage_total_rates[positive_rate_indices]
-        lineage_wait_times = [rng.expovariate(r) for r in positive_rates]
-        wait_time = np.min(lineage_wait_times)
-        if (max_time is not None) and (clock + wait_time > max_time):
-            clock = max_time
-            break
-        clock += wait_time
-        lineage_index = positive_rate_indices[np.argmin(lineage_wait_times)]
-        if lineage_index == len(lineage_total_rates) - 1:
-            # This is a burst event
-            if final_extension:
-                # We have the desired number of leaves and have extended the
-                # tree to the next diversification event
-                break
-            burst_times.append(clock)
-            # To avoid modifying `extant_nodes` while looping over it, we will
-            # keep track of which nodes need to be removed and added in these 2
-            # temporary lists:
-            extant_nodes_to_add = []
-            extant_nodes_to_remove = []
-            for node in extant_nodes:
-                current_state = node.leafward_state
-                burst_p = sdsd_model.burst_probs[current_state]
-                u = rng.random()
-                if u > burst_p:
-                    # This lineage does not diverge at this burst, so skip to
-                    # the next
-                    continue
-                n_children = 2
-                if not sdsd_model.only_bifurcate:
-                    burst_mean = sdsd_model.burst_furcation_poisson_means[current_state]
-                    burst_shift = sdsd_model.burst_furcation_poisson_shifts[current_state]
-                    pois_rv = rng_utils.poisson_rv(
-                            mean = burst_mean,
-                            rng = rng)
-                    n_children = pois_rv + burst_shift
-                assert n_children > 0
-                if n_children > 1:
-                    node.time = clock
-                    node.is_burst_node = True
-                    extant_nodes_to_remove.append(node)
-                    for i in range(n_children):
-                        child = Node(
-                            rootward_state = node.leafward_state,
-                        )
-                        node.add_child(child)
-                        extant_nodes_to_add.append(child)
-            for node in extant_nodes_to_remove:
-                # assert node in extant_nodes
-                extant_nodes.remove(node)
-                # assert node not in extant_nodes
-            # Debug sanity check
-            # for node in extant_nodes_to_add:
-            #     assert node not in extant_nodes
-            extant_nodes.extend(extant_nodes_to_add)
-        else:
-            # This is a lineage-specific event
-            lin_rates= lineage_rates[lineage_index]
-            event_index = rng_utils.get_weighted_index(lin_rates, rng)
+    return result.survived, result.tree, result.burst_times
 
-            if (event_index < 2) and final_extension:
-                # We have the desired number of leaves and have extended the
-                # tree to the next birth/death event
-                break
-            
-            if event_index == 0:
-                # lineage-specific birth event
-                node = extant_nodes[lineage_index]
-                node.time = clock
-                extant_nodes.remove(node)
-                for i in range(2):
-                    child = Node(
-                        rootward_state = node.leafward_state,
-                    )
-                    node.add_child(child)
-                    extant_nodes.append(child)
+def get_leaf_rejection_reason(
+    number_of_extant_leaves,
+    number_of_extinct_leaves,
+    max_extant_leaves = None,
+    max_extinct_leaves = None,
+    max_total_leaves = None,
+):
+    """
+    Get the reason a tree should be rejected under `max_leaves_strict`, given
+    its numbers of leaves.
 
-            elif event_index == 1:
-                # lineage-specific death event
-                node = extant_nodes[lineage_index]
-                node.time = clock
-                node.is_extinct = True
-                extant_nodes.remove(node)
-                extinct_nodes.append(node)
-                if len(extant_nodes) == 0:
-                    survived = False
-                    break
+    Parameters
+    ----------
+    number_of_extant_leaves, number_of_extinct_leaves : int
+        The numbers of leaves of the tree.
+    max_extant_leaves, max_extinct_leaves, max_total_leaves : int or None
+        The maximum numbers of leaves used to stop the simulation.
 
-            elif event_index == 2:
-                # lineage-specific state transition
-                node = extant_nodes[lineage_index]
-                current_state = node.leafward_state
-                new_state = sdsd_model.ctmc.draw_transition(current_state)
-                node.transition_state(new_state, clock)
+    Returns
+    -------
+    str or None
+        One of the `REJECTED_MAX_*` values, or None if the tree has no more
+        leaves than any of the maximums.
 
-            else:
-                raise ValueError(f"Unexpected event index: {event_index}")
-    # Populate leaf times and labels
-    extant_leaf_count = 0
-    extinct_leaf_count = 0
-    for node in root:
-        if node.time is None:
-            assert node.is_leaf
-            assert not node.is_extinct
-            node.time = clock
-        if node.is_leaf:
-            if node.is_extinct:
-                extinct_leaf_count += 1
-                node.label = f"XL{extinct_leaf_count}"
-            else:
-                extant_leaf_count += 1
-                node.label = f"L{extant_leaf_count}"
-    return survived, root, burst_times
+    >>> get_leaf_rejection_reason(12, 3, max_extant_leaves = 10)
+    'max_extant_leaves'
+    >>> get_leaf_rejection_reason(12, 3, max_total_leaves = 15) is None
+    True
+    """
+    if max_total_leaves and (
+            (number_of_extant_leaves + number_of_extinct_leaves)
+            > max_total_leaves):
+        return REJECTED_MAX_TOTAL_LEAVES
+    if max_extant_leaves and (number_of_extant_leaves > max_extant_leaves):
+        return REJECTED_MAX_EXTANT_LEAVES
+    # This should never happen, but checking in case we ever decide to
+    # allow shared extinction events
+    if max_extinct_leaves and (number_of_extinct_leaves > max_extinct_leaves):
+        return REJECTED_MAX_EXTINCT_LEAVES
+    return None
+
+def get_rejection_reason(
+    survived,
+    tree,
+    keep_extinct_trees = False,
+    max_leaves_strict = False,
+    max_extant_leaves = None,
+    max_extinct_leaves = None,
+    max_total_leaves = None,
+):
+    """
+    Get the reason a simulated tree should be rejected.
+
+    `SDSDTreeSimulator.simulate` applies the same rules while simulating, so
+    this is only needed for trees that were simulated without them.
+
+    Parameters
+    ----------
+    survived : bool
+        Whether the tree survived (had extant lineages at the end of the
+        simulation).
+    tree : `Node` or `ArrayTree` object
+        The simulated tree.
+    keep_extinct_trees : bool
+        If False, trees that did not survive are rejected.
+    max_leaves_strict : bool
+        If True, trees with more leaves than any of the maximum numbers of
+        leaves are rejected. The final burst event of a simulation can
+        overshoot these maximums.
+    max_extant_leaves, max_extinct_leaves, max_total_leaves : int or None
+        The maximum numbers of leaves used to stop the simulation.
+
+    Returns
+    -------
+    str or None
+        One of the `REJECTED_*` values, or None if the tree is accepted.
+    """
+    if (not survived) and (not keep_extinct_trees):
+        return REJECTED_EXTINCT
+    if max_leaves_strict:
+        return get_leaf_rejection_reason(
+            number_of_extant_leaves = tree.number_of_extant_leaves,
+            number_of_extinct_leaves = tree.number_of_extinct_leaves,
+            max_extant_leaves = max_extant_leaves,
+            max_extinct_leaves = max_extinct_leaves,
+            max_total_leaves = max_total_leaves,
+        )
+    return None
+
+def sim_SDSD_replicate(
+    simulator,
+    seed,
+    replicate_index,
+    root_state = None,
+    max_extant_leaves = 50,
+    max_extinct_leaves = None,
+    max_total_leaves = None,
+    max_time = None,
+    keep_extinct_trees = False,
+    max_leaves_strict = False,
+    as_array_tree = False,
+    condition_on_survival = False,
+    profile = None,
+):
+    """
+    Simulate one replicate of a batch of trees.
+
+    The replicate is seeded with `rng_utils.get_replicate_seed(seed,
+    replicate_index)`, so its outcome only depends on `seed` and
+    `replicate_index`.
+
+    Parameters
+    ----------
+    simulator : `SDSDTreeSimulator` object
+        The simulator to use.
+    seed : int
+        The master seed of the batch.
+    replicate_index : int
+        The index of the replicate.
+
+    See `sim_SDSD_tree`, `get_rejection_reason` and
+    `SDSDTreeSimulator.simulate` for the other parameters.
+
+    Returns
+    -------
+    `SimulatedTree` object
+        With `rejection` set following `get_rejection_reason`. The simulation
+        stops as soon as the replicate is certain to be rejected, so the
+        `tree` of a rejected replicate is None.
+    """
+    return simulator.simulate(
+        rng_seed = rng_utils.get_replicate_seed(seed, replicate_index),
+        root_state = root_state,
+        max_extant_leaves = max_extant_leaves,
+        max_extinct_leaves = max_extinct_leaves,
+        max_total_leaves = max_total_leaves,
+        max_time = max_time,
+        as_array_tree = as_array_tree,
+        keep_extinct_trees = keep_extinct_trees,
+        max_leaves_strict = max_leaves_strict,
+        condition_on_survival = condition_on_survival,
+        profile = profile,
+    )
+
+def sim_SDSD_trees(
+    n,
+    sdsd_model,
+    rng_seed = None,
+    root_state = None,
+    max_extant_leaves = 50,
+    max_extinct_leaves = None,
+    max_total_leaves = None,
+    max_time = None,
+    keep_extinct_trees = False,
+    max_leaves_strict = False,
+    engine = "direct",
+    as_array_tree = False,
+    rejection_callback = None,
+    rng_backend = "python",
+    condition_on_survival = False,
+    metrics = None,
+    profile = None,
+):
+    """
+    Simulate trees until `n` are accepted.
+
+    Replicates are simulated in order with `sim_SDSD_replicate`, and are
+    accepted or rejected following `get_rejection_reason`.
+
+    Parameters
+    ----------
+    n : int
+        The number of trees to accept.
+    sdsd_model : `SDSDModel` object
+        The model to simulate under.
+    rng_seed : int or None
+        The master seed from which the seed of each replicate is derived. If
+        None, a random seed is used.
+    rejection_callback : callable or None
+        If provided, it is called with the `SimulatedTree` object of each
+        rejected replicate.
+    rng_backend : str
+        One of `rng_utils.RNG_BACKENDS`; see `SDSDTreeSimulator`.
+    condition_on_survival : bool
+        If True, trees are conditioned on survival by importance sampling
+        rather than by rejection, and each accepted tree has a `log_weight`;
+        see `SDSDTreeSimulator.simulate`.
+    metrics : `metrics.SimulationMetrics` object or None
+        If provided, each replicate (and the time spent simulating it) is
+        recorded in it.
+    profile : `metrics.EventLoopProfile` object or None
+        If provided, the event loop of every replicate is profiled into it;
+        see `SDSDTreeSimulator.simulate`.
+
+    See `sim_SDSD_tree` and `get_rejection_reason` for the other parameters.
+
+    Yields
+    ------
+    `SimulatedTree` object
+        Each accepted tree.
+    """
+    if rng_seed is None:
+        rng_seed = rng_utils.get_safe_seed(random.Random())
+    simulator = SDSDTreeSimulator(sdsd_model, engine = engine,
+            rng_backend = rng_backend)
+    n_accepted = 0
+    replicate_index = 0
+    while n_accepted < n:
+        if metrics is not None:
+            start_time = time.perf_counter()
+        result = sim_SDSD_replicate(
+            simulator = simulator,
+            seed = rng_seed,
+            replicate_index = replicate_index,
+            root_state = root_state,
+            max_extant_leaves = max_extant_leaves,
+            max_extinct_leaves = max_extinct_leaves,
+            max_total_leaves = max_total_leaves,
+            max_time = max_time,
+            keep_extinct_trees = keep_extinct_trees,
+            max_leaves_strict = max_leaves_strict,
+            as_array_tree = as_array_tree,
+            condition_on_survival = condition_on_survival,
+            profile = profile,
+        )
+        replicate_index += 1
+        if metrics is not None:
+            metrics.record_replicate(result.rejection,
+                    number_of_events = result.number_of_events,
+                    stage_times = {
+                        "simulation": time.perf_counter() - start_time,
+                    })
+        if result.rejection is not None:
+            if rejection_callback is not None:
+                rejection_callback(result)
+            continue
+        n_accepted += 1
+        yield result
@@ -0,0 +1,518 @@
+#! /usr/bin/env python
+
+"""
+Parsing the Newick (and SIMMAP) trees written by `Node`.
+
+Branch annotations are either a SIMMAP state history (e.g., `:{0,0.5:1,0.2}`)
+or a plain branch length (e.g., `:0.7`), and when root annotations are
+included the tree is wrapped in an extra pair of parentheses so that the root
+branch can be annotated.
+
+The strings only store branch durations, so node times are rebuilt from a
+seed time of 0.0 (the seed time of simulated trees), choosing times that give
+back exactly the durations that were written. So, trees written with root
+annotations round trip to identical strings. Without root annotations, the
+time of the root is unknown (it is set to 0.0), and durations can differ in
+the last digit.
+"""
+
+import re
+import json
+import math
+import bisect
+import numpy as np
+
+from sdsdsim.node import Node
+from sdsdsim.array_tree import ArrayTree
+
+# Leading whitespace is skipped, followed by (1) a punctuation character, (2)
+# a SIMMAP state history, (3) a branch length, or (4) a label
+_TOKEN_PATTERN = re.compile(
+    r"\s*(?:([(),;])|:\{([^}]*)\}|:([^\s(),;:{}]+)|([^\s(),;:{}]+))"
+)
+_WHITESPACE_PATTERN = re.compile(r"\s*")
+
+# The max number of units in the last place to search, in each direction, for
+# a time that reproduces a duration exactly
+_MAX_ULPS = 8
+
+
+try:
+    from math import nextafter as _nextafter
+except ImportError:
+    # Python < 3.9
+    def _nextafter(x, y):
+        return float(np.nextafter(x, y))
+
+def _next_up(x):
+    return _nextafter(x, math.inf)
+
+def _next_down(x):
+    return _nextafter(x, -math.inf)
+
+def _get_times(start_time, duration):
+    """
+    Get the times that give back exactly `duration` when `start_time` is
+    subtracted from them.
+
+    Floating-point addition does not always undo the subtraction used to
+    calculate a duration, so the floats near `start_time + duration` are
+    searched. Because subtraction rounds, there can be more than one such time
+    (they are consecutive floats), or none (if the duration was not calculated
+    from `start_time`).
+
+    >>> _get_times(0.5, 0.25)
+    [0.75]
+    >>> _get_times(0.1, 0.2)
+    []
+    >>> _get_times(0.7382616710293373, 2.1615709957743237)
+    [2.899832666803661, 2.8998326668036607]
+    """
+    t = start_time + duration
+    # The difference `x - start_time` never decreases as `x` increases, so
+    # step toward the times that reproduce the duration
+    i = 0
+    while (t - start_time < duration) and (i < _MAX_ULPS):
+        t = _next_up(t)
+        i += 1
+    while (t - start_time > duration) and (i < _MAX_ULPS):
+        t = _next_down(t)
+        i += 1
+    if t - start_time != duration:
+        return []
+    times = [t]
+    up = _next_up(t)
+    while up - start_time == duration:
+        times.append(up)
+        up = _next_up(up)
+    down = _next_down(t)
+    while down - start_time == duration:
+        times.append(down)
+        down = _next_down(down)
+    return times
+
+def _find_burst_time(burst_times, time):
+    # Rebuilt times can be off by a few units in the last place, so look for a
+    # burst time (among the sorted `burst_times`) close to `time`
+    i = bisect.bisect_left(burst_times, time)
+    tolerance = _MAX_ULPS * float(np.spacing(time))
+    for j in (i, i - 1):
+        if (0 <= j < len(burst_times)) and (
+                abs(burst_times[j] - time) <= tolerance):
+            return burst_times[j]
+    return None
+
+def _solve_times(node, start_time, durations, burst_times, exact, solved,
+        failed):
+    """
+    Search for the times along the branch of `node` (the end time of each of
+    its `durations`) and the branches descending from it, given that the
+    branch starts at `start_time`.
+
+    This is a generator used as a coroutine by `_rebuild_times`: it yields
+    each (child, start time) pair that needs to be solved, is sent whether the
+    child was solved, and returns whether `node` was solved. If `exact` is
+    True, only times that give back the durations exactly are tried, and the
+    search backtracks when a descendant cannot be solved. Otherwise, if no
+    time gives back a duration exactly, `start_time + duration` is used.
+
+    An internal node whose time is close to one of the `burst_times` is a
+    burst node, so its time must be that burst time. If `exact` is True and
+    the burst time does not give back the duration, the search backtracks
+    (the times chosen for the ancestors can differ from the original times
+    by a unit in the last place, and still give back their durations).
+    """
+    if (node, start_time) in failed:
+        return False
+    children = node.children
+    n_times = max(len(durations), 1)
+
+    def get_candidates(i, t):
+        if not durations:
+            return [t]
+        times = _get_times(t, durations[i])
+        if (not times) and (not exact):
+            times = [t + durations[i]]
+        if burst_times and children and (i == n_times - 1) and times:
+            burst_time = _find_burst_time(burst_times, times[0])
+            if burst_time is not None:
+                if (not exact) or (burst_time in times):
+                    times = [burst_time]
+                else:
+                    times = []
+        return times
+
+    chosen = []
+    candidates = [iter(get_candidates(0, start_time))]
+    while candidates:
+        t = next(candidates[-1], None)
+        if t is None:
+            candidates.pop()
+            continue
+        del chosen[len(candidates) - 1:]
+        chosen.append(t)
+        if len(chosen) < n_times:
+            candidates.append(iter(get_candidates(len(chosen), t)))
+            continue
+        ok = True
+        for child in children:
+            ok = yield child, t
+            if not ok:
+                break
+        if ok:
+            solved[node] = chosen
+            return True
+    failed.add((node, start_time))
+    return False
+
+def _rebuild_times(root, durations, burst_times):
+    """
+    Get the end times of the branch segments of each node descending from
+    `root` (including the root), from the durations of the segments (a dict
+    mapping nodes to lists of durations).
+
+    The search for times that give back all the durations exactly runs
+    leafward from the root with an explicit stack of `_solve_times`
+    coroutines (rather than recursion), so the depth of the tree is not
+    limited by Python's recursion limit.
+    """
+    for exact in (True, False):
+        solved = {}
+        failed = set()
+        stack = [_solve_times(root, 0.0, durations.get(root, ()), burst_times,
+                exact, solved, failed)]
+        result = None
+        while stack:
+            try:
+                child, start_time = stack[-1].send(result)
+            except StopIteration as e:
+                stack.pop()
+                result = e.value
+                continue
+            stack.append(_solve_times(child, start_time,
+                    durations.get(child, ()), burst_times, exact, solved,
+                    failed))
+            result = None
+        if result:
+            return solved
+    raise AssertionError("Failed to rebuild node times")
+
+def _parse_history(annotation):
+    history = []
+    for item in annotation.split(":"):
+        state, duration = item.split(",")
+        history.append((int(state), float(duration)))
+    return history
+
+def parse_newick(
+    newick_string,
+    include_root_annotations = True,
+    burst_times = None,
+    as_array_tree = False,
+):
+    """
+    Parse a tree from a Newick string written by `Node`.
+
+    Parameters
+    ----------
+    newick_string : str
+        The Newick string of the tree (the trailing ';' is optional).
+    include_root_annotations : bool
+        Whether the root branch was annotated when the tree was written (the
+        argument of the same name passed to the `Node` writer). If True, the
+        extra pair of parentheses wrapping the tree is removed.
+    burst_times : iterable of float
+        The times of burst events. Internal nodes at these times are flagged
+        as burst nodes, and given these exact times (which also give back the
+        branch durations exactly, if the tree was written with these burst
+        times and root annotations).
+    as_array_tree : bool
+        If True, the tree is returned as an `ArrayTree` rather than as the
+        root `Node`.
+
+    Returns
+    -------
+    `Node` or `ArrayTree` object
+        The root of the tree (or the tree as an `ArrayTree`).
+
+    Leaves with labels starting with 'XL' are marked as extinct. Internal
+    node labels are not written by SDSDsim, so internal nodes (including the
+    root) are unlabeled unless the string has labels for them.
+
+    >>> root = parse_newick("((L1:{0,0.5:1,0.25},XL1:{0,0.5}):{0,1.0});")
+    >>> root.time, root.number_of_leaves, root.number_of_extinct_leaves
+    (1.0, 2, 1)
+    >>> root.children[0].state_changes
+    [(0, 1)]
+    >>> root.as_newick_string()
+    '((L1:{0,0.5:1,0.25},XL1:{0,0.5}):{0,1.0});'
+    """
+    root = None
+    open_nodes = []
+    annotations = {}
+    # The node that the next annotation or label belongs to
+    current = None
+    end = len(newick_string)
+    pos = 0
+    while pos < end:
+        match = _TOKEN_PATTERN.match(newick_string, pos)
+        if match is None:
+            if _WHITESPACE_PATTERN.match(newick_string, pos).end() == end:
+                break
+            raise ValueError(
+                f"Unexpected character in Newick string at position {pos}: "
+                f"{newick_string[pos:pos + 20]!r}"
+            )
+        pos = match.end()
+        punctuation, history, length, label = match.groups()
+        if punctuation == "(":
+            if (root is not None) and (not open_nodes):
+                raise ValueError("Newick string has more than one root")
+            node = Node()
+            if root is None:
+                root = node
+            else:
+                open_nodes[-1].add_child(node)
+            open_nodes.append(node)
+            current = None
+        elif punctuation == ")":
+            if not open_nodes:
+                raise ValueError(f"Unbalanced ')' at position {pos - 1}")
+            current = open_nodes.pop()
+            if not current.children:
+                raise ValueError(f"Empty node at position {pos - 1}")
+        elif punctuation == ",":
+            if not open_nodes:
+                raise ValueError(f"Unexpected ',' at position {pos - 1}")
+            current = None
+        elif punctuation == ";":
+            if newick_string[pos:].strip():
+                raise ValueError("Unexpected text after ';'")
+            break
+        if punctuation is not None:
+            continue
+        if current is None:
+            # A label or annotation of a new leaf
+            if (root is not None) and (not open_nodes):
+                raise ValueError("Newick string has more than one root")
+            current = Node(label = label)
+            if root is None:
+                root = current
+            else:
+                open_nodes[-1].add_child(current)
+        elif label is not None:
+            if (current.label is not None) or (current in annotations):
+                raise ValueError(f"Unexpected label {label!r}")
+            current.label = label
+        if (history is not None) or (length is not None):
+            if current in annotations:
+                raise ValueError(
+                    f"Unexpected branch annotation at position "
+                    f"{match.start()}"
+                )
+            if history is not None:
+                annotations[current] = _parse_history(history)
+            else:
+                annotations[current] = [(None, float(length))]
+    if root is None:
+        raise ValueError("Newick string has no tree")
+
+    if include_root_annotations:
+        # When the root is a leaf, the parentheses wrapping it are not closed
+        if (len(open_nodes) == 1) and (open_nodes[0] is root) and (
+                len(root.children) == 1) and root.children[0].is_leaf:
+            open_nodes.pop()
+        if (len(root.children) != 1) or (root in annotations):
+            raise ValueError(
+                "Newick string does not have the parentheses wrapping the "
+                "annotated root"
+            )
+        wrapper = root
+        root = wrapper.children[0]
+        wrapper.remove_child(root)
+    if open_nodes:
+        raise ValueError("Unbalanced '(' in Newick string")
+
+    if burst_times is not None:
+        burst_times = sorted(float(t) for t in burst_times)
+
+    durations = {node: [d for state, d in history]
+            for node, history in annotations.items()}
+    times = _rebuild_times(root, durations, burst_times)
+
+    root.seed_time = 0.0
+    for node in root:
+        history = annotations.get(node)
+        node_times = times[node]
+        if history is not None:
+            node.rootward_state = history[0][0]
+            for (state, d), t in zip(history[1:], node_times):
+                node.transition_state(state, t)
+        node.time = node_times[-1]
+        if node.children and burst_times:
+            burst_time = _find_burst_time(burst_times, node.time)
+            if burst_time is not None:
+                node.is_burst_node = True
+                node.time = burst_time
+        elif (node.label is not None) and node.label.startswith("XL"):
+            node.is_extinct = True
+
+    # An unannotated root gets the state at the start of its children's
+    # branches
+    if (root.rootward_state is None) and root.children:
+        root.rootward_state = root.children[0].rootward_state
+
+    if as_array_tree:
+        return ArrayTree.from_node(root)
+    return root
+
+def iter_newick_strings(stream, chunk_size = 1 << 20):
+    """
+    Iterate over the ';'-terminated Newick strings in a file stream.
+
+    The stream is read in chunks of `chunk_size` characters, so only one tree
+    (plus a chunk) is held in memory at a time. Whitespace around each tree is
+    stripped, and text after the last ';' is yielded if it is not blank.
+
+    >>> from io import StringIO
+    >>> list(iter_newick_strings(StringIO("(A:1,B:1);\\n(C:1,D:1);\\n")))
+    ['(A:1,B:1);', '(C:1,D:1);']
+    """
+    pieces = []
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        start = 0
+        while True:
+            end = chunk.find(";", start)
+            if end < 0:
+                pieces.append(chunk[start:])
+                break
+            pieces.append(chunk[start:end + 1])
+            yield "".join(pieces).strip()
+            pieces = []
+            start = end + 1
+    tail = "".join(pieces).strip()
+    if tail:
+        yield tail
+
+def iter_trees(
+    stream,
+    include_root_annotations = True,
+    burst_times = None,
+    as_array_tree = False,
+    chunk_size = 1 << 20,
+):
+    """
+    Iterate over the trees in a file stream of Newick strings written by
+    `Node`, parsing one tree at a time.
+
+    Parameters
+    ----------
+    burst_times : iterable of iterables of float
+        The burst times of each tree, in the same order as the trees (e.g., a
+        generator reading them from another file). It is consumed one tree at
+        a time, alongside the stream.
+
+    See `parse_newick` for a description of the other arguments.
+
+    Yields
+    ------
+    `Node` or `ArrayTree` object
+
+    >>> from io import StringIO
+    >>> stream = StringIO("((A:{0,1.0},B:{0,1.0}):{0,0.5});\\n" * 2)
+    >>> trees = iter_trees(stream, burst_times = iter([[], [0.5]]))
+    >>> [root.is_burst_node for root in trees]
+    [False, True]
+    """
+    if burst_times is not None:
+        burst_times = iter(burst_times)
+    for newick_string in iter_newick_strings(stream, chunk_size = chunk_size):
+        tree_burst_times = None
+        if burst_times is not None:
+            tree_burst_times = next(burst_times, None)
+            if tree_burst_times is None:
+                raise ValueError("There are fewer burst times than trees")
+        yield parse_newick(
+            newick_string,
+            include_root_annotations = include_root_annotations,
+            burst_times = tree_burst_times,
+            as_array_tree = as_array_tree,
+        )
+
+def _iter_yaml_samples(stream):
+    # The 'yaml' output of `sim-SDSD-trees` lists the samples under 'trees',
+    # after the header; each sample starts with a line beginning with '- '
+    # (the lines within a sample are indented), so the samples are loaded one
+    # at a time
+    import yaml
+    in_trees = False
+    lines = []
+    for line in stream:
+        if not in_trees:
+            in_trees = line.rstrip() == "trees:"
+            continue
+        if line.startswith("- ") and lines:
+            yield yaml.safe_load("".join(lines))[0]
+            lines = []
+        lines.append(line)
+    if lines:
+        yield yaml.safe_load("".join(lines))[0]
+
+def _iter_jsonl_samples(stream):
+    # The first line of the 'jsonl' output of `sim-SDSD-trees` is the header
+    for i, line in enumerate(stream):
+        if (i > 0) and line.strip():
+            yield json.loads(line)
+
+_SAMPLE_READERS = {
+    "yaml": _iter_yaml_samples,
+    "jsonl": _iter_jsonl_samples,
+}
+
+def iter_samples(stream, output_format = "yaml", as_array_tree = False):
+    """
+    Iterate over the samples in a file stream of the output of
+    `sim-SDSD-trees`, reading and parsing one sample at a time.
+
+    Parameters
+    ----------
+    stream : file object
+        The output, in text mode.
+    output_format : str
+        The format of the output ('yaml' or 'jsonl'; see the
+        `--output-format` option of `sim-SDSD-trees`). Archives are read with
+        `sdsdsim.archive.TreeArchiveReader` instead.
+    as_array_tree : bool
+        If True, the trees are returned as `ArrayTree` objects rather than as
+        root `Node` objects.
+
+    Yields
+    ------
+    tuple
+        The tree of each sample (parsed with its 'burst_times', so its burst
+        nodes are flagged) and the sample itself (a dict).
+
+    >>> from io import StringIO
+    >>> stream = StringIO(
+    ...     '{"seed": 1}\\n'
+    ...     '{"burst_times": [0.5], "tree": "((A:{0,1.0},B:{0,1.0}):{0,0.5});"}'
+    ...     '\\n')
+    >>> [(root.is_burst_node, sample["burst_times"])
+    ...         for root, sample in iter_samples(stream, "jsonl")]
+    [(True, [0.5])]
+    """
+    if output_format not in _SAMPLE_READERS:
+        raise ValueError(
+            f"Unknown output format '{output_format}'; expecting one of "
+            f"{tuple(_SAMPLE_READERS)}"
+        )
+    for sample in _SAMPLE_READERS[output_format](stream):
+        tree = parse_newick(
+            sample["tree"],
+            burst_times = sample.get("burst_times"),
+            as_array_tree = as_array_tree,
+        )
+        yield tree, sample
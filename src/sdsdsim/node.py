@@ -1,32 +1,122 @@
 #! /usr/bin/env python
 
-from io import StringIO
-import copy
 
 class Node(object):
+    """
+    A node of a tree, along with the branch leading to it.
+
+    Nodes use `__slots__` to keep their memory footprint small, and the lists
+    of state changes along the branch are only allocated when the first
+    change is added. `state_changes` and `state_change_times` always return a
+    new list (empty if there are no changes), so changing the returned list
+    does not change the node; use `transition_state`, or assign to the
+    properties, instead.
+
+    The number of leaves, extant leaves and the latest leaf time of the
+    subtree descending from each node are cached the first time they are
+    needed (for every node in the subtree at once), and the cache of a node
+    and its ancestors is cleared whenever the subtree changes. So, a node
+    whose cache is set only has descendants whose caches are set.
+    """
+
+    __slots__ = (
+        "_children",
+        "_parent",
+        "label",
+        "_time",
+        "_seed_time",
+        "rootward_state",
+        "_state_changes",
+        "_state_change_times",
+        "_is_extinct",
+        "is_burst_node",
+        "_aggregates",
+    )
 
     def __init__(self, **kwargs):
         self._children = []
         self._parent = None
+        self._aggregates = None
         self.label = kwargs.pop("label", None)
-        self.time = kwargs.pop("time", None)
+        self._time = kwargs.pop("time", None)
         self._seed_time = None
         self.rootward_state = kwargs.pop("rootward_state", None)
-        self.state_changes = []
-        self.state_change_times = []
-        self.is_extinct = False
+        self._state_changes = None
+        self._state_change_times = None
+        self._is_extinct = False
         self.is_burst_node = False
         if kwargs:
             raise TypeError(f"Unsupported keyword arguments: {kwargs}")
 
+    def _invalidate_aggregates(self):
+        node = self
+        while (node is not None) and (node._aggregates is not None):
+            node._aggregates = None
+            node = node._parent
+
+    def _get_aggregates(self):
+        """
+        Get the number of leaves, the number of extant leaves, and the latest
+        leaf time (ignoring leaves without a time) of the subtree descending
+        from this node, computing them in a single post-order pass over any
+        nodes without cached values.
+        """
+        if self._aggregates is None:
+            stack = [(self, False)]
+            while stack:
+                node, children_done = stack.pop()
+                if children_done:
+                    if not node._children:
+                        node._aggregates = (
+                            1,
+                            0 if node._is_extinct else 1,
+                            node._time,
+                        )
+                        continue
+                    n_leaves = 0
+                    n_extant = 0
+                    max_time = None
+                    for child in node._children:
+                        n, n_ex, t = child._aggregates
+                        n_leaves += n
+                        n_extant += n_ex
+                        if (t is not None) and (
+                                (max_time is None) or (t > max_time)):
+                            max_time = t
+                    node._aggregates = (n_leaves, n_extant, max_time)
+                elif node._aggregates is None:
+                    stack.append((node, True))
+                    stack.extend((c, False) for c in node._children)
+        return self._aggregates
+
+    def _get_time(self):
+        return self._time
+
+    def _set_time(self, time):
+        self._time = time
+        self._invalidate_aggregates()
+
+    time = property(_get_time, _set_time)
+
+    def _get_is_extinct(self):
+        return self._is_extinct
+
+    def _set_is_extinct(self, is_extinct):
+        self._is_extinct = is_extinct
+        self._invalidate_aggregates()
+
+    is_extinct = property(_get_is_extinct, _set_is_extinct)
+
     def _get_parent(self):
         return self._parent
 
     def _set_parent(self, node):
         if self._parent is not None:
+            self._parent._invalidate_aggregates()
             self._parent._children.remove(self)
         self._parent = node
         if self._parent is not None:
+            self._parent._invalidate_aggregates()
             if self not in self._parent._children:
                 self._parent._children.append(self)
 
@@ -40,32 +130,58 @@ class Node(object):
         node.parent = self
         if node not in self._children:
             self._children.append(node)
+        self._invalidate_aggregates()
 
     def remove_child(self, node):
         if node not in self._children:
             raise ValueError("Child node to remove is not a child")
+        self._invalidate_aggregates()
         node._parent = None
         self._children.remove(node)
 
+    def _get_state_changes(self):
+        if self._state_changes is None:
+            return []
+        return list(self._state_changes)
+
+    def _set_state_changes(self, state_changes):
+        self._state_changes = list(state_changes) if state_changes else None
+
+    state_changes = property(_get_state_changes, _set_state_changes)
+
+    def _get_state_change_times(self):
+        if self._state_change_times is None:
+            return []
+        return list(self._state_change_times)
+
+    def _set_state_change_times(self, times):
+        self._state_change_times = list(times) if times else None
+
+    state_change_times = property(_get_state_change_times,
+            _set_state_change_times)
+
     def _get_leafward_state(self):
-        if not self.state_changes:
+        if not self._state_changes:
             if self.rootward_state is None:
                 raise Exception("Node has no state")
             return self.rootward_state
         else:
-            return self.state_changes[-1][-1]
+            return self._state_changes[-1][-1]
 
     leafward_state = property(_get_leafward_state)
 
     def transition_state(self, new_state, time):
         transition = (self.leafward_state, new_state)
-        self.state_changes.append(transition)
-        self.state_change_times.append(time)
+        if self._state_changes is None:
+            self._state_changes = []
+            self._state_change_times = []
+        self._state_changes.append(transition)
+        self._state_change_times.append(time)
 
     def _get_leafward_state_history(self):
         if self.rootward_state is None:
             raise Exception("Node has no character-state history")
-        if len(self.state_changes) == 0:
+        if not self._state_changes:
             return ((self.rootward_state, self.branch_length),)
         history = []
         current_time = None
@@ -73,10 +189,10 @@ class Node(object):
             current_time = self.seed_time
         else:
             current_time = self.parent.time
-        for i, (current_state, next_state) in enumerate(self.state_changes):
-            duration = self.state_change_times[i] - current_time
+        for i, (current_state, next_state) in enumerate(self._state_changes):
+            duration = self._state_change_times[i] - current_time
             history.append((current_state, duration))
-            current_time = self.state_change_times[i]
+            current_time = self._state_change_times[i]
         assert next_state == self.leafward_state
         duration = self.time - current_time
         history.append((next_state, duration))
@@ -86,15 +202,12 @@ class Node(object):
 
     @staticmethod
     def as_simmap_string(node, include_label = True):
-        s = StringIO()
-        if (node.label is not None) and include_label:
-            s.write(f"{node.label}")
-        s.write(":{")
-        s.write(
-            ":".join(f"{k},{d}" for k, d in node.leafward_state_history)
+        history = ":".join(
+            f"{k},{d}" for k, d in node.leafward_state_history
         )
-        s.write("}")
-        return s.getvalue()
+        if (node.label is not None) and include_label:
+            return f"{node.label}:{{{history}}}"
+        return f":{{{history}}}"
 
     @staticmethod
     def as_length_string(node, include_label = True):
@@ -121,28 +234,18 @@ class Node(object):
         return self._seed_time
 
     def _get_n_leaves(self):
-        n = 0
-        for l in self.leaf_iter():
-            n += 1
-        return n
+        return self._get_aggregates()[0]
 
     number_of_leaves = property(_get_n_leaves)
 
     def _get_n_extant_leaves(self):
-        n = 0
-        for l in self.leaf_iter():
-            if not l.is_extinct:
-                n += 1
-        return n
+        return self._get_aggregates()[1]
 
     number_of_extant_leaves = property(_get_n_extant_leaves)
 
     def _get_n_extinct_leaves(self):
-        n = 0
-        for l in self.leaf_iter():
-            if l.is_extinct:
-                n += 1
-        return n
+        n_leaves, n_extant, max_time = self._get_aggregates()
+        return n_leaves - n_extant
 
     number_of_extinct_leaves = property(_get_n_extinct_leaves)
 
@@ -175,8 +278,7 @@ class Node(object):
     root = property(_get_root)
 
     def _get_max_time(self):
-        r = self.root
-        return max(leaf.time for leaf in r.leaf_iter())
+        return self.root._get_aggregates()[2]
 
     max_time = property(_get_max_time)
 
@@ -277,27 +379,51 @@ class Node(object):
             if node is not None:
                 yield node
 
-    def _write_newick(self, out, include_root_annotations, branch_annot_func):
-        if self.is_root and include_root_annotations:
-            out.write("(")
-        if self.is_leaf:
-            out.write(f"{branch_annot_func(self, include_label = True)}")
-        else:
-            out.write("(");
-            for i, child in enumerate(self._children):
-                if i > 0:
-                    out.write(",")
-                child._write_newick(
-                    out = out,
-                    include_root_annotations = include_root_annotations,
-                    branch_annot_func = branch_annot_func,
-                )
-            if self.is_root and (not include_root_annotations):
-                out.write(f")");
+    def _get_newick_pieces(self, include_root_annotations, branch_annot_func):
+        """
+        Get the pieces of the Newick string of the tree descending from this
+        node, in order.
+
+        The tree is traversed with an explicit stack (rather than recursion),
+        so the depth of the tree is not limited by Python's recursion limit.
+        The stack holds nodes still to be expanded and strings ready to be
+        output.
+        """
+        pieces = []
+        stack = [self]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                pieces.append(item)
+                continue
+            node = item
+            wrap_root = (node._parent is None) and include_root_annotations
+            if wrap_root:
+                pieces.append("(")
+            children = node._children
+            if not children:
+                pieces.append(branch_annot_func(node, include_label = True))
+                continue
+            pieces.append("(")
+            # Push what follows the children first, so it is popped last
+            if wrap_root:
+                stack.append(")")
+            if (node._parent is None) and (not include_root_annotations):
+                stack.append(")")
             else:
-                out.write(f"){branch_annot_func(self, include_label = False)}");
-            if self.is_root and include_root_annotations:
-                out.write(f")");
+                stack.append(
+                    ")" + branch_annot_func(node, include_label = False))
+            for i in range(len(children) - 1, 0, -1):
+                stack.append(children[i])
+                stack.append(",")
+            stack.append(children[0])
+        return pieces
+
+    def _write_newick(self, out, include_root_annotations, branch_annot_func):
+        out.write("".join(self._get_newick_pieces(
+            include_root_annotations = include_root_annotations,
+            branch_annot_func = branch_annot_func,
+        )))
 
     def write_newick_simmap(self, out, include_root_annotations = True):
         self._write_newick(
@@ -317,14 +443,12 @@ class Node(object):
         self.write_newick_simmap(out, include_root_annotations)
 
     def _as_newick_string(self, include_root_annotations, branch_annot_func):
-        out = StringIO()
-        self._write_newick(
-            out = out,
+        pieces = self._get_newick_pieces(
             include_root_annotations = include_root_annotations,
             branch_annot_func = branch_annot_func,
         )
-        out.write(";")
-        return out.getvalue()
+        pieces.append(";")
+        return "".join(pieces)
 
     def as_newick_simmap_string(self, include_root_annotations = True):
         return self._as_newick_string(
@@ -345,48 +469,137 @@ class Node(object):
         return self.as_newick_string()
 
     def _get_has_extant_leaves(self):
-        for node in self.leaf_iter():
-            if not node.is_extinct:
-                return True
-        return False
+        return self._get_aggregates()[1] > 0
 
     has_extant_leaves = property(_get_has_extant_leaves)
 
-    def _prune_first_extinct_clade(self, node):
-        for n in node.leafward_iter():
-            if not n.has_extant_leaves:
-                p = n.parent
-                p.remove_child(n)
-                return n
-        return None
+    def _copy_without_relatives(self):
+        node = Node(
+            label = self.label,
+            time = self.time,
+            rootward_state = self.rootward_state,
+        )
+        node.state_changes = self._state_changes
+        node.state_change_times = self._state_change_times
+        node.is_extinct = self.is_extinct
+        node.is_burst_node = self.is_burst_node
+        return node
 
-    def prune_extinct_leaves(self):
-        if not self.has_extant_leaves:
-            return None
-        new_root = copy.deepcopy(self)
-        pruned = True
-        while pruned is not None:
-            pruned = self._prune_first_extinct_clade(new_root)
-        return new_root.remove_unifurcations()
-
-    def remove_unifurcations(self):
-        new_root = copy.deepcopy(self)
-        uni_nodes = [n for n in new_root if len(n._children) == 1]
-        for node in uni_nodes:
-            child = node._children[0]
-            child.rootward_state = node.rootward_state
-            child.state_changes = node.state_changes + child.state_changes
-            child.state_change_times = node.state_change_times + child.state_change_times
-            if node.parent is not None:
-                p = node.parent
-                p._children.remove(node)
-                p.add_child(child)
-                node._parent = None
-                node._children = []
+    def _rebuild(self, get_kept_children, in_place):
+        """
+        Rebuild the tree descending from this node in a single pre-order
+        pass, keeping only the children returned by `get_kept_children` and
+        merging each chain of unifurcations into its leafward-most node.
+
+        The merged node takes the rootward state of the top of the chain, the
+        state changes along the whole chain and, if the chain starts at this
+        node, its seed time.
+
+        Children that are the top of a chain of unifurcations are placed
+        after their siblings (keeping their relative order), which matches
+        the order the previous, iterative implementation of
+        `remove_unifurcations` produced.
+        """
+        if in_place and (not self.is_root):
+            raise ValueError("Can only rebuild a tree in place from its root")
+
+        def resolve(node):
+            top = node
+            state_changes = []
+            state_change_times = []
+            kids = get_kept_children(node)
+            while len(kids) == 1:
+                state_changes.extend(node._state_changes or ())
+                state_change_times.extend(node._state_change_times or ())
+                node = kids[0]
+                kids = get_kept_children(node)
+            if in_place:
+                new_node = node
             else:
-                assert node is new_root
-                child._seed_time = node._seed_time
-                child._parent = None
-                node._children = []
-                new_root = child
+                new_node = node._copy_without_relatives()
+            if node is not top:
+                new_node.rootward_state = top.rootward_state
+                new_node.state_changes = (
+                    state_changes + node.state_changes)
+                new_node.state_change_times = (
+                    state_change_times + node.state_change_times)
+            new_node._children = []
+            new_node._aggregates = None
+            # Non-unifurcating children first, then unifurcating ones
+            kids = (
+                [k for k in kids if len(get_kept_children(k)) != 1] +
+                [k for k in kids if len(get_kept_children(k)) == 1]
+            )
+            return new_node, kids
+
+        new_root, kids = resolve(self)
+        new_root._parent = None
+        new_root._seed_time = self._seed_time
+        stack = [(new_root, kids)]
+        while stack:
+            new_parent, kids = stack.pop()
+            for kid in kids:
+                new_node, grandkids = resolve(kid)
+                new_node._parent = new_parent
+                new_parent._children.append(new_node)
+                if grandkids:
+                    stack.append((new_node, grandkids))
         return new_root
+
+    def prune_extinct_leaves(self, in_place = False):
+        """
+        Get the tree descending from this node with all the extinct leaves
+        (and any unifurcations this leaves behind) removed.
+
+        The number of extant leaves below each node is counted (and cached) in
+        a single post-order pass, and the pruned tree is then built in a single pre-order pass
+        (see `remove_unifurcations` for how unifurcations are merged).
+
+        Parameters
+        ----------
+        in_place : bool
+            If True, the tree is pruned in place rather than copied. This is
+            only supported from the root, and the root of the pruned tree can
+            differ from this node.
+
+        Returns
+        -------
+        `Node` object or None
+            The root of the pruned tree, or None if there are no extant
+            leaves.
+        """
+        # This caches the number of extant leaves below every node
+        if not self.has_extant_leaves:
+            return None
+        return self._rebuild(
+            get_kept_children = lambda n: [
+                c for c in n._children if c._aggregates[1] > 0
+            ],
+            in_place = in_place,
+        )
+
+    def remove_unifurcations(self, in_place = False):
+        """
+        Get the tree descending from this node with each unifurcating node
+        merged into its child.
+
+        The child takes the rootward state and state changes of the merged
+        node (ahead of its own), and, if the merged node is the root, its
+        seed time.
+
+        Parameters
+        ----------
+        in_place : bool
+            If True, the tree is modified in place rather than copied. This is
+            only supported from the root, and the root of the returned tree
+            can differ from this node.
+
+        Returns
+        -------
+        `Node` object
+            The root of the tree without unifurcations.
+        """
+        return self._rebuild(
+            get_kept_children = lambda n: n._children,
+            in_place = in_place,
+        )
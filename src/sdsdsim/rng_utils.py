@@ -2,6 +2,9 @@
 
 import sys
 import math
+import random
+import hashlib
+import numpy as np
 
 from sdsdsim import math_utils, GLOBAL_RNG
 
@@ -10,9 +13,140 @@ MAX_FLOAT = sys.float_info.max
 LN_MIN_FLOAT = math.log(MIN_FLOAT)
 LN_MAX_FLOAT = math.log(MAX_FLOAT)
 
+# The random number generators that simulations can be driven by; see
+# `get_rng`
+RNG_BACKENDS = ("python", "numpy")
+
+
+class NumpyRNG(object):
+    """
+    A random number generator backed by a `numpy.random.Generator`.
+
+    It provides the methods of `random.Random` that are used in `sdsdsim`
+    (`random`, `expovariate`, `randrange` and `randint`), so it can be used
+    wherever a `random.Random` object is expected. Uniform numbers for these
+    scalar methods are drawn from the generator in blocks of `BUFFER_SIZE`,
+    because each call into numpy is costly. The bulk functions of this module
+    (e.g., `poisson_rvs` and `bernoulli_indices`) draw directly from
+    `generator` in a single vectorized call.
+
+    The stream of numbers only depends on the seed, but differs from that of
+    a `random.Random` object with the same seed.
+
+    Parameters
+    ----------
+    seed : int, float, str or None
+        The seed of the generator. Seeds that are not integers are hashed
+        with SHA-256 (rather than `hash`, which varies across processes for
+        strings), so a seed gives the same stream in every process. As with
+        `random.Random`, the sign of integer seeds is ignored, so `-k` and `k`
+        give the same stream. If None, the generator is seeded from the
+        operating system.
+
+    >>> rng1 = NumpyRNG(1)
+    >>> rng2 = NumpyRNG(1)
+    >>> [rng1.random() for i in range(3)] == [rng2.random() for i in range(3)]
+    True
+    >>> 0 <= rng1.randrange(10) < 10
+    True
+    """
+
+    BUFFER_SIZE = 1024
+
+    def __init__(self, seed = None):
+        if (seed is not None) and (not isinstance(seed, int)):
+            digest = hashlib.sha256(repr(seed).encode("utf-8")).digest()
+            seed = int.from_bytes(digest[:8], "big")
+        if seed is not None:
+            # Ignore the sign, like `random.Random` (numpy rejects negative
+            # seeds)
+            seed = abs(seed)
+        self.generator = np.random.default_rng(seed)
+        self._buffer = []
+        self._index = 0
+
+    def random(self):
+        """
+        Draw a uniform number from [0, 1).
+        """
+        i = self._index
+        if i >= len(self._buffer):
+            self._buffer = self.generator.random(self.BUFFER_SIZE).tolist()
+            i = 0
+        self._index = i + 1
+        return self._buffer[i]
+
+    def expovariate(self, lambd):
+        """
+        Draw an exponential random variable with rate `lambd`.
+        """
+        return -math.log(1.0 - self.random()) / lambd
+
+    def randrange(self, start, stop = None):
+        """
+        Draw an integer from `range(start, stop)`, or `range(start)` if `stop`
+        is None.
+        """
+        if stop is None:
+            start, stop = 0, start
+        width = stop - start
+        if width < 1:
+            raise ValueError(f"Empty range for randrange ({start}, {stop})")
+        return start + int(self.random() * width)
+
+    def randint(self, a, b):
+        """
+        Draw an integer from [`a`, `b`].
+        """
+        return self.randrange(a, b + 1)
+
+def get_rng(seed = None, backend = "python"):
+    """
+    Get a seeded random number generator.
+
+    Parameters
+    ----------
+    seed : int, float, str or None
+        The seed of the generator.
+    backend : str
+        One of `RNG_BACKENDS`. With "python", the generator is a
+        `random.Random` object. With "numpy", the generator is a `NumpyRNG`
+        object, for which the bulk functions of this module use vectorized
+        draws.
+
+    Returns
+    -------
+    `random.Random` or `NumpyRNG` object
+
+    >>> get_rng(1).random() == random.Random(1).random()
+    True
+    >>> get_rng(1, "numpy").random() == get_rng(1, "numpy").random()
+    True
+    """
+    if backend == "python":
+        return random.Random(seed)
+    if backend == "numpy":
+        return NumpyRNG(seed)
+    raise ValueError(
+        f"Unknown RNG backend '{backend}'; expecting one of {RNG_BACKENDS}"
+    )
+
 def get_weighted_index(weights, rng = None):
-    total_weight = sum(weights)
-    return get_prob_index([w / total_weight for w in weights], rng)
+    if not rng:
+        rng = GLOBAL_RNG
+    # Scale the uniform draw by the total weight, rather than normalizing
+    # every weight
+    u = rng.random() * sum(weights)
+    for i, w in enumerate(weights):
+        u -= w
+        if u < 0.0:
+            return i
+    # Rounding error left `u` at (or just above) zero; return the last index
+    # with a positive weight
+    for i in range(len(weights) - 1, -1, -1):
+        if weights[i] > 0.0:
+            return i
+    return i
 
 def get_prob_index(probs, rng = None):
     assert math_utils.is_zero(1.0 - sum(probs))
@@ -26,25 +160,257 @@ def get_prob_index(probs, rng = None):
     assert math_utils.is_zero(u), print(u)
     return i
 
-def poisson_rv(mean, rng = None):
-    assert mean > 0.0
+def weighted_indices(weights, n, rng = None):
+    """
+    Draw `n` indices in proportion to their weights.
+
+    Parameters
+    ----------
+    weights : sequence of float
+        The (non-negative) weight of each index.
+    n : int
+        The number of indices to draw.
+    rng : `random.Random` or `NumpyRNG` object
+        The random number generator to use.
+
+    Returns
+    -------
+    list of int
+
+    >>> rng = get_rng(1, "numpy")
+    >>> sorted(set(weighted_indices([1.0, 0.0, 3.0], 100, rng)))
+    [0, 2]
+    """
+    if not rng:
+        rng = GLOBAL_RNG
+    if isinstance(rng, NumpyRNG):
+        weights = np.asarray(weights, dtype = float)
+        cumulative = np.cumsum(weights)
+        u = rng.generator.random(n) * cumulative[-1]
+        indices = np.searchsorted(cumulative, u, side = "right")
+        # Rounding error can leave `u` at (or just above) the total
+        last_index = int(np.flatnonzero(weights > 0.0)[-1])
+        return np.minimum(indices, last_index).tolist()
+    return [get_weighted_index(weights, rng) for i in range(n)]
+
+def uniform_rvs(n, rng = None):
+    """
+    Draw `n` uniform random numbers from [0, 1).
+
+    Parameters
+    ----------
+    n : int
+        The number of variates to draw.
+    rng : `random.Random` or `NumpyRNG` object
+        The random number generator to use.
+
+    Returns
+    -------
+    list of float
+    """
+    if not rng:
+        rng = GLOBAL_RNG
+    if isinstance(rng, NumpyRNG):
+        return rng.generator.random(n).tolist()
+    return [rng.random() for i in range(n)]
+
+def exponential_rvs(rates, rng = None):
+    """
+    Draw an exponential random variable for each of `rates`.
+
+    Parameters
+    ----------
+    rates : sequence of float
+        The (positive) rate of each variate.
+    rng : `random.Random` or `NumpyRNG` object
+        The random number generator to use.
+
+    Returns
+    -------
+    list of float
+    """
+    if not rng:
+        rng = GLOBAL_RNG
+    if isinstance(rng, NumpyRNG):
+        rates = np.asarray(rates, dtype = float)
+        return (rng.generator.standard_exponential(len(rates)) / rates
+                ).tolist()
+    return [rng.expovariate(r) for r in rates]
+
+class AliasSampler(object):
+    """
+    Draws indices in proportion to a fixed set of weights, in constant time
+    per draw.
+
+    The alias tables (Vose's version of Walker's alias method) are built once
+    from the weights, in linear time. Each draw then takes a single uniform
+    number, regardless of the number of weights, so a sampler should be built
+    once and reused whenever the same weights are drawn from repeatedly.
+
+    Parameters
+    ----------
+    weights : sequence of float
+        The (non-negative) weight of each index. Indices with zero weight are
+        never drawn.
+
+    >>> import random
+    >>> sampler = AliasSampler([1.0, 0.0, 3.0])
+    >>> len(sampler)
+    3
+    >>> rng = random.Random(1)
+    >>> sorted(set(sampler.draw(rng) for i in range(1000)))
+    [0, 2]
+    """
+
+    __slots__ = ("_n", "_probs", "_aliases")
+
+    def __init__(self, weights):
+        weights = [float(w) for w in weights]
+        n = len(weights)
+        if n < 1:
+            raise ValueError("AliasSampler requires at least one weight")
+        if any((w < 0.0) or (not math.isfinite(w)) for w in weights):
+            raise ValueError("AliasSampler weights must be finite and "
+                    "non-negative")
+        total_weight = sum(weights)
+        if total_weight <= 0.0:
+            raise ValueError("AliasSampler requires a positive weight")
+        # Scale the weights so they average 1, and pair each index with a
+        # scaled weight below 1 ("small") with an index above 1 ("large")
+        # that fills the rest of its column
+        scaled = [w * n / total_weight for w in weights]
+        probs = [0.0] * n
+        aliases = list(range(n))
+        small = [i for i, w in enumerate(scaled) if w < 1.0]
+        large = [i for i, w in enumerate(scaled) if w >= 1.0]
+        while small and large:
+            i = small.pop()
+            j = large[-1]
+            probs[i] = scaled[i]
+            aliases[i] = j
+            scaled[j] -= 1.0 - scaled[i]
+            if scaled[j] < 1.0:
+                small.append(large.pop())
+        # What is left over should have a scaled weight of 1, up to rounding
+        # error. An index with zero weight must never be drawn, though, so it
+        # is aliased to the index with the largest weight
+        max_index = max(range(n), key = lambda i: weights[i])
+        for i in small + large:
+            if weights[i] > 0.0:
+                probs[i] = 1.0
+            else:
+                probs[i] = 0.0
+                aliases[i] = max_index
+        self._n = n
+        self._probs = probs
+        self._aliases = aliases
+
+    def __len__(self):
+        return self._n
+
+    def draw(self, rng = None):
+        """
+        Draw an index in proportion to its weight.
+
+        Parameters
+        ----------
+        rng : `random.Random` object
+            An instance of a `random.Random` object
+
+        Returns
+        -------
+        int
+        """
+        if not rng:
+            rng = GLOBAL_RNG
+        # A single uniform number picks both the column and whether to take
+        # its alias
+        u = rng.random() * self._n
+        i = int(u)
+        if (u - i) < self._probs[i]:
+            return i
+        return self._aliases[i]
+
+def bernoulli_indices(n, p, rng = None):
+    """
+    Get the indices of the successes among `n` Bernoulli trials with
+    probability of success `p`.
+
+    Rather than drawing a uniform number for each trial, the gaps between
+    successes are drawn from a geometric distribution, so the number of draws
+    scales with the number of successes rather than the number of trials. With
+    a `NumpyRNG`, a uniform number is drawn for every trial instead, in a
+    single vectorized call.
+
+    Parameters
+    ----------
+    n : int
+        The number of trials.
+    p : float
+        The probability of success of each trial.
+    rng : `random.Random` or `NumpyRNG` object
+        The random number generator to use.
+
+    Returns
+    -------
+    list
+        The (sorted) indices of the successful trials.
+    """
+    if (n < 1) or (p <= 0.0):
+        return []
+    if p >= 1.0:
+        return list(range(n))
     if not rng:
         rng = GLOBAL_RNG
-    neg_mean = -mean
-    n_divs = 1
-    if neg_mean < LN_MIN_FLOAT:
-        n_divs = 1
-        while neg_mean < LN_MIN_FLOAT:
-            n_divs += 1
-            neg_mean = -mean / n_divs
-        n = 0
-        for i in range(n_divs):
-            n += poisson_rv(-neg_mean, rng)
-        return n
-    L = math.exp(neg_mean)
+    if isinstance(rng, NumpyRNG):
+        return np.flatnonzero(rng.generator.random(n) < p).tolist()
+    ln_q = math.log1p(-p)
+    indices = []
+    i = -1
+    while True:
+        # Number of failures before the next success
+        i += 1 + int(math.log(1.0 - rng.random()) / ln_q)
+        if i >= n:
+            return indices
+        indices.append(i)
+
+# Means at or above which Poisson variates are drawn by transformed rejection
+# (PTRS) rather than by Knuth's multiplication method. Below it, the exp(-mean)
+# of Knuth's method is far from underflowing.
+PTRS_MIN_MEAN = 10.0
+
+def _get_ptrs_constants(mean):
+    # The constants of the PTRS algorithm of Hörmann (1993), "The transformed
+    # rejection method for generating Poisson random variables", Insurance:
+    # Mathematics and Economics 12:39-45
+    sqrt_mean = math.sqrt(mean)
+    b = 0.931 + (2.53 * sqrt_mean)
+    a = -0.059 + (0.02483 * b)
+    ln_inv_alpha = math.log(1.1239 + (1.1328 / (b - 3.4)))
+    v_r = 0.9277 - (3.6224 / (b - 2.0))
+    return math.log(mean), a, b, ln_inv_alpha, v_r
+
+def _draw_ptrs_poisson(mean, constants, rng):
+    ln_mean, a, b, ln_inv_alpha, v_r = constants
+    while True:
+        u = rng.random() - 0.5
+        v = rng.random()
+        us = 0.5 - abs(u)
+        k = math.floor((((2.0 * a / us) + b) * u) + mean + 0.43)
+        if (us >= 0.07) and (v <= v_r):
+            return k
+        if (k < 0) or ((us < 0.013) and (v > us)):
+            continue
+        # A `v` of zero (log of -inf) is always accepted
+        if (v == 0.0) or (
+                (math.log(v) + ln_inv_alpha - math.log((a / (us * us)) + b))
+                <= (-mean + (k * ln_mean) - math.lgamma(k + 1))):
+            return k
+
+def _draw_knuth_poisson(exp_neg_mean, rng):
     p = 1.0
     k = 0.0
-    while p >= L:
+    while p >= exp_neg_mean:
         k = k + 1.0
         u = rng.random()
         p = p * u
@@ -53,6 +419,72 @@ def poisson_rv(mean, rng = None):
         raise Exception("Poisson draw was larger than maxsize")
     return int(n)
 
+def poisson_rv(mean, rng = None):
+    """
+    Draw a Poisson random variable.
+
+    For means below `PTRS_MIN_MEAN`, Knuth's multiplication method is used,
+    which takes about `mean` + 1 uniform draws. For larger means, the
+    transformed rejection method (PTRS) of Hörmann (1993) is used, which takes
+    roughly 2.2 to 2.5 uniform draws on average, however large the mean is.
+
+    Parameters
+    ----------
+    mean : float
+        The (positive) mean of the Poisson distribution.
+    rng : `random.Random` object
+        An instance of a `random.Random` object
+
+    Returns
+    -------
+    int
+    """
+    assert mean > 0.0
+    if not rng:
+        rng = GLOBAL_RNG
+    if mean >= PTRS_MIN_MEAN:
+        return _draw_ptrs_poisson(mean, _get_ptrs_constants(mean), rng)
+    return _draw_knuth_poisson(math.exp(-mean), rng)
+
+def poisson_rvs(mean, n, rng = None):
+    """
+    Draw `n` Poisson random variables with the same mean.
+
+    The variates are the same as those of `n` consecutive calls to
+    `poisson_rv` with the same `rng`, but the setup shared by the draws is
+    only done once. With a `NumpyRNG`, the variates are drawn by its
+    generator in a single vectorized call instead.
+
+    Parameters
+    ----------
+    mean : float
+        The (positive) mean of the Poisson distribution.
+    n : int
+        The number of variates to draw.
+    rng : `random.Random` or `NumpyRNG` object
+        The random number generator to use.
+
+    Returns
+    -------
+    list of int
+
+    >>> import random
+    >>> rng1 = random.Random(1)
+    >>> rng2 = random.Random(1)
+    >>> poisson_rvs(20.0, 5, rng1) == [poisson_rv(20.0, rng2) for i in range(5)]
+    True
+    """
+    assert mean > 0.0
+    if not rng:
+        rng = GLOBAL_RNG
+    if isinstance(rng, NumpyRNG):
+        return rng.generator.poisson(mean, n).tolist()
+    if mean >= PTRS_MIN_MEAN:
+        constants = _get_ptrs_constants(mean)
+        return [_draw_ptrs_poisson(mean, constants, rng) for i in range(n)]
+    exp_neg_mean = math.exp(-mean)
+    return [_draw_knuth_poisson(exp_neg_mean, rng) for i in range(n)]
+
 def get_safe_seed(rng):
     """
     Get a random seed (int) between 0 and 2^31, which is safe to write and read
@@ -70,3 +502,31 @@ def get_safe_seed(rng):
         A random integer from the range 1 to 2^31-1 (inclusive)
     """
     return rng.randint(1, (2**31)-1)
+
+def get_replicate_seed(seed, replicate_index):
+    """
+    Get the random seed (int) for a replicate of a simulation.
+
+    The seed is derived from the master seed and the index of the replicate
+    alone, so each replicate can be simulated independently (e.g., in
+    parallel or after a restart) and still get the same seed.
+
+    Parameters
+    ----------
+    seed : int
+        The master seed of the simulation.
+    replicate_index : int
+        The index of the replicate.
+
+    Returns
+    -------
+    int
+        A random integer from the range 0 to 2^64-1 (inclusive)
+
+    >>> get_replicate_seed(1, 0) == get_replicate_seed(1, 0)
+    True
+    >>> get_replicate_seed(1, 0) == get_replicate_seed(1, 1)
+    False
+    """
+    key = f"{seed}:{replicate_index}".encode("ascii")
+    return int.from_bytes(hashlib.sha256(key).digest()[:8], "big")
@@ -0,0 +1,178 @@
+#! /usr/bin/env python
+
+import os
+import sys
+import random
+import pytest
+import numpy as np
+
+from sdsdsim import archive, array_tree, model
+
+
+def write_archive(path, trees, finish = True):
+    with open(path, "wb") as stream:
+        writer = archive.TreeArchiveWriter(stream, metadata = {"seed": 1})
+        for root, burst_times in trees:
+            writer.write_tree(root, burst_times)
+        if finish:
+            writer.finish()
+
+
+class TestTreeArchive:
+    def test_round_trip(self, tmp_path):
+        sdsd_model = model.SDSDModel(
+                q = [
+                    [-1.0, 1.0],
+                    [1.0, -1.0],
+                ],
+                birth_rates = [1.0, 2.0],
+                death_rates = [0.5, 0.8],
+                burst_rate = 1.0,
+                burst_probs = [0.1, 0.5],
+                burst_furcation_poisson_means = [1.0, 2.0],
+                burst_furcation_poisson_shifts = [2, 2],
+                only_bifurcate = False,
+                )
+        rng = random.Random(1)
+        trees = []
+        for i in range(30):
+            survived, root, burst_times = model.sim_SDSD_tree(
+                    rng_seed = rng.random(),
+                    sdsd_model = sdsd_model,
+                    max_extant_leaves = rng.randint(1, 30),
+                    )
+            trees.append((root, burst_times))
+        path = str(tmp_path / "trees.archive")
+        write_archive(path, trees)
+        with archive.TreeArchiveReader(path) as reader:
+            assert reader.metadata == {"seed": 1}
+            assert len(reader) == len(trees)
+            for (root, burst_times), tree in zip(trees, reader):
+                expected = array_tree.ArrayTree.from_node(root)
+                for name in ("parent", "child_offsets", "children", "time",
+                        "rootward_state", "flags", "state_change_offsets",
+                        "state_change_states", "state_change_times"):
+                    assert np.array_equal(getattr(tree, name),
+                            getattr(expected, name))
+                assert tree.labels == expected.labels
+                assert tree.seed_time == expected.seed_time
+                assert tree.to_node().as_newick_string() == (
+                        root.as_newick_string())
+            # Random access
+            for i in (7, 0, -1, 12):
+                root, burst_times = trees[i]
+                assert reader[i].to_node().as_newick_string() == (
+                        root.as_newick_string())
+                assert list(reader.get_burst_times(i)) == list(burst_times)
+
+    def test_get_column(self, tmp_path):
+        sdsd_model = model.SDSDModel(
+                q = [
+                    [-1.0, 1.0],
+                    [1.0, -1.0],
+                ],
+                birth_rates = [1.0, 2.0],
+                death_rates = [0.5, 0.8],
+                burst_rate = 1.0,
+                burst_probs = [0.1, 0.5],
+                burst_furcation_poisson_means = [1.0, 2.0],
+                burst_furcation_poisson_shifts = [2, 2],
+                only_bifurcate = False,
+                )
+        rng = random.Random(1)
+        trees = []
+        for i in range(5):
+            survived, root, burst_times = model.sim_SDSD_tree(
+                    rng_seed = rng.random(),
+                    sdsd_model = sdsd_model,
+                    max_extant_leaves = rng.randint(1, 30),
+                    )
+            trees.append((root, burst_times))
+        path = str(tmp_path / "trees.archive")
+        write_archive(path, trees)
+        with archive.TreeArchiveReader(path) as reader:
+            for i, (root, burst_times) in enumerate(trees):
+                times = reader.get_column(i, "time")
+                assert isinstance(times, np.memmap)
+                assert list(times) == [n.time for n in root]
+                flags = reader.get_column(i, "flags")
+                assert list(flags & array_tree.ArrayTree.EXTINCT > 0) == [
+                        n.is_extinct for n in root]
+            with pytest.raises(ValueError):
+                reader.get_column(0, "children")
+
+    def test_unfinished(self, tmp_path):
+        sdsd_model = model.SDSDModel(
+                q = [
+                    [-1.0, 1.0],
+                    [1.0, -1.0],
+                ],
+                birth_rates = [1.0, 2.0],
+                death_rates = [0.5, 0.8],
+                burst_rate = 1.0,
+                burst_probs = [0.1, 0.5],
+                burst_furcation_poisson_means = [1.0, 2.0],
+                burst_furcation_poisson_shifts = [2, 2],
+                only_bifurcate = False,
+                )
+        rng = random.Random(1)
+        trees = []
+        for i in range(10):
+            survived, root, burst_times = model.sim_SDSD_tree(
+                    rng_seed = rng.random(),
+                    sdsd_model = sdsd_model,
+                    max_extant_leaves = rng.randint(1, 30),
+                    )
+            trees.append((root, burst_times))
+        path = str(tmp_path / "trees.archive")
+        write_archive(path, trees, finish = False)
+        # Mimic a partially written record
+        record = archive.encode_tree(*trees[0])
+        with open(path, "ab") as stream:
+            stream.write(record[:len(record) // 2])
+        with archive.TreeArchiveReader(path) as reader:
+            assert len(reader) == 10
+            assert reader[9].to_node().as_newick_string() == (
+                    trees[9][0].as_newick_string())
+
+    def test_resume(self, tmp_path):
+        sdsd_model = model.SDSDModel(
+                q = [
+                    [-1.0, 1.0],
+                    [1.0, -1.0],
+                ],
+                birth_rates = [1.0, 2.0],
+                death_rates = [0.5, 0.8],
+                burst_rate = 1.0,
+                burst_probs = [0.1, 0.5],
+                burst_furcation_poisson_means = [1.0, 2.0],
+                burst_furcation_poisson_shifts = [2, 2],
+                only_bifurcate = False,
+                )
+        rng = random.Random(1)
+        trees = []
+        for i in range(10):
+            survived, root, burst_times = model.sim_SDSD_tree(
+                    rng_seed = rng.random(),
+                    sdsd_model = sdsd_model,
+                    max_extant_leaves = rng.randint(1, 30),
+                    )
+            trees.append((root, burst_times))
+        path = str(tmp_path / "trees.archive")
+        write_archive(path, trees)
+        expected_path = str(tmp_path / "expected.archive")
+        write_archive(expected_path, trees + trees[:3])
+        with open(path, "r+b") as stream:
+            writer = archive.TreeArchiveWriter.resume(stream)
+            for root, burst_times in trees[:3]:
+                writer.write_tree(root, burst_times)
+            writer.finish()
+        with open(path, "rb") as s1, open(expected_path, "rb") as s2:
+            assert s1.read() == s2.read()
+
+    def test_not_an_archive(self, tmp_path):
+        path = str(tmp_path / "trees.tre")
+        with open(path, "w") as stream:
+            stream.write("((A:1.0,B:1.0):1.0);\n" * 10)
+        with pytest.raises(ValueError):
+            archive.TreeArchiveReader(path)
@@ -0,0 +1,123 @@
+#! /usr/bin/env python
+
+import os
+import sys
+import math
+import random
+import pytest
+
+from sdsdsim import array_tree, model
+from sdsdsim.math_utils import is_zero
+
+
+class TestArrayTree:
+    def test_round_trip(self):
+        rng = random.Random(1)
+        sdsd_model = model.SDSDModel(
+                q = [
+                    [-1.0, 1.0],
+                    [1.0, -1.0],
+                ],
+                birth_rates = [1.0, 2.0],
+                death_rates = [0.5, 0.8],
+                burst_rate = 1.0,
+                burst_probs = [0.1, 0.5],
+                burst_furcation_poisson_means = [1.0, 2.0],
+                burst_furcation_poisson_shifts = [2, 2],
+                only_bifurcate = False,
+                )
+        for i in range(50):
+            survived, root, burst_times = model.sim_SDSD_tree(
+                    rng_seed = rng.random(),
+                    sdsd_model = sdsd_model,
+                    max_extant_leaves = 30,
+                    )
+            tree = array_tree.ArrayTree.from_node(root)
+            assert len(tree) == len(list(root))
+            assert tree.parent[0] == -1
+            for j in range(1, len(tree)):
+                assert tree.parent[j] < j
+            assert tree.number_of_leaves == root.number_of_leaves
+            assert tree.number_of_extant_leaves == root.number_of_extant_leaves
+            assert tree.number_of_extinct_leaves == root.number_of_extinct_leaves
+            assert is_zero(tree.max_time - root.max_time)
+            assert is_zero(tree.height - root.height)
+            assert is_zero(tree.tree_length - root.tree_length)
+            assert (tree.is_burst_node.sum() ==
+                    sum(1 for n in root if n.is_burst_node))
+
+            new_root = tree.to_node()
+            assert new_root.as_newick_string() == root.as_newick_string()
+            assert (new_root.as_newick_simple_string() ==
+                    root.as_newick_simple_string())
+            for n1, n2 in zip(root, new_root):
+                assert n1.label == n2.label
+                assert n1.time == n2.time
+                assert n1.is_extinct == n2.is_extinct
+                assert n1.is_burst_node == n2.is_burst_node
+                assert n1.state_changes == n2.state_changes
+                assert n1.state_change_times == n2.state_change_times
+
+    def test_simulate_as_array_tree(self):
+        sdsd_model = model.SDSDModel(
+                q = [
+                    [-1.0, 1.0],
+                    [1.0, -1.0],
+                ],
+                birth_rates = [1.0, 2.0],
+                death_rates = [0.5, 0.8],
+                burst_rate = 1.0,
+                burst_probs = [0.1, 0.5],
+                burst_furcation_poisson_means = [1.0, 2.0],
+                burst_furcation_poisson_shifts = [2, 2],
+                only_bifurcate = False,
+                )
+        simulator = model.SDSDTreeSimulator(sdsd_model)
+        names = ("parent", "child_offsets", "children", "time",
+                "rootward_state", "flags", "state_change_offsets",
+                "state_change_states", "state_change_times")
+        n_extinct_trees = 0
+        for seed in range(1, 101):
+            # The second setting often gives trees that went extinct
+            for max_extant_leaves, max_time in ((30, None), (None, 2.0)):
+                sim = simulator.simulate(
+                        rng_seed = seed,
+                        max_extant_leaves = max_extant_leaves,
+                        max_time = max_time,
+                        )
+                array_sim = simulator.simulate(
+                        rng_seed = seed,
+                        max_extant_leaves = max_extant_leaves,
+                        max_time = max_time,
+                        as_array_tree = True,
+                        )
+                tree = array_sim.tree
+                assert isinstance(tree, array_tree.ArrayTree)
+                assert array_sim.survived == sim.survived
+                assert array_sim.burst_times == sim.burst_times
+                assert (array_sim.number_of_extinct_leaves ==
+                        sim.number_of_extinct_leaves)
+                n_extinct_trees += not sim.survived
+                expected = array_tree.ArrayTree.from_node(sim.tree)
+                for name in names:
+                    assert (getattr(tree, name).tolist() ==
+                            getattr(expected, name).tolist())
+                assert tree.labels == expected.labels
+                assert tree.seed_time == expected.seed_time
+                assert (tree.to_node().as_newick_string() ==
+                        sim.tree.as_newick_string())
+        assert n_extinct_trees > 0
+
+    def test_bad_lengths(self):
+        with pytest.raises(ValueError):
+            array_tree.ArrayTree(
+                    parent = [-1, 0],
+                    child_offsets = [0, 1],
+                    children = [1],
+                    time = [0.0, 1.0],
+                    rootward_state = [0, 0],
+                    flags = [0, 0],
+                    state_change_offsets = [0, 0, 0],
+                    state_change_states = [],
+                    state_change_times = [],
+                    )
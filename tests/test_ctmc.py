@@ -152,3 +152,51 @@ class TestDrawTransition:
                     continue
                 assert is_zero(exp_prob - state_counts[i][j], 0.005)
 
+
+class TestCachedQuantities:
+    def test_replace_q(self):
+        rng = random.Random(1)
+        m = ctmc.CTMC([
+            [-1.0, 1.0, 0.0],
+            [1.0, -2.0, 1.0],
+            [0.0, 1.0, -1.0],
+        ])
+        assert is_zero(m.get_rate_from(1) - 2.0)
+        for i in range(100):
+            assert m.draw_transition(0, rng) == 1
+        probs = m.get_steady_state_probs()
+        for p in probs:
+            assert is_zero(p - 1/3.0)
+
+        m.q = [
+            [-1.0, 0.0, 1.0],
+            [0.0, -3.0, 3.0],
+            [1.0, 1.0, -2.0],
+        ]
+        assert m.n_states == 3
+        assert is_zero(m.get_rate_from(1) - 3.0)
+        for i in range(100):
+            assert m.draw_transition(0, rng) == 2
+            assert m.draw_transition(1, rng) == 2
+        assert m.are_steady_state_probs(m.get_steady_state_probs())
+        assert is_zero(m.get_steady_state_probs()[1] - 1/7.0)
+
+    def test_invalid_replacement(self):
+        m = ctmc.CTMC([
+            [-1.0, 1.0],
+            [1.0, -1.0],
+        ])
+        with pytest.raises(ValueError):
+            m.q = [
+                [-1.0, 2.0],
+                [1.0, -1.0],
+            ]
+        assert is_zero(m.get_rate_from(0) - 1.0)
+
+    def test_q_is_read_only(self):
+        m = ctmc.CTMC([
+            [-1.0, 1.0],
+            [1.0, -1.0],
+        ])
+        with pytest.raises(ValueError):
+            m.q[0][1] = 2.0
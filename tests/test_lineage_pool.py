@@ -0,0 +1,47 @@
+#! /usr/bin/env python
+
+import os
+import sys
+import math
+import random
+import pytest
+
+from sdsdsim import lineage_pool
+from sdsdsim.node import Node
+from sdsdsim.math_utils import is_zero
+
+
+class TestLineagePool:
+    def test_add_remove(self):
+        nodes = [Node(label = str(i)) for i in range(10)]
+        pool = lineage_pool.LineagePool(nodes)
+        assert len(pool) == 10
+        for n in nodes:
+            assert n in pool
+
+        pool.remove(nodes[0])
+        pool.remove(nodes[9])
+        pool.remove(nodes[4])
+        assert len(pool) == 7
+        assert nodes[0] not in pool
+        assert nodes[9] not in pool
+        assert nodes[4] not in pool
+        assert set(pool) == set(nodes[1:4] + nodes[5:9])
+        for i in range(len(pool)):
+            assert pool[i] in pool
+
+        for n in list(pool):
+            pool.remove(n)
+        assert len(pool) == 0
+
+    def test_errors(self):
+        a = Node()
+        b = Node()
+        pool = lineage_pool.LineagePool([a])
+        with pytest.raises(ValueError):
+            pool.add(a)
+        with pytest.raises(ValueError):
+            pool.remove(b)
+        pool.clear()
+        with pytest.raises(IndexError):
+            pool[0]
@@ -0,0 +1,126 @@
+#! /usr/bin/env python
+
+import os
+import sys
+import io
+import json
+import pytest
+
+from sdsdsim import metrics, model
+from sdsdsim.math_utils import is_zero
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.time = 100.0
+
+    def __call__(self):
+        return self.time
+
+
+class TestSimulationMetrics:
+    def test_counts(self):
+        clock = FakeClock()
+        m = metrics.SimulationMetrics(clock = clock)
+        assert m.acceptance_rate is None
+        assert m.events_per_second is None
+        m.record_replicate(None, number_of_events = 100,
+                stage_times = {"simulation": 1.0, "serialization": 0.5})
+        m.record_replicate("extinct", number_of_events = 20,
+                stage_times = {"simulation": 0.25})
+        m.record_replicate("extinct", number_of_events = 5,
+                stage_times = {"simulation": 0.25})
+        m.record_replicate("max_extant_leaves", number_of_events = 75,
+                stage_times = {"simulation": 0.5})
+        m.add_time("pruning", 0.125)
+        clock.time += 8.0
+        assert m.attempts == 4
+        assert m.accepted == 1
+        assert m.rejections == {"extinct": 2, "max_extant_leaves": 1}
+        assert m.events == 200
+        assert is_zero(m.acceptance_rate - 0.25)
+        assert is_zero(m.events_per_second - 100.0)
+        assert is_zero(m.trees_per_second - 0.125)
+        d = m.as_dict()
+        assert d["stage_seconds"] == {
+            "simulation": 2.0,
+            "pruning": 0.125,
+            "serialization": 0.5,
+        }
+        assert d["elapsed_seconds"] == 8.0
+        line = m.get_progress_line()
+        assert line.startswith("1 of 4 replicates accepted (25.0%)")
+        assert "extinct 2, max_extant_leaves 1" in line
+        assert "200 events (100/s)" in line
+
+    def test_write_json(self):
+        m = metrics.SimulationMetrics()
+        m.record_replicate(None, number_of_events = 3)
+        stream = io.StringIO()
+        m.write_json(stream)
+        d = json.loads(stream.getvalue())
+        assert d["attempts"] == 1
+        assert d["events"] == 3
+        assert set(d["stage_seconds"]) == set(metrics.SimulationMetrics.STAGES)
+
+    def test_unknown_stage(self):
+        m = metrics.SimulationMetrics()
+        with pytest.raises(ValueError):
+            m.add_time("bogus", 1.0)
+
+
+class TestEventLoopProfile:
+    def test_counts(self):
+        sdsd_model = model.SDSDModel(
+                q = [
+                    [-1.0, 1.0],
+                    [1.0, -1.0],
+                ],
+                birth_rates = [1.0, 2.0],
+                death_rates = [0.5, 0.8],
+                burst_rate = 1.0,
+                burst_probs = [0.1, 0.5],
+                burst_furcation_poisson_means = [1.0, 2.0],
+                burst_furcation_poisson_shifts = [2, 2],
+                only_bifurcate = False,
+                )
+        simulator = model.SDSDTreeSimulator(sdsd_model)
+        for seed in range(1, 30):
+            profile = metrics.EventLoopProfile()
+            result = simulator.simulate(rng_seed = seed,
+                    max_extant_leaves = 40,
+                    profile = profile)
+            expected = simulator.simulate(rng_seed = seed,
+                    max_extant_leaves = 40)
+            root = result.tree
+            assert root.as_newick_string() == (
+                    expected.tree.as_newick_string())
+            n_births = sum(1 for n in root
+                    if (not n.is_leaf) and (not n.is_burst_node))
+            assert profile.counts["birth"] == n_births
+            assert profile.counts["death"] == root.number_of_extinct_leaves
+            assert profile.counts["transition"] == sum(
+                    len(n.state_changes) for n in root)
+            assert profile.counts["burst"] == len(result.burst_times)
+            assert profile.counts["labeling"] == 1
+            assert profile.counts["wait_time"] == result.number_of_events
+            for part in metrics.EventLoopProfile.PARTS:
+                assert profile.times[part] >= 0.0
+            assert len(profile.get_summary_lines()) == len(
+                    metrics.EventLoopProfile.PARTS)
+
+    def test_accumulates(self):
+        profile = metrics.EventLoopProfile()
+        results = list(model.sim_SDSD_trees(
+                n = 5,
+                sdsd_model = model.SDSDModel(),
+                rng_seed = 1,
+                max_extant_leaves = 10,
+                keep_extinct_trees = True,
+                profile = profile,
+                ))
+        assert profile.counts["labeling"] == 5
+        d = profile.as_dict()
+        assert d["labeling"]["count"] == 5
+        assert is_zero(sum(v["seconds"] for v in d.values()) -
+                profile.total_time)
@@ -4,9 +4,13 @@ import os
 import sys
 import math
 import random
+import gc
+import multiprocessing
+import concurrent.futures
 import pytest
 
-from sdsdsim import model
+import sdsdsim
+from sdsdsim import ctmc, metrics, model, rng_utils
 from sdsdsim.math_utils import is_zero 
 
 
@@ -19,6 +23,40 @@ def expected_yule_tree_height(ntips, birth_rate):
 def expected_yule_tree_length(ntips, birth_rate):
     return float(ntips - 1) / birth_rate
 
+# Seeds and settings for the reproducibility tests; string seeds hash
+# differently across processes with Python's `hash`
+REPRODUCIBILITY_CASES = [
+    (seed, engine, rng_backend)
+    for seed in (1, 2**64 - 1, 0.3, "tree-7")
+    for engine in model.ENGINES
+    for rng_backend in rng_utils.RNG_BACKENDS
+]
+
+def simulate_newick(case):
+    seed, engine, rng_backend = case
+    sdsd_model = model.SDSDModel(
+            q = [
+                [-1.0, 0.6, 0.4],
+                [0.5, -1.0, 0.5],
+                [0.2, 0.8, -1.0],
+            ],
+            birth_rates = [1.0, 1.5, 2.0],
+            death_rates = [0.5, 0.5, 0.8],
+            burst_rate = 1.0,
+            burst_probs = [0.1, 0.5, 0.3],
+            burst_furcation_poisson_means = [1.0, 2.0, 15.0],
+            burst_furcation_poisson_shifts = [2, 2, 1],
+            only_bifurcate = False,
+            )
+    survived, root, burst_times = model.sim_SDSD_tree(
+            rng_seed = seed,
+            sdsd_model = sdsd_model,
+            max_extant_leaves = 60,
+            engine = engine,
+            rng_backend = rng_backend,
+            )
+    return root.as_newick_string(), burst_times
+
 class TestSimSDSDTree:
     def test_yule(self):
         rng = random.Random(1)
@@ -130,7 +168,8 @@ class TestSimSDSDTree:
             else:
                 assert n_leaves == 0
 
-    def test_rates_SDSD(self):
+    @pytest.mark.parametrize("engine", model.ENGINES)
+    def test_rates_SDSD(self, engine):
         rng = random.Random(1)
 
         r_trans = 1.5
@@ -151,7 +190,7 @@ class TestSimSDSDTree:
                 only_bifurcate = False,
                 )
 
-        n = 200
+        n = 400
         max_extant_leaves = None
         max_time = 2.0
         n_bursts = 0
@@ -171,6 +210,7 @@ class TestSimSDSDTree:
                     max_extinct_leaves = None,
                     max_total_leaves = None,
                     max_time = max_time,
+                    engine = engine,
                     )
             # print(root.number_of_leaves)
             n_bursts += len(burst_times)
@@ -242,3 +282,478 @@ class TestSimSDSDTree:
                 e_burst_rate - r_burst,
                 eps
                 )
+
+    def test_reuses_state_tables(self):
+        sdsd_model = model.SDSDModel()
+        tables = model.get_state_tables(sdsd_model)
+        assert model.SDSDTreeSimulator(sdsd_model).state_event_samplers is (
+                tables.state_event_samplers)
+        survived, root, burst_times = model.sim_SDSD_tree(
+                rng_seed = 1,
+                sdsd_model = sdsd_model,
+                )
+        assert model.get_state_tables(sdsd_model) is tables
+
+        # Changing the model gives new tables
+        sdsd_model.ctmc.q = [
+            [-5.0, 5.0],
+            [5.0, -5.0],
+        ]
+        survived, root, burst_times = model.sim_SDSD_tree(
+                rng_seed = 1,
+                sdsd_model = sdsd_model,
+                )
+        new_tables = model.get_state_tables(sdsd_model)
+        assert new_tables is not tables
+        assert new_tables.state_rates[0][2] == 5.0
+        expected = model.SDSDTreeSimulator(sdsd_model).simulate(rng_seed = 1)
+        assert root.as_newick_string() == expected.tree.as_newick_string()
+
+    def test_state_tables_freed(self):
+        n_cached = len(model._STATE_TABLES)
+        for i in range(100):
+            model.sim_SDSD_tree(
+                    rng_seed = i,
+                    sdsd_model = model.SDSDModel(),
+                    max_extant_leaves = 5,
+                    )
+        gc.collect()
+        assert len(model._STATE_TABLES) <= n_cached
+
+    def test_threads(self):
+        sdsd_model = model.SDSDModel(burst_rate = 1.0)
+        simulator = model.SDSDTreeSimulator(sdsd_model)
+        seeds = list(range(40))
+        def sim(seed):
+            survived, root, burst_times = model.sim_SDSD_tree(
+                    rng_seed = seed,
+                    sdsd_model = sdsd_model,
+                    max_extant_leaves = 30,
+                    )
+            result = simulator.simulate(rng_seed = seed,
+                    max_extant_leaves = 30)
+            return (root.as_newick_string(),
+                    result.tree.as_newick_string())
+        expected = [sim(seed) for seed in seeds]
+        with concurrent.futures.ThreadPoolExecutor(max_workers = 4) as pool:
+            for rep in range(4):
+                assert list(pool.map(sim, seeds)) == expected
+
+
+class TestEngines:
+    def test_invalid_engine(self):
+        with pytest.raises(ValueError):
+            model.sim_SDSD_tree(
+                    rng_seed = 1,
+                    sdsd_model = model.SDSDModel(),
+                    engine = "bogus",
+                    )
+
+    def test_engines_agree(self):
+        rng = random.Random(1)
+
+        sdsd_model = model.SDSDModel(
+                q = [
+                    [-1.0, 1.0],
+                    [1.0, -1.0],
+                ],
+                birth_rates = [1.0, 2.0],
+                death_rates = [0.5, 0.8],
+                burst_rate = 1.0,
+                burst_probs = [0.1, 0.5],
+                burst_furcation_poisson_means = [1.0, 2.0],
+                burst_furcation_poisson_shifts = [2, 2],
+                only_bifurcate = False,
+                )
+
+        n = 500
+        summaries = {}
+        for engine in model.ENGINES:
+            n_survived = 0
+            n_bursts = 0
+            total_height = 0.0
+            total_leaves = 0
+            for i in range(n):
+                survived, root, burst_times = model.sim_SDSD_tree(
+                        rng_seed = rng.random(),
+                        sdsd_model = sdsd_model,
+                        max_extant_leaves = 20,
+                        engine = engine,
+                        )
+                n_survived += survived
+                n_bursts += len(burst_times)
+                total_height += root.height + root.time
+                total_leaves += root.number_of_leaves
+            summaries[engine] = (
+                    n_survived / n,
+                    n_bursts / n,
+                    total_height / n,
+                    total_leaves / n,
+                    )
+        direct = summaries["direct"]
+        race = summaries["race"]
+        assert is_zero(direct[0] - race[0], 0.08)
+        assert is_zero((direct[1] / race[1]) - 1.0, 0.15)
+        assert is_zero((direct[2] / race[2]) - 1.0, 0.15)
+        assert is_zero((direct[3] / race[3]) - 1.0, 0.15)
+
+
+class TestRNGBackends:
+    def test_invalid_backend(self):
+        with pytest.raises(ValueError):
+            model.SDSDTreeSimulator(model.SDSDModel(), rng_backend = "bogus")
+
+    @pytest.mark.parametrize("engine", model.ENGINES)
+    def test_reproducible(self, engine):
+        sdsd_model = model.SDSDModel(burst_rate = 2.0)
+        newicks = {}
+        for rng_backend in rng_utils.RNG_BACKENDS:
+            simulator = model.SDSDTreeSimulator(sdsd_model,
+                    engine = engine,
+                    rng_backend = rng_backend)
+            newicks[rng_backend] = []
+            for seed in range(1, 20):
+                trees = [
+                    simulator.simulate(rng_seed = seed,
+                        max_extant_leaves = 30).tree.as_newick_string()
+                    for rep in range(2)
+                ]
+                assert trees[0] == trees[1]
+                newicks[rng_backend].append(trees[0])
+        assert newicks["python"] != newicks["numpy"]
+
+    def test_backends_agree(self):
+        sdsd_model = model.SDSDModel(
+                q = [
+                    [-1.0, 1.0],
+                    [1.0, -1.0],
+                ],
+                birth_rates = [1.0, 2.0],
+                death_rates = [0.5, 0.8],
+                burst_rate = 1.0,
+                burst_probs = [0.1, 0.5],
+                burst_furcation_poisson_means = [1.0, 12.0],
+                burst_furcation_poisson_shifts = [2, 2],
+                only_bifurcate = False,
+                )
+
+        n = 500
+        summaries = {}
+        for rng_backend in rng_utils.RNG_BACKENDS:
+            n_survived = 0
+            n_bursts = 0
+            total_height = 0.0
+            total_leaves = 0
+            for i in range(n):
+                survived, root, burst_times = model.sim_SDSD_tree(
+                        rng_seed = i,
+                        sdsd_model = sdsd_model,
+                        max_extant_leaves = 20,
+                        rng_backend = rng_backend,
+                        )
+                n_survived += survived
+                n_bursts += len(burst_times)
+                total_height += root.height + root.time
+                total_leaves += root.number_of_leaves
+            summaries[rng_backend] = (
+                    n_survived / n,
+                    n_bursts / n,
+                    total_height / n,
+                    total_leaves / n,
+                    )
+        python = summaries["python"]
+        numpy = summaries["numpy"]
+        assert is_zero(python[0] - numpy[0], 0.08)
+        assert is_zero((python[1] / numpy[1]) - 1.0, 0.15)
+        assert is_zero((python[2] / numpy[2]) - 1.0, 0.15)
+        assert is_zero((python[3] / numpy[3]) - 1.0, 0.15)
+
+
+class TestReproducibility:
+    def test_any_order(self):
+        expected = [simulate_newick(c) for c in REPRODUCIBILITY_CASES]
+        order = list(range(len(REPRODUCIBILITY_CASES)))
+        random.Random(1).shuffle(order)
+        for i in order:
+            assert simulate_newick(REPRODUCIBILITY_CASES[i]) == expected[i]
+
+    def test_without_global_rng(self, monkeypatch):
+        class NoRandom(random.Random):
+            def random(self):
+                raise AssertionError("GLOBAL_RNG was used")
+        no_random = NoRandom()
+        for module in (sdsdsim, ctmc, rng_utils):
+            monkeypatch.setattr(module, "GLOBAL_RNG", no_random)
+        for case in REPRODUCIBILITY_CASES:
+            simulate_newick(case)
+
+    def test_across_processes(self):
+        expected = [simulate_newick(c) for c in REPRODUCIBILITY_CASES]
+        cases = list(reversed(REPRODUCIBILITY_CASES))
+        # Spawned processes start from scratch, with their own hash seeds
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(processes = 2) as pool:
+            results = pool.map(simulate_newick, cases, chunksize = 1)
+        assert list(reversed(results)) == expected
+
+
+class TestConditionOnSurvival:
+    def test_no_death(self):
+        sdsd_model = model.SDSDModel(
+                q = [
+                    [-0.5, 0.5],
+                    [0.3, -0.3],
+                ],
+                birth_rates = [1.0, 1.2],
+                death_rates = [0.0, 0.0],
+                burst_rate = 0.3,
+                burst_probs = [0.2, 0.4],
+                burst_furcation_poisson_means = [0.5, 1.0],
+                burst_furcation_poisson_shifts = [2, 2],
+                only_bifurcate = False,
+                )
+        simulator = model.SDSDTreeSimulator(sdsd_model)
+        for i in range(50):
+            expected = simulator.simulate(rng_seed = i)
+            result = simulator.simulate(rng_seed = i,
+                    condition_on_survival = True)
+            assert result.log_weight == 0.0
+            assert result.tree.as_newick_string() == (
+                    expected.tree.as_newick_string())
+
+    @pytest.mark.parametrize("stopping_conditions", [
+        {"max_extant_leaves": 10},
+        {"max_extant_leaves": 30, "max_time": 4.0},
+    ])
+    def test_matches_rejection(self, stopping_conditions):
+        sdsd_model = model.SDSDModel(
+                q = [
+                    [-0.5, 0.5],
+                    [0.3, -0.3],
+                ],
+                birth_rates = [1.0, 1.2],
+                death_rates = [0.95, 1.1],
+                burst_rate = 0.3,
+                burst_probs = [0.2, 0.4],
+                burst_furcation_poisson_means = [0.5, 1.0],
+                burst_furcation_poisson_shifts = [2, 2],
+                only_bifurcate = False,
+                )
+        simulator = model.SDSDTreeSimulator(sdsd_model)
+        n = 6000
+        n_survived = 0
+        totals = [0.0, 0.0]
+        for i in range(n):
+            result = simulator.simulate(rng_seed = i, **stopping_conditions)
+            assert result.log_weight == 0.0
+            if result.survived:
+                n_survived += 1
+                totals[0] += result.tree.height + result.tree.time
+                totals[1] += result.tree.number_of_extinct_leaves
+        expected_means = [t / n_survived for t in totals]
+
+        total_weight = 0.0
+        totals = [0.0, 0.0]
+        for i in range(n, 2 * n):
+            result = simulator.simulate(rng_seed = i,
+                    condition_on_survival = True,
+                    **stopping_conditions)
+            assert result.survived
+            assert result.log_weight <= 0.0
+            weight = math.exp(result.log_weight)
+            total_weight += weight
+            totals[0] += weight * (result.tree.height + result.tree.time)
+            totals[1] += weight * result.tree.number_of_extinct_leaves
+        assert is_zero((total_weight / n) - (n_survived / n), 0.03)
+        for total, expected_mean in zip(totals, expected_means):
+            assert is_zero(((total / total_weight) / expected_mean) - 1.0,
+                    0.08)
+
+    def test_sim_SDSD_trees(self):
+        sdsd_model = model.SDSDModel(
+                q = [
+                    [-0.5, 0.5],
+                    [0.3, -0.3],
+                ],
+                birth_rates = [1.0, 1.2],
+                death_rates = [0.95, 1.1],
+                burst_rate = 0.3,
+                burst_probs = [0.2, 0.4],
+                burst_furcation_poisson_means = [0.5, 1.0],
+                burst_furcation_poisson_shifts = [2, 2],
+                only_bifurcate = False,
+                )
+        results = list(model.sim_SDSD_trees(
+                n = 20,
+                sdsd_model = sdsd_model,
+                rng_seed = 1,
+                max_extant_leaves = 10,
+                keep_extinct_trees = False,
+                condition_on_survival = True,
+                rejection_callback = lambda r: pytest.fail(
+                    "Conditioned tree rejected"),
+                ))
+        assert len(results) == 20
+        assert any(r.log_weight < 0.0 for r in results)
+
+
+class TestSimSDSDTrees:
+    def test_acceptance(self):
+        sdsd_model = model.SDSDModel(
+                q = [
+                    [-0.3, 0.3],
+                    [0.3, -0.3],
+                ],
+                birth_rates = [1.0, 1.0],
+                death_rates = [0.5, 0.5],
+                burst_rate = 1.5,
+                burst_probs = [0.1, 0.8],
+                burst_furcation_poisson_means = [0.6, 0.6],
+                burst_furcation_poisson_shifts = [2, 2],
+                only_bifurcate = False,
+                )
+        max_extant_leaves = 20
+        rejected = []
+        results = list(model.sim_SDSD_trees(
+                n = 30,
+                sdsd_model = sdsd_model,
+                rng_seed = 1,
+                max_extant_leaves = max_extant_leaves,
+                keep_extinct_trees = False,
+                max_leaves_strict = True,
+                rejection_callback = rejected.append,
+                ))
+        assert len(results) == 30
+        for r in results:
+            assert r.survived
+            assert r.rejection is None
+            assert r.tree.number_of_extant_leaves == max_extant_leaves
+        reasons = set(r.rejection for r in rejected)
+        assert model.REJECTED_EXTINCT in reasons
+        assert model.REJECTED_MAX_EXTANT_LEAVES in reasons
+        for r in rejected:
+            assert r.tree is None
+            if r.rejection == model.REJECTED_EXTINCT:
+                assert not r.survived
+                assert r.number_of_extant_leaves == 0
+            else:
+                assert r.number_of_extant_leaves > max_extant_leaves
+
+    @pytest.mark.parametrize("stopping_conditions", [
+        {"max_extant_leaves": 20},
+        {"max_extant_leaves": 30, "max_total_leaves": 40},
+        {"max_extant_leaves": None, "max_total_leaves": 25},
+        {"max_extant_leaves": 30, "max_time": 3.0},
+    ])
+    def test_early_rejection(self, stopping_conditions):
+        sdsd_model = model.SDSDModel(
+                q = [
+                    [-0.3, 0.3],
+                    [0.3, -0.3],
+                ],
+                birth_rates = [1.0, 1.0],
+                death_rates = [0.5, 0.5],
+                burst_rate = 1.5,
+                burst_probs = [0.1, 0.8],
+                burst_furcation_poisson_means = [0.6, 0.6],
+                burst_furcation_poisson_shifts = [2, 2],
+                only_bifurcate = False,
+                )
+        simulator = model.SDSDTreeSimulator(sdsd_model)
+        reasons = set()
+        for i in range(300):
+            full = simulator.simulate(rng_seed = i, **stopping_conditions)
+            assert full.number_of_extant_leaves == (
+                    full.tree.number_of_extant_leaves)
+            assert full.number_of_extinct_leaves == (
+                    full.tree.number_of_extinct_leaves)
+            expected = model.get_rejection_reason(
+                    survived = full.survived,
+                    tree = full.tree,
+                    keep_extinct_trees = False,
+                    max_leaves_strict = True,
+                    **{k: v for k, v in stopping_conditions.items()
+                        if k != "max_time"})
+            result = simulator.simulate(rng_seed = i,
+                    keep_extinct_trees = False,
+                    max_leaves_strict = True,
+                    **stopping_conditions)
+            assert result.rejection == expected
+            assert result.survived == full.survived
+            assert result.number_of_extant_leaves == (
+                    full.number_of_extant_leaves)
+            assert result.number_of_extinct_leaves == (
+                    full.number_of_extinct_leaves)
+            if expected is None:
+                assert result.tree.as_newick_string() == (
+                        full.tree.as_newick_string())
+                assert result.burst_times == full.burst_times
+            else:
+                assert result.tree is None
+                reasons.add(expected)
+        assert model.REJECTED_EXTINCT in reasons
+        assert len(reasons) > 1
+
+    def test_metrics(self):
+        sdsd_model = model.SDSDModel(
+                q = [
+                    [-0.3, 0.3],
+                    [0.3, -0.3],
+                ],
+                birth_rates = [1.0, 1.0],
+                death_rates = [0.5, 0.5],
+                burst_rate = 1.5,
+                burst_probs = [0.1, 0.8],
+                burst_furcation_poisson_means = [0.6, 0.6],
+                burst_furcation_poisson_shifts = [2, 2],
+                only_bifurcate = False,
+                )
+        m = metrics.SimulationMetrics()
+        rejected = []
+        results = list(model.sim_SDSD_trees(
+                n = 10,
+                sdsd_model = sdsd_model,
+                rng_seed = 1,
+                max_extant_leaves = 20,
+                max_leaves_strict = True,
+                rejection_callback = rejected.append,
+                metrics = m,
+                ))
+        assert m.accepted == 10
+        assert m.attempts == 10 + len(rejected)
+        assert sum(m.rejections.values()) == len(rejected)
+        assert m.events == sum(r.number_of_events for r in results + rejected)
+        assert m.stage_times["simulation"] > 0.0
+        for r in results:
+            assert r.number_of_events > 0
+
+    def test_matches_sim_SDSD_tree(self):
+        sdsd_model = model.SDSDModel(
+                q = [
+                    [-0.3, 0.3],
+                    [0.3, -0.3],
+                ],
+                birth_rates = [1.0, 1.0],
+                death_rates = [0.5, 0.5],
+                burst_rate = 1.5,
+                burst_probs = [0.1, 0.8],
+                burst_furcation_poisson_means = [0.6, 0.6],
+                burst_furcation_poisson_shifts = [2, 2],
+                only_bifurcate = False,
+                )
+        results = model.sim_SDSD_trees(
+                n = 10,
+                sdsd_model = sdsd_model,
+                rng_seed = 1,
+                max_extant_leaves = 20,
+                keep_extinct_trees = True,
+                )
+        for i, r in enumerate(results):
+            survived, root, burst_times = model.sim_SDSD_tree(
+                    rng_seed = rng_utils.get_replicate_seed(1, i),
+                    sdsd_model = sdsd_model,
+                    max_extant_leaves = 20,
+                    )
+            assert r.survived == survived
+            assert r.burst_times == burst_times
+            assert r.tree.as_newick_string() == root.as_newick_string()
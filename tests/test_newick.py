@@ -0,0 +1,301 @@
+#! /usr/bin/env python
+
+import os
+import sys
+import io
+import random
+import pytest
+
+from sdsdsim import array_tree, model, newick, node
+from sdsdsim.cli import sim_SDSD_trees
+from sdsdsim.math_utils import is_zero
+
+
+class TestParseNewick:
+    def test_round_trip(self):
+        sdsd_model = model.SDSDModel(
+                q = [
+                    [-1.0, 1.0],
+                    [1.0, -1.0],
+                ],
+                birth_rates = [1.0, 2.0],
+                death_rates = [0.5, 0.8],
+                burst_rate = 1.0,
+                burst_probs = [0.1, 0.5],
+                burst_furcation_poisson_means = [1.0, 2.0],
+                burst_furcation_poisson_shifts = [1, 2],
+                only_bifurcate = False,
+                )
+        rng = random.Random(1)
+        trees = []
+        for i in range(300):
+            survived, root, burst_times = model.sim_SDSD_tree(
+                    rng_seed = rng.random(),
+                    sdsd_model = sdsd_model,
+                    max_extant_leaves = rng.randint(1, 40),
+                    )
+            trees.append((root, burst_times))
+            pruned = root.prune_extinct_leaves()
+            if pruned is not None:
+                trees.append((pruned, burst_times))
+        for root, burst_times in trees:
+            for as_string in (
+                    root.as_newick_string,
+                    root.as_newick_simmap_string,
+                    root.as_newick_simple_string):
+                s = as_string()
+                new_root = newick.parse_newick(s, burst_times = burst_times)
+                assert getattr(new_root, as_string.__name__)() == s
+
+            new_root = newick.parse_newick(root.as_newick_string(),
+                    burst_times = burst_times)
+            assert len(list(new_root)) == len(list(root))
+            for n1, n2 in zip(root, new_root):
+                assert n1.label == n2.label or not n1.is_leaf
+                assert n1.is_extinct == n2.is_extinct
+                assert n1.is_burst_node == n2.is_burst_node
+                assert n1.rootward_state == n2.rootward_state
+                assert n1.state_changes == n2.state_changes
+                assert is_zero(n1.time - n2.time)
+
+    def test_without_root_annotations(self):
+        sdsd_model = model.SDSDModel(
+                q = [
+                    [-1.0, 1.0],
+                    [1.0, -1.0],
+                ],
+                birth_rates = [1.0, 2.0],
+                death_rates = [0.5, 0.8],
+                burst_rate = 1.0,
+                burst_probs = [0.1, 0.5],
+                burst_furcation_poisson_means = [1.0, 2.0],
+                burst_furcation_poisson_shifts = [1, 2],
+                only_bifurcate = False,
+                )
+        rng = random.Random(1)
+        trees = []
+        for i in range(100):
+            survived, root, burst_times = model.sim_SDSD_tree(
+                    rng_seed = rng.random(),
+                    sdsd_model = sdsd_model,
+                    max_extant_leaves = rng.randint(1, 40),
+                    )
+            trees.append((root, burst_times))
+            pruned = root.prune_extinct_leaves()
+            if pruned is not None:
+                trees.append((pruned, burst_times))
+        for root, burst_times in trees:
+            for as_string in (
+                    root.as_newick_simmap_string,
+                    root.as_newick_simple_string):
+                s = as_string(include_root_annotations = False)
+                new_root = newick.parse_newick(s,
+                        include_root_annotations = False)
+                if not new_root.is_leaf:
+                    assert new_root.time == 0.0
+                new_s = getattr(new_root, as_string.__name__)(
+                        include_root_annotations = False)
+                assert new_s.count(":") == s.count(":")
+                for n1, n2 in zip(root, new_root):
+                    if n1.is_root:
+                        continue
+                    assert n1.label == n2.label or not n1.is_leaf
+                    assert is_zero(n1.branch_length - n2.branch_length)
+
+    def test_leaf_root(self):
+        root = node.Node(label = "L1", rootward_state = 1, time = 1.5)
+        root.seed_time = 0.0
+        for include_root_annotations in (True, False):
+            s = root.as_newick_string(include_root_annotations)
+            new_root = newick.parse_newick(s,
+                    include_root_annotations = include_root_annotations)
+            assert new_root.is_leaf
+            assert new_root.label == "L1"
+            assert new_root.rootward_state == 1
+            assert new_root.as_newick_string(include_root_annotations) == s
+
+    def test_deep_tree(self):
+        depth = sys.getrecursionlimit() + 1000
+        s = "((" + ("(" * depth) + "A:{0,1.0},B:{0,1.0}" + (
+                "):{0,0.125},C:{1,1.0}" * depth) + "):{0,0.5});"
+        root = newick.parse_newick(s)
+        assert root.number_of_leaves == depth + 2
+        assert root.as_newick_string() == s
+
+    def test_as_array_tree(self):
+        sdsd_model = model.SDSDModel(
+                q = [
+                    [-1.0, 1.0],
+                    [1.0, -1.0],
+                ],
+                birth_rates = [1.0, 2.0],
+                death_rates = [0.5, 0.8],
+                burst_rate = 1.0,
+                burst_probs = [0.1, 0.5],
+                burst_furcation_poisson_means = [1.0, 2.0],
+                burst_furcation_poisson_shifts = [1, 2],
+                only_bifurcate = False,
+                )
+        rng = random.Random(1)
+        trees = []
+        for i in range(20):
+            survived, root, burst_times = model.sim_SDSD_tree(
+                    rng_seed = rng.random(),
+                    sdsd_model = sdsd_model,
+                    max_extant_leaves = rng.randint(1, 40),
+                    )
+            trees.append((root, burst_times))
+            pruned = root.prune_extinct_leaves()
+            if pruned is not None:
+                trees.append((pruned, burst_times))
+        for root, burst_times in trees:
+            tree = newick.parse_newick(root.as_newick_string(),
+                    burst_times = burst_times,
+                    as_array_tree = True)
+            assert isinstance(tree, array_tree.ArrayTree)
+            assert tree.number_of_leaves == root.number_of_leaves
+            assert (tree.is_burst_node.sum() ==
+                    sum(1 for n in root if n.is_burst_node))
+            assert tree.to_node().as_newick_string() == (
+                    root.as_newick_string())
+
+    def test_burst_times(self):
+        sdsd_model = model.SDSDModel(burst_rate = 2.0)
+        for seed in list(range(300)) + [274]:
+            survived, root, burst_times = model.sim_SDSD_tree(
+                    rng_seed = seed,
+                    sdsd_model = sdsd_model,
+                    max_extant_leaves = random.Random(seed).randint(1, 80),
+                    )
+            new_root = newick.parse_newick(root.as_newick_string(),
+                    burst_times = burst_times)
+            assert new_root.as_newick_string() == root.as_newick_string()
+            assert [n.is_burst_node for n in new_root] == [
+                    n.is_burst_node for n in root]
+            # Burst nodes get the exact burst times
+            assert sorted(n.time for n in new_root if n.is_burst_node) == (
+                    sorted(n.time for n in root if n.is_burst_node))
+
+    @pytest.mark.parametrize("newick_string,include_root_annotations", [
+        ("((A:1.0,B:1.0):1.0", True),
+        ("((A:1.0,B:1.0):1.0));", True),
+        ("(A:1.0,B:1.0):1.0;", True),
+        ("(A:1.0,B:1.0);(C:1.0,D:1.0);", False),
+        ("(A:1.0,B:1.0)(C:1.0,D:1.0);", False),
+        ("(A:1.0:2.0,B:1.0);", False),
+        ("(A:{0},B:1.0);", False),
+        ("((),B:1.0);", False),
+        ("", False),
+    ])
+    def test_invalid(self, newick_string, include_root_annotations):
+        with pytest.raises(ValueError):
+            newick.parse_newick(newick_string,
+                    include_root_annotations = include_root_annotations)
+
+
+class TestIterTrees:
+    def test_iter_trees(self):
+        sdsd_model = model.SDSDModel(
+                q = [
+                    [-1.0, 1.0],
+                    [1.0, -1.0],
+                ],
+                birth_rates = [1.0, 2.0],
+                death_rates = [0.5, 0.8],
+                burst_rate = 1.0,
+                burst_probs = [0.1, 0.5],
+                burst_furcation_poisson_means = [1.0, 2.0],
+                burst_furcation_poisson_shifts = [1, 2],
+                only_bifurcate = False,
+                )
+        rng = random.Random(1)
+        trees = []
+        for i in range(20):
+            survived, root, burst_times = model.sim_SDSD_tree(
+                    rng_seed = rng.random(),
+                    sdsd_model = sdsd_model,
+                    max_extant_leaves = rng.randint(1, 40),
+                    )
+            trees.append(root)
+            pruned = root.prune_extinct_leaves()
+            if pruned is not None:
+                trees.append(pruned)
+        stream = io.StringIO()
+        for root in trees:
+            root.write_newick(stream)
+            stream.write(";\n")
+        for chunk_size in (7, 1 << 20):
+            stream.seek(0)
+            parsed = list(newick.iter_trees(stream, chunk_size = chunk_size))
+            assert len(parsed) == len(trees)
+            for root, new_root in zip(trees, parsed):
+                assert new_root.as_newick_string() == root.as_newick_string()
+
+    def test_iter_newick_strings(self):
+        stream = io.StringIO("(A:1,B:1);\n (C:1,\nD:1);\n\n(E:1,F:1)")
+        assert list(newick.iter_newick_strings(stream, chunk_size = 3)) == [
+                "(A:1,B:1);",
+                "(C:1,\nD:1);",
+                "(E:1,F:1)",
+                ]
+
+    def test_burst_times(self):
+        sdsd_model = model.SDSDModel(burst_rate = 2.0)
+        trees = []
+        for seed in range(20):
+            survived, root, burst_times = model.sim_SDSD_tree(
+                    rng_seed = seed,
+                    sdsd_model = sdsd_model,
+                    max_extant_leaves = 30,
+                    )
+            trees.append((root, burst_times))
+        stream = io.StringIO()
+        for root, burst_times in trees:
+            root.write_newick(stream)
+            stream.write(";\n")
+        stream.seek(0)
+        parsed = list(newick.iter_trees(stream,
+                burst_times = (bt for root, bt in trees)))
+        assert len(parsed) == len(trees)
+        assert any(root.is_burst_node for root in parsed[0])
+        for (root, burst_times), new_root in zip(trees, parsed):
+            assert new_root.as_newick_string() == root.as_newick_string()
+            assert [n.is_burst_node for n in new_root] == [
+                    n.is_burst_node for n in root]
+
+        stream.seek(0)
+        with pytest.raises(ValueError):
+            list(newick.iter_trees(stream, burst_times = [[]]))
+
+
+class TestIterSamples:
+    @pytest.mark.parametrize("output_format", ["yaml", "jsonl"])
+    def test_sim_SDSD_trees_output(self, output_format):
+        sdsd_model = model.SDSDModel(burst_rate = 2.0)
+        stream = io.StringIO()
+        writer = sim_SDSD_trees.SAMPLE_WRITERS[output_format](stream)
+        writer.write_header({"seed": 1})
+        trees = []
+        for seed in range(20):
+            survived, root, burst_times = model.sim_SDSD_tree(
+                    rng_seed = seed,
+                    sdsd_model = sdsd_model,
+                    max_extant_leaves = 60,
+                    )
+            trees.append(root)
+            writer.write_sample(writer.get_sample(root, burst_times))
+        writer.finish()
+        stream.seek(0)
+        samples = list(newick.iter_samples(stream, output_format))
+        assert len(samples) == len(trees)
+        for root, (new_root, sample) in zip(trees, samples):
+            assert new_root.as_newick_string() == root.as_newick_string()
+            assert [n.is_burst_node for n in new_root] == [
+                    n.is_burst_node for n in root]
+            expected = sim_SDSD_trees.get_sample(new_root,
+                    sample["burst_times"])
+            assert expected == sample
+
+    def test_invalid_format(self):
+        with pytest.raises(ValueError):
+            list(newick.iter_samples(io.StringIO(""), "archive"))
@@ -2,11 +2,14 @@
 
 import os
 import sys
+import io
+import copy
+import pickle
 import math
 import random
 import pytest
 
-from sdsdsim import node
+from sdsdsim import node, model
 from sdsdsim.math_utils import is_zero 
 
 
@@ -119,3 +122,310 @@ class TestHeight:
         assert root.number_of_leaves == 5
         assert root.number_of_extant_leaves == 0
         assert root.number_of_extinct_leaves == 5
+
+
+class TestStateChanges:
+    def test_lazy_state_changes(self):
+        n = node.Node(rootward_state = 0, time = 2.0)
+        assert not hasattr(n, "__dict__")
+        assert n.state_changes == []
+        assert n.state_change_times == []
+        assert n.leafward_state == 0
+
+        n.transition_state(1, 0.5)
+        n.transition_state(0, 1.0)
+        assert n.state_changes == [(0, 1), (1, 0)]
+        assert n.state_change_times == [0.5, 1.0]
+        assert n.leafward_state == 0
+
+        # The returned lists are copies, whether or not there are changes
+        n.state_changes.append((0, 1))
+        n.state_change_times.append(1.5)
+        assert n.state_changes == [(0, 1), (1, 0)]
+        assert n.state_change_times == [0.5, 1.0]
+        empty = node.Node(rootward_state = 0, time = 2.0)
+        empty.state_changes.append((0, 1))
+        assert empty.state_changes == []
+
+        n.state_changes = []
+        n.state_change_times = []
+        assert n.state_changes == []
+        assert n.state_change_times == []
+
+    def test_copy(self):
+        root = node.Node(rootward_state = 0, time = 1.0)
+        root.seed_time = 0.0
+        for i in range(2):
+            child = node.Node(rootward_state = 0, time = 3.0)
+            root.add_child(child)
+        child.transition_state(1, 2.0)
+        root_copy = copy.deepcopy(root)
+        assert root_copy.as_newick_string() == root.as_newick_string()
+        root_copy = pickle.loads(pickle.dumps(root))
+        assert root_copy.as_newick_string() == root.as_newick_string()
+        assert root_copy.children[1].state_changes == [(0, 1)]
+        assert root_copy.children[0].state_changes == []
+
+
+def reference_remove_unifurcations(root):
+    # The previous, quadratic implementation of `Node.remove_unifurcations`
+    new_root = copy.deepcopy(root)
+    uni_nodes = [n for n in new_root if len(n.children) == 1]
+    for n in uni_nodes:
+        child = n.children[0]
+        child.rootward_state = n.rootward_state
+        child.state_changes = (
+            list(n.state_changes) + list(child.state_changes))
+        child.state_change_times = (
+            list(n.state_change_times) + list(child.state_change_times))
+        if n.parent is not None:
+            p = n.parent
+            p.children.remove(n)
+            p.add_child(child)
+        else:
+            child.parent = None
+            child.seed_time = n.seed_time
+            new_root = child
+    return new_root
+
+def reference_prune_extinct_leaves(root):
+    # The previous, quadratic implementation of `Node.prune_extinct_leaves`
+    if not root.has_extant_leaves:
+        return None
+    new_root = copy.deepcopy(root)
+    pruned = True
+    while pruned:
+        pruned = False
+        for n in new_root:
+            if not n.has_extant_leaves:
+                n.parent.remove_child(n)
+                pruned = True
+                break
+    return reference_remove_unifurcations(new_root)
+
+
+class TestPruneExtinctLeaves:
+    def test_matches_reference(self):
+        sdsd_model = model.SDSDModel(
+                q = [
+                    [-1.0, 1.0],
+                    [1.0, -1.0],
+                ],
+                birth_rates = [1.0, 1.0],
+                death_rates = [0.9, 0.9],
+                burst_rate = 0.5,
+                burst_probs = [0.2, 0.5],
+                burst_furcation_poisson_means = [1.0, 1.0],
+                burst_furcation_poisson_shifts = [1, 2],
+                only_bifurcate = False,
+                )
+        rng = random.Random(1)
+        n_pruned = 0
+        for i in range(100):
+            survived, root, burst_times = model.sim_SDSD_tree(
+                    rng_seed = rng.random(),
+                    sdsd_model = sdsd_model,
+                    max_extant_leaves = 20,
+                    )
+            original = root.as_newick_string()
+            expected = reference_prune_extinct_leaves(root)
+            pruned = root.prune_extinct_leaves()
+            assert root.as_newick_string() == original
+            if expected is None:
+                assert pruned is None
+                assert root.prune_extinct_leaves(in_place = True) is None
+                continue
+            n_pruned += 1
+            assert pruned.as_newick_string() == expected.as_newick_string()
+            assert pruned.number_of_extinct_leaves == 0
+            for n in pruned:
+                assert len(n.children) != 1
+            pruned_in_place = root.prune_extinct_leaves(in_place = True)
+            assert (pruned_in_place.as_newick_string() ==
+                    expected.as_newick_string())
+        assert n_pruned > 10
+
+    def test_remove_unifurcations(self):
+        root = node.Node(rootward_state = 0, time = 1.0, label = "r")
+        root.seed_time = 0.0
+        a = node.Node(rootward_state = 0, time = 2.0, label = "a")
+        b = node.Node(rootward_state = 0, time = 3.0, label = "b")
+        c = node.Node(rootward_state = 0, time = 4.0, label = "c")
+        d = node.Node(rootward_state = 0, time = 4.0, label = "d")
+        e = node.Node(rootward_state = 1, time = 4.0, label = "e")
+        root.add_child(a)
+        a.add_child(b)
+        a.add_child(e)
+        b.add_child(c)
+        b.add_child(d)
+        a.transition_state(1, 1.5)
+        b.rootward_state = 1
+        b.transition_state(0, 2.5)
+        expected = reference_remove_unifurcations(root)
+        new_root = root.remove_unifurcations()
+        assert new_root.as_newick_string() == expected.as_newick_string()
+        assert new_root.label == "a"
+        assert new_root.seed_time == 0.0
+        assert new_root.rootward_state == 0
+        assert new_root.state_changes == [(0, 1)]
+        assert root.remove_unifurcations(
+                in_place = True).as_newick_string() == (
+                        expected.as_newick_string())
+        with pytest.raises(ValueError):
+            c.remove_unifurcations(in_place = True)
+
+
+class TestCachedAggregates:
+    def test_invalidation(self):
+        root = node.Node(time = 1.0)
+        root.seed_time = 0.0
+        a = node.Node(time = 2.0)
+        b = node.Node(time = 3.0)
+        root.add_child(a)
+        root.add_child(b)
+        c = node.Node(time = 4.0)
+        d = node.Node(time = 5.0)
+        a.add_child(c)
+        a.add_child(d)
+
+        assert root.number_of_leaves == 3
+        assert a.number_of_leaves == 2
+        assert root.max_time == 5.0
+        assert root.height == 4.0
+        assert a.height == 3.0
+
+        # Changing the time of a leaf
+        d.time = 6.0
+        assert root.max_time == 6.0
+        assert b.height == 3.0
+
+        # Adding a child to a leaf
+        e = node.Node(time = 7.0)
+        b.add_child(e)
+        assert root.number_of_leaves == 3
+        assert b.number_of_leaves == 1
+        assert root.max_time == 7.0
+
+        # Setting the parent of a node moves its subtree
+        a.parent = b
+        assert root.number_of_leaves == 3
+        assert b.number_of_leaves == 3
+        assert root.children == [b]
+
+        # Removing a child
+        b.remove_child(e)
+        assert root.number_of_leaves == 2
+        assert root.max_time == 6.0
+
+        # Extinction
+        c.is_extinct = True
+        assert root.number_of_extant_leaves == 1
+        assert root.number_of_extinct_leaves == 1
+        assert root.has_extant_leaves
+        d.is_extinct = True
+        assert not root.has_extant_leaves
+        assert not a.has_extant_leaves
+        assert root.prune_extinct_leaves() is None
+
+
+def reference_write_newick(nd, out, include_root_annotations,
+        branch_annot_func):
+    # The previous, recursive implementation of `Node._write_newick`
+    if nd.is_root and include_root_annotations:
+        out.write("(")
+    if nd.is_leaf:
+        out.write(f"{branch_annot_func(nd, include_label = True)}")
+    else:
+        out.write("(");
+        for i, child in enumerate(nd.children):
+            if i > 0:
+                out.write(",")
+            reference_write_newick(child, out, include_root_annotations,
+                    branch_annot_func)
+        if nd.is_root and (not include_root_annotations):
+            out.write(f")");
+        else:
+            out.write(f"){branch_annot_func(nd, include_label = False)}");
+        if nd.is_root and include_root_annotations:
+            out.write(f")");
+
+def reference_newick_string(root, include_root_annotations,
+        branch_annot_func):
+    out = io.StringIO()
+    reference_write_newick(root, out, include_root_annotations,
+            branch_annot_func)
+    out.write(";")
+    return out.getvalue()
+
+
+class TestWriteNewick:
+    def test_matches_reference(self):
+        sdsd_model = model.SDSDModel(
+                q = [
+                    [-1.0, 1.0],
+                    [1.0, -1.0],
+                ],
+                birth_rates = [1.0, 1.0],
+                death_rates = [0.5, 0.5],
+                burst_rate = 0.5,
+                burst_probs = [0.2, 0.5],
+                burst_furcation_poisson_means = [1.0, 1.0],
+                burst_furcation_poisson_shifts = [2, 2],
+                only_bifurcate = False,
+                )
+        rng = random.Random(1)
+        for i in range(50):
+            survived, root, burst_times = model.sim_SDSD_tree(
+                    rng_seed = rng.random(),
+                    sdsd_model = sdsd_model,
+                    max_extant_leaves = 20,
+                    )
+            for include_root_annotations in (True, False):
+                for annot_func, as_string, write in (
+                        (node.Node.as_simmap_string,
+                         root.as_newick_simmap_string,
+                         root.write_newick_simmap),
+                        (node.Node.as_length_string,
+                         root.as_newick_simple_string,
+                         root.write_newick_simple),
+                        ):
+                    expected = reference_newick_string(root,
+                            include_root_annotations, annot_func)
+                    assert as_string(include_root_annotations) == expected
+                    out = io.StringIO()
+                    write(out, include_root_annotations)
+                    assert out.getvalue() + ";" == expected
+
+    def test_single_node(self):
+        root = node.Node(rootward_state = 0, time = 1.0, label = "L1")
+        root.seed_time = 0.0
+        for include_root_annotations in (True, False):
+            assert root.as_newick_string(include_root_annotations) == (
+                    reference_newick_string(root, include_root_annotations,
+                            node.Node.as_simmap_string))
+
+    def test_deep_tree(self):
+        # A caterpillar tree deeper than the recursion limit
+        depth = sys.getrecursionlimit() + 1000
+        root = node.Node(rootward_state = 0, time = 0.0)
+        root.seed_time = 0.0
+        n = root
+        for i in range(depth):
+            n.add_child(node.Node(rootward_state = 0, time = i + 1.0,
+                    label = f"L{i}"))
+            child = node.Node(rootward_state = 0, time = i + 1.0)
+            n.add_child(child)
+            n = child
+        n.add_child(node.Node(rootward_state = 0, time = depth + 1.0,
+                label = "L"))
+        n.add_child(node.Node(rootward_state = 0, time = depth + 1.0,
+                label = "M"))
+        s = root.as_newick_simple_string()
+        # One parenthesis per internal node, plus the root wrap
+        assert s.count("(") == depth + 2
+        assert s.count(")") == depth + 2
+        assert s.startswith("((L0:1.0,(L1:1.0,(")
+        assert "(L:1.0,M:1.0):1.0):1.0)" in s
+        assert s.endswith(":1.0):1.0):0.0);")
+        assert root.number_of_leaves == depth + 2
+        assert root.max_time == depth + 1.0
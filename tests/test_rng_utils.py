@@ -142,6 +142,76 @@ class TestGetWeightedIndex:
         assert props[1] == 0.0
 
 
+class TestBernoulliIndices:
+    def test_edge_cases(self):
+        rng = random.Random(1)
+        assert rng_utils.bernoulli_indices(0, 0.5, rng) == []
+        assert rng_utils.bernoulli_indices(5, 0.0, rng) == []
+        assert rng_utils.bernoulli_indices(5, 1.0, rng) == [0, 1, 2, 3, 4]
+
+    def test_03(self):
+        rng = random.Random(1)
+        p = 0.3
+        n_trials = 10
+        counts = [0 for i in range(n_trials)]
+        ss = SampleSummarizer()
+        n = 100000
+        for rep in range(n):
+            indices = rng_utils.bernoulli_indices(n_trials, p, rng)
+            assert indices == sorted(set(indices))
+            ss.add_sample(len(indices))
+            for i in indices:
+                counts[i] += 1
+        for c in counts:
+            assert is_zero((c / n) - p, 0.005)
+        assert is_zero(ss.mean - (n_trials * p), 0.02)
+        assert is_zero(ss.variance - (n_trials * p * (1.0 - p)), 0.05)
+
+
+class TestAliasSampler:
+    def test_nonuniform(self):
+        rng = random.Random(1)
+        weights = [0.5, 3.0, 0.0, 1.5, 2.0, 0.001]
+        total = sum(weights)
+        sampler = rng_utils.AliasSampler(weights)
+        assert len(sampler) == len(weights)
+        counts = [0 for w in weights]
+        n = 200000
+        for rep in range(n):
+            counts[sampler.draw(rng)] += 1
+        assert counts[2] == 0
+        for c, w in zip(counts, weights):
+            assert is_zero((c / n) - (w / total), 0.005)
+
+    def test_single_positive_weight(self):
+        rng = random.Random(1)
+        sampler = rng_utils.AliasSampler([0.0, 0.0, 2.0, 0.0])
+        for rep in range(1000):
+            assert sampler.draw(rng) == 2
+        sampler = rng_utils.AliasSampler([5.0])
+        for rep in range(10):
+            assert sampler.draw(rng) == 0
+
+    def test_many_weights(self):
+        # Weights that do not divide evenly leave rounding error in the tables
+        rng = random.Random(1)
+        weights = [0.0 if (i % 3) == 0 else 1.0 / (i + 1) for i in range(100)]
+        sampler = rng_utils.AliasSampler(weights)
+        for rep in range(20000):
+            assert weights[sampler.draw(rng)] > 0.0
+
+    @pytest.mark.parametrize("weights", [
+        [],
+        [0.0, 0.0],
+        [1.0, -0.5],
+        [1.0, float("inf")],
+        [1.0, float("nan")],
+    ])
+    def test_invalid_weights(self, weights):
+        with pytest.raises(ValueError):
+            rng_utils.AliasSampler(weights)
+
+
 class TestPoissonRV:
     def test_1(self):
         rng = random.Random(1)
@@ -176,17 +246,136 @@ class TestPoissonRV:
         assert is_zero(mean - ss.mean, 0.001)
         assert is_zero(mean - ss.variance, 0.001)
 
-    def test_underflow(self):
-        rng_utils.LN_MIN_FLOAT = -1.1
-
+    @pytest.mark.parametrize("mean", [10.0, 15.3, 100.0, 2500.0])
+    def test_large_means(self, mean):
         rng = random.Random(1)
-        mean = 3.0
-        n = 1000000
+        n = 200000
         ss = SampleSummarizer()
+        for k in rng_utils.poisson_rvs(mean, n, rng):
+            ss.add_sample(k)
+        # Within 5 standard errors
+        assert is_zero(mean - ss.mean, 5.0 * math.sqrt(mean / n))
+        assert is_zero(1.0 - (ss.variance / mean), 0.02)
+
+    def test_pmf(self):
+        rng = random.Random(1)
+        mean = 12.0
+        n = 200000
+        counts = {}
         for rep in range(n):
-            n = rng_utils.poisson_rv(mean, rng)
-            ss.add_sample(n)
-        assert is_zero(mean - ss.mean, 0.001)
-        assert is_zero(mean - ss.variance, 0.001)
+            k = rng_utils.poisson_rv(mean, rng)
+            counts[k] = counts.get(k, 0) + 1
+        for k in range(30):
+            pmf = math.exp(-mean + (k * math.log(mean)) - math.lgamma(k + 1))
+            assert is_zero((counts.get(k, 0) / n) - pmf, 0.002)
+
+    def test_flat_cost(self):
+        class CountingRandom(random.Random):
+            n_draws = 0
+            def random(self):
+                self.n_draws += 1
+                return super().random()
+        for mean in (20.0, 1000.0, 1e6):
+            rng = CountingRandom(1)
+            n = 10000
+            rng_utils.poisson_rvs(mean, n, rng)
+            assert (rng.n_draws / n) < 3.0
+
+    def test_batch_matches_single_draws(self):
+        for mean in (0.5, 3.0, 20.0, 500.0):
+            rng1 = random.Random(1)
+            rng2 = random.Random(1)
+            assert rng_utils.poisson_rvs(mean, 1000, rng1) == [
+                    rng_utils.poisson_rv(mean, rng2) for i in range(1000)]
+
+
+class TestRNGBackends:
+    def test_get_rng(self):
+        assert isinstance(rng_utils.get_rng(1), random.Random)
+        assert isinstance(rng_utils.get_rng(1, "numpy"), rng_utils.NumpyRNG)
+        with pytest.raises(ValueError):
+            rng_utils.get_rng(1, "bogus")
+
+    @pytest.mark.parametrize("seed", [1, -1, 2**64 - 1, 0.25])
+    def test_numpy_reproducible(self, seed):
+        draws = []
+        for rep in range(2):
+            rng = rng_utils.get_rng(seed, "numpy")
+            draws.append((
+                [rng.random() for i in range(2000)],
+                [rng.randrange(7) for i in range(100)],
+                rng_utils.poisson_rvs(3.0, 100, rng),
+                rng_utils.bernoulli_indices(100, 0.3, rng),
+                rng_utils.exponential_rvs([1.0, 2.0, 3.0], rng),
+                rng_utils.weighted_indices([1.0, 2.0], 100, rng),
+                rng.random(),
+            ))
+        assert draws[0] == draws[1]
+        other = rng_utils.get_rng(3, "numpy")
+        assert [other.random() for i in range(10)] != draws[0][0][:10]
+
+    @pytest.mark.parametrize("backend", rng_utils.RNG_BACKENDS)
+    def test_negative_seeds(self, backend):
+        # Both backends ignore the sign of seeds
+        streams = set()
+        for seed in (5, -5):
+            rng = rng_utils.get_rng(seed, backend)
+            streams.add(tuple(rng.random() for i in range(10)))
+        assert len(streams) == 1
+
+    def test_python_bulk_matches_scalar_draws(self):
+        rng1 = rng_utils.get_rng(1)
+        rng2 = random.Random(1)
+        assert rng_utils.uniform_rvs(10, rng1) == [
+                rng2.random() for i in range(10)]
+        assert rng_utils.exponential_rvs([1.0, 2.0], rng1) == [
+                rng2.expovariate(1.0), rng2.expovariate(2.0)]
+        assert rng_utils.weighted_indices([1.0, 0.0, 2.0], 10, rng1) == [
+                rng_utils.get_weighted_index([1.0, 0.0, 2.0], rng2)
+                for i in range(10)]
+
+    @pytest.mark.parametrize("backend", rng_utils.RNG_BACKENDS)
+    def test_scalar_draws(self, backend):
+        rng = rng_utils.get_rng(1, backend)
+        n = 200000
+        uniforms = SampleSummarizer(rng.random() for i in range(n))
+        assert 0.0 <= uniforms.minimum and uniforms.maximum < 1.0
+        assert is_zero(uniforms.mean - 0.5, 0.005)
+        assert is_zero(uniforms.variance - (1.0 / 12.0), 0.005)
+        exponentials = SampleSummarizer(rng.expovariate(4.0) for i in range(n))
+        assert is_zero(exponentials.mean - 0.25, 0.005)
+        counts = [0 for i in range(5)]
+        for i in range(n):
+            counts[rng.randrange(5)] += 1
+        for c in counts:
+            assert is_zero((c / n) - 0.2, 0.005)
+        assert set(rng.randint(2, 4) for i in range(1000)) == {2, 3, 4}
 
-        rng_utils.LN_MIN_FLOAT = math.log(rng_utils.MIN_FLOAT)
+    @pytest.mark.parametrize("backend", rng_utils.RNG_BACKENDS)
+    def test_bulk_draws(self, backend):
+        rng = rng_utils.get_rng(1, backend)
+        n = 200000
+        uniforms = SampleSummarizer(rng_utils.uniform_rvs(n, rng))
+        assert is_zero(uniforms.mean - 0.5, 0.005)
+        rates = [0.5, 2.0] * (n // 2)
+        waits = rng_utils.exponential_rvs(rates, rng)
+        assert is_zero(SampleSummarizer(waits[0::2]).mean - 2.0, 0.05)
+        assert is_zero(SampleSummarizer(waits[1::2]).mean - 0.5, 0.01)
+        poissons = SampleSummarizer(rng_utils.poisson_rvs(2.5, n, rng))
+        assert is_zero(poissons.mean - 2.5, 0.02)
+        assert is_zero(poissons.variance - 2.5, 0.05)
+        weights = [5.0, 0.0, 3.0, 2.0]
+        counts = [0 for w in weights]
+        for i in rng_utils.weighted_indices(weights, n, rng):
+            counts[i] += 1
+        assert counts[1] == 0
+        for c, w in zip(counts, weights):
+            assert is_zero((c / n) - (w / sum(weights)), 0.005)
+        counts = [0 for i in range(10)]
+        for rep in range(20000):
+            indices = rng_utils.bernoulli_indices(10, 0.3, rng)
+            assert indices == sorted(set(indices))
+            for i in indices:
+                counts[i] += 1
+        for c in counts:
+            assert is_zero((c / 20000) - 0.3, 0.015)
@@ -0,0 +1,208 @@
+#! /usr/bin/env python
+
+import os
+import sys
+import json
+import math
+import random
+import pytest
+import yaml
+
+from sdsdsim import archive
+from sdsdsim.cli import sim_SDSD_trees
+
+
+CONFIG = """
+model:
+  q : [ [-0.3,    0.3],
+        [0.3,     -0.3] ]
+  birth_rates : [1.0, 1.0]
+  death_rates : [0.5, 0.5]
+  burst_rate : 1.5
+  burst_probs : [0.1, 0.8]
+  burst_furcation_poisson_means : [0.6, 0.6]
+  burst_furcation_poisson_shifts : [2, 2]
+  only_bifurcate : False
+
+settings:
+  prune_extinct_leaves: True
+  keep_extinct_trees: False
+  max_leaves_strict: True
+  stopping_conditions:
+    max_extant_leaves : 20
+"""
+
+@pytest.fixture
+def config_path(tmp_path):
+    path = tmp_path / "config.yml"
+    path.write_text(CONFIG)
+    return str(path)
+
+def run_main(monkeypatch, capsys, args):
+    monkeypatch.setattr(sys, "argv", ["sim-SDSD-trees"] + args)
+    sim_SDSD_trees.main()
+    return capsys.readouterr()
+
+
+class TestMain:
+    def test_output(self, monkeypatch, capsys, config_path):
+        out = run_main(monkeypatch, capsys, ["-n", "5", "-s", "1", config_path])
+        data = yaml.safe_load(out.out)
+        assert data['seed'] == 1
+        assert len(data['trees']) == 5
+        for sample in data['trees']:
+            assert sample['tree'].endswith(";")
+            assert "XL" not in sample['tree']
+            assert sample['tree'].count("L") == 20
+
+    def test_jobs(self, monkeypatch, capsys, config_path):
+        serial = run_main(monkeypatch, capsys,
+                ["-n", "10", "-s", "1", config_path])
+        parallel = run_main(monkeypatch, capsys,
+                ["-n", "10", "-s", "1", "-j", "3", config_path])
+        assert serial.out == parallel.out
+        assert serial.err == parallel.err
+
+    def test_yaml_matches_single_dump(self, monkeypatch, capsys, config_path):
+        out = run_main(monkeypatch, capsys, ["-n", "5", "-s", "1", config_path])
+        data = yaml.safe_load(out.out)
+        assert out.out == yaml.dump(data, default_flow_style = False)
+
+    def test_jsonl(self, monkeypatch, capsys, tmp_path, config_path):
+        yaml_out = run_main(monkeypatch, capsys,
+                ["-n", "5", "-s", "1", config_path])
+        path = str(tmp_path / "trees.jsonl")
+        run_main(monkeypatch, capsys,
+                ["-n", "5", "-s", "1", "-f", "jsonl", "-o", path, config_path])
+        with open(path) as stream:
+            lines = stream.readlines()
+        assert len(lines) == 6
+        header = json.loads(lines[0])
+        samples = [json.loads(l) for l in lines[1:]]
+        data = yaml.safe_load(yaml_out.out)
+        assert samples == data.pop('trees')
+        assert header == data
+
+    @pytest.mark.parametrize("output_format", ["yaml", "jsonl", "archive"])
+    def test_resume(self, monkeypatch, capsys, tmp_path, config_path,
+            output_format):
+        full_path = str(tmp_path / "full.out")
+        run_main(monkeypatch, capsys,
+                ["-n", "12", "-s", "1", "-f", output_format,
+                 "-o", full_path, config_path])
+
+        # Interrupt a run right after the checkpoint at 5 trees
+        path = str(tmp_path / "interrupted.out")
+        write_checkpoint = sim_SDSD_trees.write_checkpoint
+        def interrupting_write_checkpoint(p, checkpoint):
+            write_checkpoint(p, checkpoint)
+            if checkpoint['number_of_samples'] == 5:
+                raise KeyboardInterrupt
+        monkeypatch.setattr(sim_SDSD_trees, "write_checkpoint",
+                interrupting_write_checkpoint)
+        with pytest.raises(KeyboardInterrupt):
+            run_main(monkeypatch, capsys,
+                    ["-n", "12", "-s", "1", "-f", output_format,
+                     "--checkpoint-interval", "5", "-o", path, config_path])
+        monkeypatch.setattr(sim_SDSD_trees, "write_checkpoint",
+                write_checkpoint)
+        # Mimic a partially written tree after the checkpoint
+        with open(path, "a") as stream:
+            stream.write("- burst_times:\n  - 0.1")
+
+        run_main(monkeypatch, capsys,
+                ["-n", "12", "-f", output_format, "--resume",
+                 "-o", path, config_path])
+        with open(full_path, "rb") as stream:
+            expected = stream.read()
+        with open(path, "rb") as stream:
+            assert stream.read() == expected
+
+    def test_archive(self, monkeypatch, capsys, tmp_path, config_path):
+        yaml_out = run_main(monkeypatch, capsys,
+                ["-n", "5", "-s", "1", config_path])
+        path = str(tmp_path / "trees.archive")
+        run_main(monkeypatch, capsys,
+                ["-n", "5", "-s", "1", "-f", "archive", "-o", path,
+                 config_path])
+        data = yaml.safe_load(yaml_out.out)
+        samples = data.pop('trees')
+        with archive.TreeArchiveReader(path) as reader:
+            assert reader.metadata == data
+            assert len(reader) == 5
+            for i, sample in enumerate(samples):
+                tree = reader.get_tree(i)
+                assert tree.to_node().as_newick_string() == sample['tree']
+                assert list(reader.get_burst_times(i)) == (
+                        sample['burst_times'])
+                assert sorted(set(tree.time[tree.is_burst_node])) == (
+                        sample['burst_times_with_nodes'])
+
+    def test_rng_backend(self, monkeypatch, capsys, tmp_path):
+        path = tmp_path / "config.yml"
+        path.write_text(CONFIG + "  rng_backend: numpy\n")
+        serial = run_main(monkeypatch, capsys,
+                ["-n", "5", "-s", "1", str(path)])
+        parallel = run_main(monkeypatch, capsys,
+                ["-n", "5", "-s", "1", "-j", "2", str(path)])
+        assert serial.out == parallel.out
+        data = yaml.safe_load(serial.out)
+        assert data['settings']['rng_backend'] == "numpy"
+        assert len(data['trees']) == 5
+
+        path.write_text(CONFIG + "  rng_backend: bogus\n")
+        with pytest.raises(SystemExit):
+            run_main(monkeypatch, capsys, ["-n", "5", "-s", "1", str(path)])
+
+    def test_condition_on_survival(self, monkeypatch, capsys, tmp_path,
+            config_path):
+        path = tmp_path / "conditioned-config.yml"
+        path.write_text(CONFIG + "  condition_on_survival: True\n")
+        out = run_main(monkeypatch, capsys, ["-n", "5", "-s", "1", str(path)])
+        data = yaml.safe_load(out.out)
+        assert data['settings']['condition_on_survival']
+        assert len(data['trees']) == 5
+        for sample in data['trees']:
+            assert sample['log_weight'] <= 0.0
+        plain = run_main(monkeypatch, capsys,
+                ["-n", "5", "-s", "1", config_path])
+        for sample in yaml.safe_load(plain.out)['trees']:
+            assert 'log_weight' not in sample
+
+        with pytest.raises(SystemExit):
+            run_main(monkeypatch, capsys,
+                    ["-n", "5", "-s", "1", "-f", "archive",
+                     "-o", str(tmp_path / "trees.archive"), str(path)])
+
+    def test_metrics(self, monkeypatch, capsys, tmp_path, config_path):
+        plain = run_main(monkeypatch, capsys,
+                ["-n", "5", "-s", "1", config_path])
+        path = str(tmp_path / "metrics.json")
+        out = run_main(monkeypatch, capsys,
+                ["-n", "5", "-s", "1", "--progress-interval", "1e-9",
+                 "--metrics-output", path, config_path])
+        assert out.out == plain.out
+        with open(path) as stream:
+            summary = json.load(stream)
+        assert summary['accepted'] == 5
+        assert summary['attempts'] == 5 + sum(summary['rejections'].values())
+        assert summary['events'] > 0
+        for stage in ('simulation', 'pruning', 'serialization'):
+            assert summary['stage_seconds'][stage] > 0.0
+        progress = [l for l in out.err.splitlines()
+                if l.startswith("Progress: ")]
+        assert len(progress) == summary['attempts'] + 1
+        assert progress[-1].startswith(
+                f"Progress: 5 of {summary['attempts']} replicates accepted")
+        assert [l for l in out.err.splitlines()
+                if not l.startswith("Progress: ")] == plain.err.splitlines()
+
+    def test_resume_seed_mismatch(self, monkeypatch, capsys, tmp_path,
+            config_path):
+        path = str(tmp_path / "trees.yml")
+        run_main(monkeypatch, capsys,
+                ["-n", "2", "-s", "1", "-o", path, config_path])
+        with pytest.raises(SystemExit):
+            run_main(monkeypatch, capsys,
+                    ["-n", "4", "-s", "2", "--resume", "-o", path,
+                     config_path])